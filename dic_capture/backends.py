@@ -0,0 +1,479 @@
+"""This module contains the camera and trigger backends used by the run function. The "neoapi" camera backend and the
+"serial" trigger backend talk to the Baumer cameras and the Arduino. The "simulated" camera backend and the "loopback"
+trigger backend stand in for them, so that the capture -> handoff -> save path can be run and timed on any machine
+without hardware attached.
+
+The backends are selected with the optional "Backend" section of the config file, e.g.
+    "Backend": {
+        "Camera": "simulated",
+        "Trigger": "loopback",
+        "Simulated Width": 2448,
+        "Simulated Height": 2048,
+        "Simulated FPS": 100,
+        "Simulated Jitter (ms)": 0.05,
+        "Simulated Drop Rate": 0.001
+    }
+
+The "replay" camera backend (see replay.py) feeds the frames of a recorded test back through the pipeline.
+"""
+
+# ======================================================================================================================
+# Imports
+
+import logging
+import os
+import threading
+from time import perf_counter, perf_counter_ns, sleep
+from typing import Dict, Any, Optional
+
+import numpy as np
+
+from packed12 import pack12, packed_shape
+from schedule import parse_trigger_stages
+from serial_protocol import BINARY_REQUEST_PREFIX, encode_trigger_event
+
+# ======================================================================================================================
+# Global variables
+
+SIMULATED_DEFAULTS = {
+    "Simulated Width": 2448,
+    "Simulated Height": 2048,
+    "Simulated FPS": 100,
+    "Simulated Jitter (ms)": 0.05,
+    "Simulated Drop Rate": 0.0,
+    "Simulated Clock Drift (ppm)": 0.0,
+}
+PULSE_HISTORY = 4096  # pulse times kept by the simulated trigger line, far more than a camera has image buffers
+CAMERA_BACKENDS = ('neoapi', 'simulated', 'replay')
+TRIGGER_BACKENDS = ('serial', 'loopback')
+
+
+# ======================================================================================================================
+# Simulated camera
+
+class SimulatedTriggerLine:
+    """Stand-in for the trigger cable between the Arduino and the cameras. The loopback serial port pulses the line and
+    simulated cameras in hardware trigger mode produce one frame per pulse. The times of the last PULSE_HISTORY
+    pulses are kept, so memory does not grow during open ended runs."""
+
+    def __init__(self):
+        self.count = 0
+        self.pulse_times_ns = np.zeros(PULSE_HISTORY, dtype=np.int64)  # indexed by pulse number modulo PULSE_HISTORY
+        self._condition = threading.Condition()
+
+    def pulse(self):
+        with self._condition:
+            self.pulse_times_ns[self.count % PULSE_HISTORY] = perf_counter_ns()
+            self.count += 1
+            self._condition.notify_all()
+
+    def wait_for_pulse(self, pulse_index: int, timeout_s: float) -> Optional[int]:
+        """Wait until pulse number pulse_index has fired and return its host time in ns, or None on timeout."""
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.count > pulse_index, timeout_s):
+                return None
+            return int(self.pulse_times_ns[pulse_index % PULSE_HISTORY])
+
+
+class SimulatedImage:
+    """Mimics the parts of neoapi.Image used by the capture pipeline."""
+
+    def __init__(self, array: Optional[np.ndarray] = None, image_id: int = 0, timestamp_ns: int = 0):
+        self._array = array
+        self._image_id = image_id
+        self._timestamp_ns = timestamp_ns
+
+    def IsEmpty(self) -> bool:
+        return self._array is None
+
+    def GetNPArray(self) -> np.ndarray:
+        return self._array
+
+    def GetImageID(self) -> int:
+        return self._image_id
+
+    def GetTimestamp(self) -> int:
+        return self._timestamp_ns
+
+    def GetWidth(self) -> int:
+        return self._array.shape[1]
+
+    def GetHeight(self) -> int:
+        return self._array.shape[0]
+
+
+class _SimulatedFeature:
+    """Mimics a neoapi feature with Get/Set methods."""
+
+    def __init__(self, value, inc=1, writable=True):
+        self.value = value
+        self.inc = inc
+        self.writable = writable
+
+    def Get(self):
+        return self.value
+
+    def Set(self, value):
+        self.value = value
+
+    def GetString(self) -> str:
+        return str(self.value)
+
+    def SetString(self, value: str):
+        self.value = value
+
+    def GetInc(self):
+        return self.inc
+
+    def IsWritable(self) -> bool:
+        return self.writable
+
+
+class _SimulatedFeatureAccess:
+    """Mimics neoapi.Cam.f. Features that are assigned directly (e.g. TriggerMode) are stored as plain attributes."""
+
+    def __init__(self, width: int, height: int):
+        self.PixelFormat = _SimulatedFeature('Mono12')
+        self.ExposureTime = _SimulatedFeature(10000.0)
+        self.Gain = _SimulatedFeature(1.0)
+        self.Width = _SimulatedFeature(width, inc=8)
+        self.Height = _SimulatedFeature(height, inc=2)
+        self.WidthMax = _SimulatedFeature(width, writable=False)
+        self.HeightMax = _SimulatedFeature(height, writable=False)
+        self.OffsetX = _SimulatedFeature(0, inc=8)
+        self.OffsetY = _SimulatedFeature(0, inc=2)
+        self.TriggerMode = 'Off'
+        self.TriggerSource = 'Software'
+        self.TriggerActivation = 'RisingEdge'
+
+
+class SimulatedCam:
+    """Synthetic camera that mimics the parts of neoapi.Cam used by the capture pipeline. It produces Mono12 speckle
+    frames either free running at the configured FPS or, in hardware trigger mode, on pulses of a SimulatedTriggerLine.
+
+    Dropped frames are simulated the way the SDK reports them: the ImageID still advances, but no image is delivered.
+    Frames are also lost, like on the camera, when the host falls more than SetImageBufferCount frames behind.
+    Timestamps are in ns on a camera clock with a random power-up offset and an optional drift, like GetTimestamp()."""
+
+    def __init__(self, width: int, height: int, fps: float, jitter_ms: float = 0.0, drop_rate: float = 0.0,
+                 clock_drift_ppm: float = 0.0, trigger_line: Optional[SimulatedTriggerLine] = None, seed: int = 0):
+        self.f = _SimulatedFeatureAccess(width, height)
+        self.fps = float(fps)
+        self.jitter_ns = jitter_ms * 1e6
+        self.drop_rate = drop_rate
+        self.clock_drift = clock_drift_ppm * 1e-6
+        self.trigger_line = trigger_line
+        self.rng = np.random.default_rng(seed)
+        self.clock_offset_ns = int(self.rng.integers(10 ** 9, 10 ** 12))
+        self.connected = False
+        self.buffer_count = 10
+        self.next_image_id = 0
+        self.t_start_ns = None
+        self.patterns = None
+        self.stamp = None
+        self.buffers = []
+
+    # Connection and buffer settings (neoapi.Cam API)
+    def Connect(self, src: str = '') -> 'SimulatedCam':
+        self.connected = True
+        return self
+
+    def IsConnected(self) -> bool:
+        return self.connected
+
+    def Disconnect(self):
+        self.connected = False
+
+    def SetImageBufferCount(self, count: int):
+        self.buffer_count = int(count)
+        self.buffers = []
+
+    def SetImageBufferCycleCount(self, count: int):
+        pass
+
+    # Image acquisition (neoapi.Cam API)
+    def GetImage(self, timeout_ms: int = 400) -> SimulatedImage:
+        backlog = self._frames_available() - self.next_image_id
+        if backlog > self.buffer_count:  # the SDK had no free buffer for the oldest frames, they are lost
+            self.next_image_id += backlog - self.buffer_count
+        while True:
+            t_frame_ns = self._wait_for_frame(timeout_ms)
+            if t_frame_ns is None:
+                return SimulatedImage()
+            image_id = self.next_image_id
+            self.next_image_id += 1
+            if self.drop_rate <= 0 or self.rng.random() >= self.drop_rate:
+                break  # otherwise the frame was lost and the next one is returned with the following ImageID
+
+        t_frame_ns += self.f.ExposureTime.Get() * 1000
+        if self.jitter_ns:
+            t_frame_ns += self.rng.normal(0, self.jitter_ns)
+        timestamp_ns = self.clock_offset_ns + int(t_frame_ns * (1 + self.clock_drift))
+        return SimulatedImage(self._render(image_id), image_id, timestamp_ns)
+
+    def _frames_available(self) -> int:
+        """Number of frames the camera has exposed so far."""
+        if self.f.TriggerMode != 'Off' and self.trigger_line is not None:
+            return self.trigger_line.count
+        if self.t_start_ns is None:
+            return 0
+        return int((perf_counter_ns() - self.t_start_ns) * self.fps / 1e9) + 1
+
+    def _wait_for_frame(self, timeout_ms: int) -> Optional[int]:
+        """Wait for the next trigger pulse or free running frame time and return it in host ns, or None on timeout."""
+        if self.f.TriggerMode != 'Off' and self.trigger_line is not None:
+            return self.trigger_line.wait_for_pulse(self.next_image_id, timeout_ms / 1000)
+        if self.t_start_ns is None:
+            self.t_start_ns = perf_counter_ns()
+        t_frame_ns = self.t_start_ns + int(self.next_image_id * 1e9 / self.fps)
+        wait_s = (t_frame_ns - perf_counter_ns()) / 1e9
+        if wait_s > timeout_ms / 1000:
+            sleep(timeout_ms / 1000)
+            return None
+        if wait_s > 0:
+            sleep(wait_s)
+        return t_frame_ns
+
+    def _render(self, image_id: int) -> np.ndarray:
+        """Fill the next image buffer with a speckle pattern and stamp the ImageID into the first three pixels. In
+        PixelFormat Mono12p the buffer holds the packed payload, like the camera delivers it."""
+        shape = (int(self.f.Height.Get()), int(self.f.Width.Get()))
+        packed = self.f.PixelFormat.GetString() == 'Mono12p'
+        buffer_shape = packed_shape(shape) if packed else shape
+        if self.patterns is None or self.patterns[0].shape != shape:
+            self.patterns = [_speckle_pattern(shape, self.rng) for _ in range(4)]
+            self.stamp = np.empty(shape, dtype=np.uint16)
+        if self.buffers and self.buffers[0].shape != buffer_shape:
+            self.buffers = []
+        if len(self.buffers) < self.buffer_count:
+            self.buffers.append(np.empty(buffer_shape, dtype=np.uint8 if packed else np.uint16))
+        buffer = self.buffers[image_id % len(self.buffers)]
+        frame = self.stamp if packed else buffer
+        np.copyto(frame, self.patterns[image_id % len(self.patterns)])
+        frame[0, :3] = [(image_id >> shift) & 0xFFF for shift in (24, 12, 0)]
+        if packed:
+            pack12(frame, buffer)
+        return buffer
+
+
+def _speckle_pattern(shape, rng: np.random.Generator, speckle_px: int = 4) -> np.ndarray:
+    """Create a Mono12 speckle-like test pattern with blobs of roughly speckle_px pixels."""
+    height, width = shape
+    coarse = rng.integers(300, 3800, size=(-(-height // speckle_px), -(-width // speckle_px)), dtype=np.uint16)
+    pattern = np.repeat(np.repeat(coarse, speckle_px, axis=0), speckle_px, axis=1)[:height, :width]
+    noise = rng.integers(0, 64, size=shape, dtype=np.uint16)
+    return np.minimum(pattern + noise, 4095).astype(np.uint16)
+
+
+# ======================================================================================================================
+# Loopback serial port
+
+class LoopbackSerial:
+    """Stand-in for the Arduino on the other end of a serial.Serial connection. It speaks the same handshake as the
+    trigger sketch: the trigger stages string written by the host is answered with "RECIEVED", after which one record
+    is sent for every trigger, a "<stage>,<trigger count>,<micros>" line or a binary record if the stages were prefixed
+    with "B:" (see serial_protocol.py). Reads block up to `timeout` like pyserial."""
+
+    def __init__(self, port: str = 'loop://', baudrate: int = 115200, timeout: Optional[float] = None,
+                 trigger_line: Optional[SimulatedTriggerLine] = None):
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.trigger_line = trigger_line
+        self.is_open = True
+        self._rx = bytearray()
+        self._condition = threading.Condition()
+        self._closed = threading.Event()
+        self._trigger_thread = None
+        self._binary = False
+        self._t0 = perf_counter()
+        self.missed_pulses = 0  # pulses skipped because the trigger thread was stalled
+
+    # Writing (host -> Arduino)
+    def write(self, data: bytes) -> int:
+        text = data.decode('ascii').strip()
+        binary = text.startswith(BINARY_REQUEST_PREFIX)
+        try:
+            stages = parse_trigger_stages(text[len(BINARY_REQUEST_PREFIX):] if binary else text)
+        except ValueError:
+            logging.warning(f'Loopback serial received an invalid trigger stages string: {data!r}')
+            return len(data)
+        self._put(b'RECIEVED\r\n')
+        if self._trigger_thread is None:
+            self._binary = binary
+            self._trigger_thread = threading.Thread(target=self._run_triggers, args=(stages,), daemon=True)
+            self._trigger_thread.start()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    # Reading (Arduino -> host)
+    @property
+    def in_waiting(self) -> int:
+        return len(self._rx)
+
+    def inWaiting(self) -> int:
+        return self.in_waiting
+
+    def read(self, size: int = 1) -> bytes:
+        with self._condition:
+            self._condition.wait_for(lambda: len(self._rx) >= size or not self.is_open, self.timeout)
+            data = bytes(self._rx[:size])
+            del self._rx[:size]
+            return data
+
+    def readline(self) -> bytes:
+        with self._condition:
+            self._condition.wait_for(lambda: b'\n' in self._rx or not self.is_open, self.timeout)
+            end = self._rx.find(b'\n') + 1 or len(self._rx)
+            data = bytes(self._rx[:end])
+            del self._rx[:end]
+            return data
+
+    def reset_input_buffer(self):
+        with self._condition:
+            self._rx.clear()
+
+    def close(self):
+        if self.is_open and self.missed_pulses:
+            logging.warning(f'Loopback serial missed {self.missed_pulses} trigger pulses while it was stalled.')
+        self.is_open = False
+        self._closed.set()
+        with self._condition:
+            self._condition.notify_all()
+
+    # Simulated Arduino
+    def _put(self, data: bytes):
+        with self._condition:
+            self._rx += data
+            self._condition.notify_all()
+
+    def _run_triggers(self, stages):
+        """Send triggers following the stage schedule, keeping to the schedule rather than accumulating sleep error.
+        Pulses more than half a period late because the thread was stalled are skipped, like the Arduino misses them,
+        rather than fired in a burst to catch up."""
+        count = 0
+        t_next = perf_counter()
+        for stage_index, stage in enumerate(stages, start=1):
+            t_stage_end = t_next + stage.duration_ms / 1000 if stage.duration_ms is not None else float('inf')
+            if stage.period_ms <= 0:
+                if self._closed.wait(max(0.0, t_stage_end - perf_counter())) or stage.duration_ms is None:
+                    return
+                t_next = t_stage_end
+                continue
+            while t_next < t_stage_end:
+                delay = t_next - perf_counter()
+                if delay > 0 and self._closed.wait(delay):
+                    return
+                if self._closed.is_set():
+                    return
+                period_s = stage.period_ms / 1000
+                missed = int((perf_counter() - t_next) / period_s + 0.5)  # pulses more than half a period late
+                if missed > 0:
+                    self.missed_pulses += missed
+                    logging.info(f'Loopback serial stalled, {missed} trigger pulses of stage {stage_index} missed.')
+                    t_next += missed * period_s
+                    continue  # wait for the next pulse of the schedule
+                count += 1
+                if self.trigger_line is not None:
+                    self.trigger_line.pulse()
+                micros = int((perf_counter() - self._t0) * 1e6) & 0xFFFFFFFF  # Arduino micros() wraps at 2^32
+                self._put(encode_trigger_event(stage_index, count, micros, self._binary))
+                t_next += period_s
+            t_next = t_stage_end
+
+
+# ======================================================================================================================
+# Backend selection
+
+class NeoapiCameraBackend:
+    """Connects to Baumer cameras through neoapi."""
+    name = 'neoapi'
+
+    def connect(self, src: str):
+        import neoapi
+        from device_registry import registry
+        camera = neoapi.Cam()
+        camera.Connect(registry.resolve_camera_source(src))  # connect by serial number, no enumeration needed
+        return camera
+
+    def enable_hardware_trigger(self, camera):
+        import neoapi
+        camera.f.TriggerMode = neoapi.TriggerMode_On
+        camera.f.TriggerSource = neoapi.TriggerSource_Line2
+        camera.f.TriggerActivation = neoapi.TriggerActivation_FallingEdge
+
+
+class SimulatedCameraBackend:
+    """Creates SimulatedCam objects. Cameras are triggered by the shared trigger line when the loopback trigger
+    backend is used, otherwise they free run at the configured FPS."""
+    name = 'simulated'
+
+    def __init__(self, settings: Dict[str, Any], trigger_line: Optional[SimulatedTriggerLine] = None):
+        self.settings = {**SIMULATED_DEFAULTS, **settings}
+        self.trigger_line = trigger_line
+        self.cameras_created = 0
+        self._lock = threading.Lock()  # cameras are connected concurrently
+
+    def connect(self, src: str) -> SimulatedCam:
+        with self._lock:
+            seed = self.cameras_created
+            self.cameras_created += 1
+        camera = SimulatedCam(width=int(self.settings["Simulated Width"]),
+                              height=int(self.settings["Simulated Height"]),
+                              fps=float(self.settings["Simulated FPS"]),
+                              jitter_ms=float(self.settings["Simulated Jitter (ms)"]),
+                              drop_rate=float(self.settings["Simulated Drop Rate"]),
+                              clock_drift_ppm=float(self.settings["Simulated Clock Drift (ppm)"]),
+                              trigger_line=self.trigger_line,
+                              seed=seed)
+        logging.info(f'Connected simulated camera for source {src!r}.')
+        return camera.Connect(src)
+
+    def enable_hardware_trigger(self, camera: SimulatedCam):
+        camera.f.TriggerMode = 'On' if camera.trigger_line is not None else 'Off'
+        camera.f.TriggerSource = 'Line2'
+        camera.f.TriggerActivation = 'FallingEdge'
+
+
+def check_backend_settings(backend_settings: Dict[str, Any]):
+    """Check the "Backend" config section before anything is created, raising ValueError if it is invalid."""
+    camera_backend_name = backend_settings.get("Camera", "neoapi")
+    trigger_backend_name = backend_settings.get("Trigger", "serial")
+    if camera_backend_name not in CAMERA_BACKENDS:
+        raise ValueError(f'Unknown camera backend: {camera_backend_name!r}, use one of {", ".join(CAMERA_BACKENDS)}')
+    if trigger_backend_name not in TRIGGER_BACKENDS:
+        raise ValueError(f'Unknown trigger backend: {trigger_backend_name!r}, use one of {", ".join(TRIGGER_BACKENDS)}')
+    if camera_backend_name == "replay" and not os.path.isdir(str(backend_settings.get("Replay Folder", ""))):
+        raise ValueError(f'Replay Folder {backend_settings.get("Replay Folder", "")!r} is not a folder')
+
+
+def make_backends(backend_settings: Dict[str, Any]):
+    """Create the camera backend and a function for opening the trigger serial port from the "Backend" config
+    section. The returned open_trigger_port function has the same signature as serial.Serial."""
+    camera_backend_name = backend_settings.get("Camera", "neoapi")
+    trigger_backend_name = backend_settings.get("Trigger", "serial")
+    trigger_line = SimulatedTriggerLine() if trigger_backend_name == "loopback" else None
+
+    if camera_backend_name == "neoapi":
+        camera_backend = NeoapiCameraBackend()
+    elif camera_backend_name == "simulated":
+        camera_backend = SimulatedCameraBackend(backend_settings, trigger_line)
+    elif camera_backend_name == "replay":
+        from replay import ReplayCameraBackend
+        camera_backend = ReplayCameraBackend(backend_settings)
+    else:
+        raise ValueError(f'Unknown camera backend: {camera_backend_name!r}')
+
+    if trigger_backend_name == "serial":
+        import serial
+        open_trigger_port = serial.Serial
+    elif trigger_backend_name == "loopback":
+        def open_trigger_port(port, baudrate, timeout=None):
+            return LoopbackSerial(port, baudrate, timeout, trigger_line=trigger_line)
+    else:
+        raise ValueError(f'Unknown trigger backend: {trigger_backend_name!r}')
+
+    logging.info(f'Using camera backend {camera_backend_name!r} and trigger backend {trigger_backend_name!r}.')
+    return camera_backend, open_trigger_port
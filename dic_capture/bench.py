@@ -0,0 +1,108 @@
+"""This module measures the acquisition throughput of the capture pipeline against the number of cameras. For 1 to N
+simulated cameras free running as fast as they can, it runs the same CameraPipeline objects as run() (grab, frame ring
+and save threads, the preview is off) for a fixed time and reports the aggregate frame rate and the scaling efficiency,
+i.e. the aggregate rate divided by N times the single camera rate. With enough cores (and the cameras pinned to
+separate cores with --affinity) the efficiency should stay close to 1 up to at least four cameras.
+
+Usage:
+    python bench.py --cameras 4 --seconds 5 --width 2448 --height 2048 [--record tiff] [--affinity]
+"""
+
+# ======================================================================================================================
+# Imports
+
+import argparse
+import logging
+import os
+import tempfile
+import threading
+from time import perf_counter, sleep
+from typing import Dict, List, Optional
+
+from backends import SimulatedCameraBackend
+from camera_pipeline import CameraConfig, PipelineSettings, create_pipelines, stop_pipelines
+from writer_pool import WriterPool
+
+
+# ======================================================================================================================
+# Functions
+
+def frames_saved(pipeline) -> int:
+    """Frames a pipeline has written to disk, or released from its ring if it does not record."""
+    return pipeline.frames_written if pipeline.record_mode else pipeline.frame_ring.tail
+
+
+def bench_cameras(n_cameras: int, seconds: float, width: int, height: int, fps: float = 10000,
+                  record_format: Optional[str] = None, writer_processes: int = 0, affinity: bool = False,
+                  ring_buffer_frames: int = 64) -> Dict[str, float]:
+    """Run n_cameras free running simulated cameras for a number of seconds and return their throughput. Frames are
+    written in record_format to a temporary folder, or only copied into the rings and released if it is None."""
+    backend = SimulatedCameraBackend({"Simulated Width": width, "Simulated Height": height, "Simulated FPS": fps,
+                                      "Simulated Jitter (ms)": 0})
+    cores = os.cpu_count() or 1
+    with tempfile.TemporaryDirectory() as test_dir:
+        cameras = [CameraConfig(name=str(k + 1), source=f'SIM{k + 1}', exposure_time_ms=0.1,
+                                save_dir=os.path.join(test_dir, f'Camera_{k + 1}'),
+                                cpu_affinity=(k % cores,) if affinity else None) for k in range(n_cameras)]
+        for camera in cameras:
+            os.makedirs(camera.save_dir)
+        settings = PipelineSettings(record_mode=record_format is not None, test_id='BENCH', test_dir=test_dir,
+                                    raw_data_dir=test_dir, record_format=record_format or 'tiff',
+                                    ring_buffer_frames=ring_buffer_frames, ring_overrun_policy='drop_newest',
+                                    preview_max_fps=0)
+        stop_event = threading.Event()
+        writer_pool = WriterPool(writer_processes) if record_format and writer_processes > 0 else None
+        pipelines = create_pipelines(cameras, settings, backend, stop_event, writer_pool)
+        for pipeline in pipelines:
+            pipeline.start_vStream()
+        sleep(0.5)  # let the cameras start up before counting
+        grabbed_0 = [pipeline.frame_ring.head for pipeline in pipelines]
+        saved_0 = [frames_saved(pipeline) for pipeline in pipelines]
+        dropped_0 = [pipeline.frame_ring.dropped for pipeline in pipelines]
+        t0 = perf_counter()
+        sleep(seconds)
+        elapsed = perf_counter() - t0
+        grabbed = sum(pipeline.frame_ring.head for pipeline in pipelines) - sum(grabbed_0)
+        saved = sum(frames_saved(pipeline) for pipeline in pipelines) - sum(saved_0)
+        dropped = sum(pipeline.frame_ring.dropped for pipeline in pipelines) - sum(dropped_0)
+        stop_pipelines(pipelines, stop_event)
+        if writer_pool is not None:
+            writer_pool.close()
+        for pipeline in pipelines:
+            pipeline.close()
+    frame_mb = width * height * 2 / 1e6
+    return {'cameras': n_cameras, 'grabbed_fps': grabbed / elapsed, 'saved_fps': saved / elapsed,
+            'mb_per_s': saved * frame_mb / elapsed, 'ring_drops': dropped}
+
+
+def bench_scaling(max_cameras: int, **kwargs) -> List[Dict[str, float]]:
+    """Run bench_cameras for 1 to max_cameras cameras and add the scaling efficiency to the results."""
+    results = []
+    for n_cameras in range(1, max_cameras + 1):
+        result = bench_cameras(n_cameras, **kwargs)
+        single = results[0]['saved_fps'] if results else result['saved_fps']
+        result['efficiency'] = result['saved_fps'] / (n_cameras * single) if single else 0.0
+        results.append(result)
+        print(f"{n_cameras} camera(s): {result['grabbed_fps']:8.1f} grabbed/s, {result['saved_fps']:8.1f} saved/s, "
+              f"{result['mb_per_s']:8.1f} MB/s, {result['ring_drops']} ring drops, "
+              f"scaling efficiency {result['efficiency']:.2f}")
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure capture throughput against the number of cameras.')
+    parser.add_argument('--cameras', type=int, default=4, help='largest number of cameras to run (default 4)')
+    parser.add_argument('--seconds', type=float, default=5.0, help='measuring time per run (default 5 s)')
+    parser.add_argument('--width', type=int, default=2448)
+    parser.add_argument('--height', type=int, default=2048)
+    parser.add_argument('--fps', type=float, default=10000, help='free running rate of each camera (default: as fast '
+                                                                 'as possible)')
+    parser.add_argument('--record', choices=['tiff', 'bigtiff', 'packed12'], default=None,
+                        help='write the frames in this format (default: grab only)')
+    parser.add_argument('--writer-processes', type=int, default=0)
+    parser.add_argument('--affinity', action='store_true', help='pin each camera to its own CPU core')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    print(f'{os.cpu_count()} CPU cores')
+    bench_scaling(args.cameras, seconds=args.seconds, width=args.width, height=args.height, fps=args.fps,
+                  record_format=args.record, writer_processes=args.writer_processes, affinity=args.affinity)
@@ -0,0 +1,599 @@
+"""This module contains the per-camera acquisition pipeline used by the run function. A CameraPipeline owns one
+camera and its threads: grab (SDK buffer -> frame ring), save (frame ring -> frame writer, camera log and frame index)
+and preview (newest frame -> live view). run() builds one pipeline per "Camera N" section of the config, so the number
+of cameras is only limited by the host.
+
+The grab and save threads of a camera can be pinned to a set of CPU cores with the "CPU Affinity" camera setting, which
+keeps cameras from competing for the same cores at high frame rates. Throughput against the number of cameras is
+measured with bench.py.
+
+OpenCV and the preview renderer are only imported when the live view is on, so headless runs start faster."""
+
+# ======================================================================================================================
+# Imports
+
+import logging
+import os
+import re
+import sys
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+from time import perf_counter_ns, sleep, time
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from frame_buffer import FrameRing
+from frame_index import FrameIndexBuilder
+from compression import AdaptiveCompression
+from events import EventCapture, IntensityTrigger
+from health import CameraHealth
+from instrumentation import STAGES, Instrumentation
+from metadata import MetadataWriter
+from packed12 import packed_shape, unpack12
+from rawcapture import RawCaptureFile
+from roi import Roi, align_roi, apply_camera_roi, parse_roi, roi_from_corners
+from writers import FrameWriterSpec, make_frame_writer
+
+# ======================================================================================================================
+# Global variables
+
+WINDOW_SPACING_PX = 839  # horizontal distance between the preview windows of neighbouring cameras
+
+# Exposure key bindings, cv2.waitKeyEx code: (camera position, exposure change sign)
+EXPOSURE_KEYS = {
+    2555904: (0, +1), 2424832: (0, -1),  # RIGHT / LEFT arrow: camera 1
+    2490368: (1, +1), 2621440: (1, -1),  # UP / DOWN arrow: camera 2
+    2162688: (2, +1), 2228224: (2, -1),  # PAGE UP / PAGE DOWN: camera 3
+    2359296: (3, +1), 2293760: (3, -1),  # HOME / END: camera 4
+}
+
+
+# ======================================================================================================================
+# Classes
+
+class CameraConfig(NamedTuple):
+    """Settings of one camera, from a "Camera N" section of the config."""
+    name: str  # "1", "2", ... used for window titles, file names and the Camera_N folder
+    source: str
+    exposure_time_ms: float
+    save_dir: str
+    cpu_affinity: Optional[Tuple[int, ...]] = None
+    roi: Optional[Roi] = None  # record ROI, see roi.py
+    x_pos: int = 0
+    y_pos: int = 0
+
+
+class PipelineSettings(NamedTuple):
+    """Settings shared by all camera pipelines of a run."""
+    record_mode: bool
+    test_id: str
+    test_dir: str
+    raw_data_dir: str
+    camera_pixel_format: str = 'Mono12'
+    record_format: str = 'tiff'
+    container_max_file_gb: float = 4.0
+    ring_buffer_frames: int = 64
+    ring_overrun_policy: str = 'drop_newest'
+    raw_capacity: Optional[int] = None  # frames preallocated per camera by the raw format
+    metadata_flush_interval_s: float = 1.0
+    grab_timeout_ms: int = 4000
+    preview_max_fps: float = 60.0  # 0 disables the preview thread
+    preview_window_low: int = 0
+    preview_window_high: int = 4095
+    preview_metrics: bool = True
+    compression: str = 'none'  # codec of the "tiff" format, see compression.py
+    compression_level: int = 0
+    compression_threads: int = 1
+    compression_adaptive: bool = False
+    disk_mb_per_s: Optional[float] = None  # measured by the pre-flight probe, for the adaptive compression
+    roi_mode: str = 'auto'  # "auto" sets the record ROI on the camera if it can, "software" always crops
+    event_capture: Optional[EventCapture] = None  # only write the frames around events, see events.py
+
+
+class CameraPipeline:
+    """Grab, buffer, save and preview pipeline of one camera."""
+
+    def __init__(self, camera_config: CameraConfig, settings: PipelineSettings, camera_backend,
+                 stop_event: threading.Event, writer_pool=None, instrumentation: Optional[Instrumentation] = None):
+        self.config = camera_config
+        self.settings = settings
+        self.stop_event = stop_event
+        self.writer_pool = writer_pool
+        self.record_mode = settings.record_mode
+        self.timeOut_ms = settings.grab_timeout_ms
+        self.windowName = camera_config.name
+        self.zoomWindowName = self.windowName + ' Zoomed'
+        self.xPos = camera_config.x_pos
+        self.yPos = camera_config.y_pos
+        self.src = camera_config.source
+        self.camera = camera_backend.connect(self.src)
+        self.cam_save_dir = camera_config.save_dir
+        self.float_exposure_time = float(camera_config.exposure_time_ms) * 1000
+        self.camera.SetImageBufferCount(20)
+        self.camera.SetImageBufferCycleCount(10)
+        self.camera.f.PixelFormat.SetString(settings.camera_pixel_format)
+        self.camera.f.ExposureTime.Set(self.float_exposure_time)
+        self.camera.f.Gain.Set(1)
+        camera_backend.enable_hardware_trigger(self.camera)
+        self.frame_packed = settings.camera_pixel_format == 'Mono12p'  # ring slots hold the packed Mono12p payload
+        self.roi: Optional[Roi] = None  # record ROI in sensor pixels
+        self.crop = None  # index of the ROI in the frames from the camera, if it is cropped by the grab thread
+        if camera_config.roi is not None:
+            if settings.roi_mode == 'auto':
+                self.roi = apply_camera_roi(self.camera, camera_config.roi)
+            if self.roi is None:
+                step = 2 if self.frame_packed else 1  # packed frames are cropped at whole 3 byte pixel pairs
+                sensor_shape = (int(self.camera.f.Height.Get()), int(self.camera.f.Width.Get()))
+                self.roi = align_roi(camera_config.roi, sensor_shape, x_inc=step, width_inc=step)
+                self.crop = self.roi.slices(self.frame_packed)
+            logging.info(f'Camera {self.windowName} records the ROI {self.roi.text()} '
+                         f'({"cropped in software" if self.crop else "set on the camera"}).')
+        self.frame_shape = (self.roi.shape if self.crop is not None
+                            else (int(self.camera.f.Height.Get()), int(self.camera.f.Width.Get())))
+        self.ring_shape = packed_shape(self.frame_shape) if self.frame_packed else self.frame_shape
+        self.ring_dtype = np.uint8 if self.frame_packed else np.uint16
+        self.frame_writer_spec = FrameWriterSpec(settings.record_format, self.cam_save_dir, settings.test_id,
+                                                 self.windowName, settings.container_max_file_gb,
+                                                 settings.compression, settings.compression_level,
+                                                 settings.compression_threads,
+                                                 tuple(self.roi) if self.roi is not None else None)
+        self.raw_file = None
+        if self.record_mode and settings.record_format == 'raw':  # the ring lives in the memory-mapped capture file
+            self.raw_file = RawCaptureFile.create(os.path.join(self.cam_save_dir,
+                                                               f'{settings.test_id}_CAM_{self.windowName}.raw'),
+                                                  settings.raw_capacity, self.ring_shape, self.ring_dtype,
+                                                  test_id=settings.test_id, camera=self.windowName,
+                                                  packed=self.frame_packed, roi=self.frame_writer_spec.roi)
+            self.frame_ring = self.raw_file.ring
+            self.frame_writer = None
+        elif writer_pool is not None:  # the ring lives in shared memory and frames are written by the pool
+            self.frame_ring = writer_pool.add_camera(self.windowName, settings.ring_buffer_frames, self.ring_shape,
+                                                     self.frame_writer_spec, self.frame_written,
+                                                     dtype=self.ring_dtype, overrun_policy=settings.ring_overrun_policy)
+            self.frame_writer = None
+        else:
+            self.frame_ring = FrameRing(settings.ring_buffer_frames, self.ring_shape, self.ring_dtype,
+                                        overrun_policy=settings.ring_overrun_policy)
+            self.frame_writer = make_frame_writer(self.frame_writer_spec) if self.record_mode else None
+        instrumentation = instrumentation or Instrumentation()
+        self.timing = {stage: instrumentation.stage(self.windowName, stage) for stage in STAGES}
+        self.health = CameraHealth(self.windowName, self.frame_ring, keeps_frames=self.raw_file is not None)
+        self.frames_written = 0
+        self.bytes_written = 0
+        self.compression = None
+        if (self.record_mode and settings.compression_adaptive and settings.record_format == 'tiff'
+                and settings.compression != 'none'):
+            self.compression = AdaptiveCompression(settings.compression, settings.compression_level,
+                                                   self.frame_ring.capacity, settings.disk_mb_per_s,
+                                                   camera=self.windowName)
+        self.thread_update = Thread(target=self.update, args=(), daemon=True,
+                                    name=f'Camera {self.windowName} grab')
+        self.events = settings.event_capture if self.record_mode else None
+        self.intensity = None
+        if self.events is not None and self.events.intensity_change > 0:
+            self.intensity = IntensityTrigger(self.events, self.windowName, self.frame_shape, self.frame_packed)
+        self.host_offset_ns = 0  # host time minus camera time of the last frame, to place frames in event windows
+        self.thread_save_array = Thread(target=self.save_events if self.events is not None else self.save_array,
+                                        args=(), daemon=True, name=f'Camera {self.windowName} save')
+        self.clicked = 0
+        self.scale = 0.5
+        self.show_ready = False
+        self.preview = None
+        self.preview_frame = None
+        self.thread_preview = None
+        if settings.preview_max_fps > 0:
+            from preview import PreviewRenderer
+            self.preview_frame = np.empty(self.frame_shape, dtype=np.uint16)  # preview copy, see preview_frames
+            self.preview = PreviewRenderer(self.frame_shape, round(1 / self.scale), settings.preview_window_low,
+                                           settings.preview_window_high, settings.preview_metrics)
+            self.thread_preview = Thread(target=self.preview_frames, args=(), daemon=True,
+                                         name=f'Camera {self.windowName} preview')
+        self.cam_t0 = 0
+        self.cam_log = None
+        self.frame_index = None
+        if self.record_mode:
+            self.cam_log = MetadataWriter(os.path.join(settings.raw_data_dir,
+                                                       f'{settings.test_id}_CAM_{self.windowName}.txt'),
+                                          settings.metadata_flush_interval_s)
+            self.frame_index = FrameIndexBuilder(self.windowName, os.path.relpath(self.cam_save_dir, settings.test_dir),
+                                                 roi=self.frame_writer_spec.roi)
+
+    def inc_exposure_ms(self, inc_ms):
+        self.inc_ms = inc_ms
+        self.float_exposure_time = self.float_exposure_time + inc_ms*1000
+        self.camera.f.ExposureTime.Set(self.float_exposure_time)
+        print("Cam"+self.windowName+' changed exposure time to: ', str(self.float_exposure_time/1000)+'ms')
+
+    def click_event(self, event, x, y, flags, params):
+        import cv2
+        logging.info('Click event detected.')
+        self.event = event
+        self.flags = flags
+        self.params = params
+        if self.event == cv2.EVENT_LBUTTONDOWN:
+            self.x_0 = x
+            self.y_0 = y
+            self.x_0_scaled = round(self.x_0 / self.scale)
+            self.y_0_scaled = round(self.y_0 / self.scale)
+
+        if self.event == cv2.EVENT_LBUTTONUP:
+            self.x_1 = x
+            self.y_1 = y
+            self.x_1_scaled = round(self.x_1 / self.scale)
+            self.y_1_scaled = round(self.y_1 / self.scale)
+            self.clicked = self.clicked + 1
+
+    def zoom_roi(self) -> Optional[Roi]:
+        """The zoom rectangle dragged on the live view, in sensor pixels, or None."""
+        if self.clicked == 0:
+            return None
+        roi = roi_from_corners(self.x_0_scaled, self.y_0_scaled, self.x_1_scaled, self.y_1_scaled)
+        if roi.width == 0 or roi.height == 0:
+            return None
+        if self.roi is not None:  # the live view shows the record ROI
+            roi = roi._replace(x=roi.x + self.roi.x, y=roi.y + self.roi.y)
+        return roi
+
+    def start_vStream(self):
+        logging.info(f'Starting camera {self.windowName} threads.')
+        self.thread_update.start()
+        self.thread_save_array.start()
+        if self.thread_preview is not None:
+            self.thread_preview.start()
+
+    def update(self):
+        """Grab images and copy them out of the SDK buffers into the frame ring."""
+        pin_current_thread(self.config.cpu_affinity)
+        time_grab, time_copy = self.timing['grab'], self.timing['copy-out']
+        while not self.stop_event.is_set():
+            try:
+                t_grab = perf_counter_ns()
+                self.img = self.camera.GetImage(self.timeOut_ms)
+                t_copy = perf_counter_ns()
+                if self.img.IsEmpty():
+                    self.health.timed_out()
+                else:
+                    image_id = self.img.GetImageID()
+                    head = self.frame_ring.head
+                    array = self.img.GetNPArray()
+                    if self.crop is not None:
+                        array = array[self.crop]
+                    timestamp = self.img.GetTimestamp()
+                    if self.events is not None and timestamp:
+                        self.host_offset_ns = t_copy - timestamp
+                    if self.frame_ring.put(array, image_id, timestamp):
+                        time_copy.record(self.frame_ring.put_time(head) - t_copy)
+                    self.health.grabbed(image_id, t_copy - t_grab)
+                    time_grab.record(t_copy - t_grab)
+                self.img = None  # release the SDK buffer so the camera can reuse it
+            except Exception as e:
+                self.img = None
+                self.health.grab_error(e)
+
+    def save_buffer_remainder(self, timeout_s=5.0):
+        """Wait until the save thread has been handed every frame in the ring."""
+        t_stop = time() + timeout_s
+        while not self.frame_ring.caught_up() and time() < t_stop:
+            sleep(0.01)
+
+    def stop_vStream(self, timeout_s=5.0):
+        """Save the frames left in the ring, then wait for the grab, save and preview threads to finish."""
+        self.save_buffer_remainder(timeout_s)
+        self.stop_event.set()
+        self.join(timeout_s)
+
+    def join(self, timeout_s=5.0):
+        """Wait for the threads of the pipeline to finish once stop_event is set."""
+        self.thread_update.join(timeout_s)
+        self.thread_save_array.join(timeout_s)
+        if self.thread_preview is not None:
+            self.thread_preview.join(timeout_s)
+
+    def close(self):
+        """Close the frame writer, raw capture file and camera log after the threads have finished."""
+        if self.frame_writer is not None:
+            self.frame_writer.close()
+        if self.raw_file is not None:
+            if self.frame_ring.dropped:
+                logging.warning(f'Camera {self.windowName}: raw capture file was full, {self.frame_ring.dropped} '
+                                f'frames were not recorded.')
+            self.raw_file.close()
+        if self.cam_log is not None:
+            self.cam_log.close()
+
+    def frame_written(self, seq, frame_name, valid, write_ns=0, encode_ns=0, nbytes=0):
+        """Called by the writer pool, in frame order, once a frame has been written."""
+        image_id, timestamp = self.frame_ring.metadata(seq)
+        if frame_name is not None:
+            self.frames_written += 1
+            self.bytes_written += nbytes
+            if encode_ns:  # only formats that encode before writing have an encode stage
+                self.timing['encode'].record(encode_ns)
+            self.timing['write'].record(write_ns)
+            self.log_frame(image_id, timestamp, frame_name, valid, self.frame_ring.frame(seq))
+        elif timestamp == 0:
+            self.health.skipped(image_id)
+        else:
+            self.health.save_error()
+
+    def log_frame(self, image_id, timestamp, frame_name, valid, frame=None):
+        """Add the details of a saved frame to the camera log and the frame index."""
+        t_metadata = perf_counter_ns()
+        if (image_id == 0 or self.cam_t0 == 0):
+            self.cam_t0 = timestamp
+        self.img_TimeStamp_zerod = round((timestamp - self.cam_t0) / 1000000)
+        self.data = str(image_id) + '\t' + str(frame_name) + '\t' + str(self.img_TimeStamp_zerod) + '\n'
+        if not valid:
+            logging.error(f'Frame {image_id} on camera {self.windowName} was overwritten while it was being saved.')
+        self.cam_log.write(self.data)
+        self.frame_index.add(image_id, timestamp, frame_name, valid, frame)
+        self.timing['metadata'].record(perf_counter_ns() - t_metadata)
+
+    def save_array(self):
+        pin_current_thread(self.config.cpu_affinity)
+        if (self.record_mode == True):
+            self.heading_cam = 'Frame' + '\t' + 'Frame_Name' + '\t' + 'Cam_Time' + '\n'
+            self.cam_log.write(self.heading_cam)
+        time_handoff = self.timing['handoff wait']
+        while not (self.stop_event.is_set() and self.frame_ring.caught_up()):
+            try:
+                self.seq = None
+                if not self.frame_ring.wait(0.5):  # sleep until the grab thread publishes a frame
+                    continue
+                self.seq = self.frame_ring.get()
+                time_handoff.record(perf_counter_ns() - self.frame_ring.put_time(self.seq))
+
+                self.frame = self.frame_ring.frame(self.seq)
+
+                if (self.record_mode == True) and self.writer_pool is not None:
+                    self.writer_pool.submit(self.windowName, self.seq)  # the pool releases the frame once written
+                    continue
+
+                if self.raw_file is not None:  # already on disk, only log it (and keep the slot)
+                    self.img_ID, self.img_TimeStamp = self.frame_ring.metadata(self.seq)
+                    self.log_frame(self.img_ID, self.img_TimeStamp,
+                                   f'{os.path.basename(self.raw_file.path)}:{self.seq}',
+                                   self.frame_ring.is_valid(self.seq), self.frame)
+                    self.frames_written += 1
+                    self.bytes_written += self.frame.nbytes
+                    continue
+
+                if (self.record_mode == True):  # saves the image and adds image details to the camera log
+                    self.write_frame(self.seq)
+                self.frame_ring.release(self.seq)
+            except Exception as e:
+                logging.error(f'Error saving array on camera {self.windowName}: {e}')
+                self.health.save_error()
+                if self.seq is not None and self.raw_file is None:
+                    self.frame_ring.release(self.seq)
+
+    def write_frame(self, seq):
+        """Write frame seq with the frame writer and add it to the camera log (the caller releases it)."""
+        self.frame = self.frame_ring.frame(seq)
+        self.img_ID, self.img_TimeStamp = self.frame_ring.metadata(seq)
+        if self.img_TimeStamp == 0:
+            self.health.skipped(self.img_ID)
+            return
+        t_write = perf_counter_ns()
+        self.img_title = self.frame_writer.write(self.frame, self.img_ID, self.img_TimeStamp)
+        encode_ns = self.frame_writer.last_encode_ns
+        if encode_ns:
+            self.timing['encode'].record(encode_ns)
+        self.timing['write'].record(perf_counter_ns() - t_write - encode_ns)
+        self.frames_written += 1
+        self.bytes_written += self.frame_writer.last_nbytes
+        self.log_frame(self.img_ID, self.img_TimeStamp, self.img_title, self.frame_ring.is_valid(seq), self.frame)
+
+    def save_events(self):
+        """Save thread of event capture (see events.py): keep the frames of the last pre-event seconds in the ring,
+        watch them for an intensity change, and write the frames in the window of each event."""
+        pin_current_thread(self.config.cpu_affinity)
+        self.cam_log.write('Frame' + '\t' + 'Frame_Name' + '\t' + 'Cam_Time' + '\n')
+        written = self.events.frames_written.setdefault(self.windowName, [])
+        held = deque()  # frames taken from the ring and not released yet, oldest first
+        event = 0  # index of the next event to write
+        window = None  # (start, end) host times of the frames to write for event
+        while not (self.stop_event.is_set() and self.frame_ring.caught_up()):
+            try:
+                self.seq = None
+                self.frame_ring.wait(0.05)
+                seq = self.frame_ring.get()
+                while seq is not None:
+                    held.append(seq)
+                    if self.intensity is not None and window is None:
+                        self.intensity.update(self.frame_ring.frame(seq))
+                    seq = self.frame_ring.get()
+                if window is None and event < len(self.events.times_ns):
+                    window = self.events.window(event)
+                    written.append(0)
+                t_history = perf_counter_ns() - self.events.pre_ns
+                while held:
+                    self.seq = held[0]
+                    t_frame = self.frame_ring.metadata(self.seq)[1] + self.host_offset_ns
+                    if window is not None and t_frame > window[1]:  # the window is complete
+                        logging.info(f'Camera {self.windowName}: wrote {written[-1]} frames of event {event + 1}.')
+                        event += 1
+                        window = None
+                        if event < len(self.events.times_ns):
+                            window = self.events.window(event)
+                            written.append(0)
+                        continue
+                    if window is not None and t_frame >= window[0]:
+                        self.write_frame(self.seq)
+                        written[-1] += 1
+                    elif window is None and t_frame >= t_history:
+                        break  # the rest of the frames are the history before a future event
+                    held.popleft()
+                    self.frame_ring.release(self.seq)
+            except Exception as e:
+                logging.error(f'Error saving array on camera {self.windowName}: {e}')
+                self.health.save_error()
+                if held and held[0] == self.seq:
+                    held.popleft()
+                    self.frame_ring.release(self.seq)
+
+    def adapt_compression(self, now=None):
+        """Let the adaptive compression reconsider the compression level (called from the main loop)."""
+        if self.compression is None:
+            return
+        level = self.compression.update(self.health.queue_depth, self.frames_written, self.bytes_written, now)
+        if level is None:
+            return
+        if self.writer_pool is not None:
+            self.writer_pool.set_compression_level(self.windowName, level)
+        elif self.frame_writer is not None:
+            self.frame_writer.compression_level = level  # read by the save thread for the next frame
+
+    def preview_frames(self):
+        """Render the newest frame in the ring for the live view, at most preview_max_fps times a second. The save
+        thread may release the slot while the preview is working on it, so the frame is first copied out of the ring
+        and dropped if the producer started to overwrite the slot before the copy was complete."""
+        rendered_seq = None
+        logged = False
+        while not self.stop_event.wait(1 / self.settings.preview_max_fps):
+            seq = self.frame_ring.latest()
+            if seq is None or seq == rendered_seq:
+                continue
+            rendered_seq = seq
+            try:
+                if self.frame_packed:
+                    frame = unpack12(self.frame_ring.frame(seq), self.frame_shape, self.preview_frame)
+                else:
+                    frame = self.preview_frame
+                    np.copyto(frame, self.frame_ring.frame(seq))
+                if not self.frame_ring.is_valid(seq):
+                    continue  # torn copy, the next frame is rendered instead
+                t_preview = perf_counter_ns()
+                status = self.health.lines()
+                if self.clicked > 0:
+                    self.preview.render(frame, (self.x_0_scaled, self.y_0_scaled, self.x_1_scaled, self.y_1_scaled),
+                                        (self.x_0, self.y_0, self.x_1, self.y_1), status, self.health.ok)
+                else:
+                    self.preview.render(frame, status=status, status_ok=self.health.ok)
+                self.show_ready = True
+                self.timing['preview'].record(perf_counter_ns() - t_preview)
+                if self.record_mode and self.preview.metrics is not None and not logged:
+                    logging.info(f'Camera {self.windowName} speckle metrics at start of record '
+                                 f'({"zoom ROI" if self.clicked > 0 else "full frame"}): {self.preview.metrics}')
+                    logged = True
+            except Exception as e:
+                logging.error(f'Preview problem on camera {self.windowName}: {e}')
+
+    def showWindow(self):
+        """Show the last rendered preview (called from the main thread, which owns the OpenCV windows)."""
+        if self.show_ready:
+            import cv2
+            self.show_ready = False
+            self.img_rotated, self.zoomed_heat, self.img_hist = self.preview.front()
+            if self.clicked > 0 and self.zoomed_heat is not None:
+                self.showHistogram()
+                cv2.imshow(self.zoomWindowName, self.zoomed_heat)
+            cv2.namedWindow(self.windowName)
+            cv2.imshow(self.windowName, self.img_rotated)
+
+    def showHistogram(self):
+        """Show the histogram of the zoom ROI, drawn by the preview thread for the last rendered frame."""
+        import cv2
+        self.hist_window_name = str(self.windowName + ' Histogram')
+        cv2.namedWindow(self.hist_window_name)
+        cv2.imshow(self.hist_window_name, self.img_hist)
+
+
+# ======================================================================================================================
+# Functions
+
+def parse_cpu_affinity(value) -> Optional[Tuple[int, ...]]:
+    """Parse a "CPU Affinity" setting ("2,3", "4-7", [2, 3] or empty) into a tuple of core numbers."""
+    if value is None or value == '' or value == []:
+        return None
+    if isinstance(value, (list, tuple)):
+        return tuple(int(core) for core in value)
+    cores = []
+    for part in str(value).replace(';', ',').split(','):
+        part = part.strip()
+        if '-' in part:
+            first, last = part.split('-')
+            cores += range(int(first), int(last) + 1)
+        elif part:
+            cores.append(int(part))
+    return tuple(cores) or None
+
+
+def pin_current_thread(cpus: Optional[Tuple[int, ...]]):
+    """Restrict the calling thread to the given CPU cores (no-op if cpus is None)."""
+    if not cpus:
+        return
+    try:
+        if sys.platform == 'win32':
+            import ctypes
+            kernel32 = ctypes.windll.kernel32
+            kernel32.SetThreadAffinityMask.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+            mask = sum(1 << cpu for cpu in cpus)
+            if not kernel32.SetThreadAffinityMask(kernel32.GetCurrentThread(), mask):
+                raise OSError(ctypes.get_last_error())
+        elif hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cpus)  # 0 is the calling thread on Linux
+        else:
+            logging.warning(f'CPU affinity is not supported on {sys.platform}.')
+            return
+        logging.info(f'Pinned {threading.current_thread().name} to CPU cores {list(cpus)}.')
+    except Exception as e:
+        logging.error(f'Could not pin {threading.current_thread().name} to CPU cores {list(cpus)}: {e}')
+
+
+def camera_configs(config: Dict[str, Any], test_dir: str) -> List[CameraConfig]:
+    """Build the camera list from the "Camera N" sections of the config, in camera number order. Sections without a
+    camera source are skipped."""
+    sections = sorted((int(match.group(1)), key) for key in config
+                      for match in [re.fullmatch(r'Camera (\d+)', key)] if match)
+    cameras = []
+    for number, key in sections:
+        section = config[key]
+        source = section.get("Camera Source", "")
+        if not source or not isinstance(source, str):
+            logging.info(f'{key} has no camera source, skipping it.')
+            continue
+        position = len(cameras)
+        cameras.append(CameraConfig(name=str(number), source=source,
+                                    exposure_time_ms=float(section["Exposure Time (ms)"]),
+                                    save_dir=os.path.join(test_dir, f'Camera_{number}'),
+                                    cpu_affinity=parse_cpu_affinity(section.get("CPU Affinity")),
+                                    roi=parse_roi(section.get("Record ROI")),
+                                    x_pos=-16 + WINDOW_SPACING_PX * position, y_pos=0))
+    return cameras
+
+
+def create_pipelines(cameras: List[CameraConfig], settings: PipelineSettings, camera_backend,
+                     stop_event: threading.Event, writer_pool=None,
+                     instrumentation: Optional[Instrumentation] = None) -> List[CameraPipeline]:
+    """Connect and set up all cameras concurrently (connecting, configuring and preallocating take most of the start
+    up time) and return their pipelines in camera order. If a camera fails, the pipelines of the other cameras are
+    closed and their cameras disconnected before the error is raised."""
+    with ThreadPoolExecutor(max_workers=max(1, len(cameras)), thread_name_prefix='Camera setup') as executor:
+        futures = [executor.submit(CameraPipeline, camera, settings, camera_backend, stop_event, writer_pool,
+                                   instrumentation)
+                   for camera in cameras]
+    errors = [future.exception() for future in futures if future.exception() is not None]
+    if not errors:
+        return [future.result() for future in futures]
+    for future in futures:
+        if future.exception() is None:
+            pipeline = future.result()
+            try:
+                pipeline.close()
+                pipeline.camera.Disconnect()
+            except Exception as e:
+                logging.error(f'Error closing camera {pipeline.windowName} after a failed start up: {e}')
+    raise errors[0]
+
+
+def stop_pipelines(pipelines: List[CameraPipeline], stop_event: threading.Event, timeout_s: float = 5.0):
+    """Let every camera hand its remaining frames to its save thread, then stop and join all pipelines."""
+    for pipeline in pipelines:
+        pipeline.save_buffer_remainder(timeout_s)
+    stop_event.set()
+    for pipeline in pipelines:
+        pipeline.join(timeout_s)
@@ -0,0 +1,98 @@
+"""This module contains the headless command line entry point of DIC Capture. It runs a test from a config file saved by
+the GUI, without Tk or the OpenCV windows, for scripted batch tests and remote triggering:
+
+    python cli.py run --config my_test.json [--record | --test] [--test-id ID] [--duration 60]
+    python cli.py export --test-dir <test folder> [--crop x,y,w,h] [--8bit] [--stack N] (see exporter.py)
+
+The capture modules are only imported once the arguments have been checked, and the run itself only imports what the
+configured backend and record format need (neoapi for the Baumer cameras, tifffile for TIFF output, OpenCV for the
+live view), so a run starts in well under a second. The time to the first frame is printed and written to the run
+log."""
+
+# ======================================================================================================================
+# Imports
+
+import argparse
+import json
+import sys
+from time import perf_counter
+from typing import List, Optional
+
+# ======================================================================================================================
+# Global variables
+
+T_START = perf_counter()
+
+
+# ======================================================================================================================
+# Functions
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog='dic-capture', description='Run DIC Capture without the GUI.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run', help='run a test from a config file')
+    run_parser.add_argument('--config', required=True, help='config file (.json) saved by the GUI')
+    mode = run_parser.add_mutually_exclusive_group()
+    mode.add_argument('--record', dest='record_mode', action='store_true', default=None,
+                      help='record the test (default: "Record Mode" of the config)')
+    mode.add_argument('--test', dest='record_mode', action='store_false', help='run without recording')
+    run_parser.add_argument('--test-id', help='override the "Test ID" of the config')
+    run_parser.add_argument('--duration', type=float, default=None,
+                            help='stop after this many seconds (default: when the trigger schedule ends, or Ctrl+C)')
+    run_parser.add_argument('--show', action='store_true', help='show the live view windows')
+
+    export_parser = commands.add_parser('export', help='convert a recorded test for DIC software')
+    export_parser.add_argument('--test-dir', required=True, help='test folder (holding Raw_Data)')
+    export_parser.add_argument('--output', default='', help='output folder (default: Export in the test folder)')
+    export_parser.add_argument('--camera', action='append', help='camera to export (repeat for several, default all)')
+    export_parser.add_argument('--order', choices=['synced', 'image_id'], default='synced',
+                               help='number the frames by synced trigger (default) or by ImageID')
+    export_parser.add_argument('--crop', default=None, help='x,y,width,height')
+    export_parser.add_argument('--8bit', dest='eight_bit', action='store_true', help='convert to 8 bit')
+    export_parser.add_argument('--window', default='0,4095', help='intensities mapped to 0 and 255 by --8bit')
+    export_parser.add_argument('--stack', type=int, default=0, help='frames per multi-page stack (default: one file '
+                                                                    'per frame)')
+    export_parser.add_argument('--processes', type=int, default=None, help='worker processes (default: CPU cores)')
+    export_parser.add_argument('--restart', action='store_true', help='ignore the journal of an earlier export')
+    return parser.parse_args(argv)
+
+
+def export(args: argparse.Namespace) -> int:
+    import logging
+    from exporter import ExportSettings, export_test, parse_crop
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(message)s')
+    low, high = (int(value) for value in args.window.split(','))
+    settings = ExportSettings(output_dir=args.output, cameras=tuple(args.camera) if args.camera else None,
+                              order=args.order, crop=parse_crop(args.crop) if args.crop else None,
+                              eight_bit=args.eight_bit, window=(low, high), stack_frames=args.stack,
+                              processes=ExportSettings().processes if args.processes is None else args.processes)
+    try:
+        frames = export_test(args.test_dir, settings, restart=args.restart)
+    except KeyboardInterrupt:
+        print('Export interrupted, run the same command again to resume it.')
+        return 1
+    except ValueError as e:
+        print(f'Export failed: {e}')
+        return 1
+    print(f'Exported {frames} frames.')
+    return 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    if args.command == 'export':
+        return export(args)
+    with open(args.config) as f:
+        config = json.load(f)
+    if args.record_mode is not None:
+        config["Record Mode"] = args.record_mode
+    if args.test_id:
+        config["I/O"]["Test ID"] = args.test_id
+
+    from run import run  # the capture modules are imported once the arguments are valid
+    print(f'Capture modules loaded in {perf_counter() - T_START:.3f} s')
+    return run(config, headless=not args.show, duration_s=args.duration)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,125 @@
+"""This module contains the compression stage of the "tiff" record format. Speckle images compress well losslessly once
+a horizontal predictor has turned the pixels into differences, so writing fewer bytes per frame trades spare CPU cores
+for disk bandwidth. Each frame is written in strips that tifffile compresses on a pool of threads (zstd and zlib
+release the GIL), so the save thread of a camera uses several cores without reordering the frames.
+
+The codec and level are chosen with "Compression" and "Compression Level" in the "Pipeline" section. With "Adaptive
+Compression" the level of each camera follows its saver queue: while the queue backs up, the level is lowered if the
+save thread is compute bound and raised if the disk is the bottleneck (the written MB/s is close to what the pre-flight
+probe measured), and once the queue has drained it returns to the configured level. Level 0 writes uncompressed."""
+
+# ======================================================================================================================
+# Imports
+
+import logging
+import math
+from time import perf_counter
+from typing import Any, Dict, Optional, Tuple
+
+# ======================================================================================================================
+# Global variables
+
+CODECS = ('none', 'zstd', 'deflate')
+TIFF_CODEC = {'zstd': 'zstd', 'deflate': 'zlib'}  # tifffile compression names
+LEVELS = {'zstd': (0, 1, 2, 3, 5, 7, 9, 12), 'deflate': (0, 1, 2, 3, 4, 6, 9)}  # levels the adaptive mode steps through
+STRIPS_PER_THREAD = 4
+MIN_ROWS_PER_STRIP = 16
+
+QUEUE_HIGH = 0.25  # fraction of the ring; above it (and growing) the queue is backing up
+QUEUE_LOW = 0.05  # below it the queue has drained
+DISK_BOUND = 0.8  # written MB/s above this fraction of the probed disk bandwidth means the disk is the bottleneck
+
+
+# ======================================================================================================================
+# Classes
+
+class AdaptiveCompression:
+    """Chooses the compression level of one camera from its saver queue depth and its written MB/s.
+
+    :param codec: "zstd" or "deflate"
+    :param level: configured level, where the adaptive level returns to once the queue has drained
+    :param ring_capacity: frames the camera's ring holds
+    :param disk_mb_per_s: disk bandwidth measured by the pre-flight probe, None if unknown
+    :param interval_s: how often the level is reconsidered
+    """
+
+    def __init__(self, codec: str, level: int, ring_capacity: int, disk_mb_per_s: Optional[float] = None,
+                 interval_s: float = 1.0, camera: str = ''):
+        self.levels = LEVELS[codec]
+        self.home = min(range(len(self.levels)), key=lambda k: abs(self.levels[k] - level))
+        self.index = self.home
+        self.ring_capacity = ring_capacity
+        self.disk_mb_per_s = disk_mb_per_s
+        self.interval_s = interval_s
+        self.camera = camera
+        self.direction = -1  # step tried first when the queue backs up and the bottleneck is unknown
+        self.changes = 0
+        self._last: Optional[Tuple[float, int, int, int]] = None  # time, depth, frames, bytes
+        self._last_fps = 0.0
+
+    @property
+    def level(self) -> int:
+        return self.levels[self.index]
+
+    def update(self, queue_depth: int, frames_written: int, bytes_written: int,
+               now: Optional[float] = None) -> Optional[int]:
+        """Reconsider the level (at most every interval_s). Returns the new level if it changed, otherwise None."""
+        now = perf_counter() if now is None else now
+        if self._last is None:
+            self._last = (now, queue_depth, frames_written, bytes_written)
+            return None
+        t_last, depth_last, frames_last, bytes_last = self._last
+        elapsed = now - t_last
+        if elapsed < self.interval_s:
+            return None
+        self._last = (now, queue_depth, frames_written, bytes_written)
+        fps = (frames_written - frames_last) / elapsed
+        mb_per_s = (bytes_written - bytes_last) / elapsed / 1e6
+        fill = queue_depth / self.ring_capacity
+        step = 0
+        if fill > QUEUE_HIGH and queue_depth >= depth_last:  # backing up
+            if self.disk_mb_per_s:
+                step = +1 if mb_per_s >= DISK_BOUND * self.disk_mb_per_s else -1
+            else:  # keep the direction while it helps, otherwise reverse it
+                if self.changes and fps < self._last_fps:
+                    self.direction = -self.direction
+                step = self.direction
+        elif fill < QUEUE_LOW and self.index != self.home:
+            step = int(math.copysign(1, self.home - self.index))
+        self._last_fps = fps
+        index = min(max(self.index + step, 0), len(self.levels) - 1)
+        if index == self.index:
+            return None
+        self.index = index
+        self.changes += 1
+        logging.info(f'Camera {self.camera}: compression level {self.level} (queue {queue_depth}, {fps:.1f} fps, '
+                     f'{mb_per_s:.1f} MB/s written).')
+        return self.level
+
+
+# ======================================================================================================================
+# Functions
+
+def check_codec(codec: str) -> str:
+    """Return the codec to use: zstd needs imagecodecs, deflate falls back to zlib from the standard library."""
+    codec = str(codec).lower()
+    if codec not in CODECS:
+        logging.error(f'Unknown compression {codec!r}, writing uncompressed.')
+        return 'none'
+    if codec == 'zstd':
+        try:
+            import imagecodecs  # noqa: F401
+        except ImportError:
+            logging.error('zstd compression needs the imagecodecs package, using deflate.')
+            return 'deflate'
+    return codec
+
+
+def tiff_compression_args(codec: str, level: int, threads: int, shape: Tuple[int, ...]) -> Dict[str, Any]:
+    """Keyword arguments for tifffile.imwrite that compress a frame of shape with codec at level on threads threads
+    (none for level 0 or codec "none")."""
+    if codec == 'none' or level <= 0:
+        return {}
+    rows_per_strip = max(MIN_ROWS_PER_STRIP, math.ceil(shape[0] / (STRIPS_PER_THREAD * max(1, threads))))
+    return dict(compression=TIFF_CODEC[codec], compressionargs={'level': int(level)}, predictor=True,
+                rowsperstrip=rows_per_strip, maxworkers=max(1, threads))
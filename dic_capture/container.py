@@ -0,0 +1,274 @@
+"""This module contains the chunked recording container: instead of one .tif file per frame, all frames of a camera are
+appended to one BigTIFF file, rolling over to a new part when a part reaches its maximum size. The files are ordinary
+multi-page BigTIFFs that any TIFF reader can open. The packed 12-bit format in packed12.py uses the same rolling parts
+and frame index.
+
+When a part is closed, a frame index is appended after the end of the TIFF data (TIFF readers ignore it). The index
+holds the ImageID, camera timestamp, data offset and size of every frame, so a frame can be read straight from its
+offset without walking the TIFF pages. Trailer layout:
+    [JSON header][index records (FRAME_INDEX_DTYPE)][footer: magic | header length | frame count]
+
+The module also contains the exporter back to per-frame {test_id}_{ImageID}_{camera}.tif files for DIC software that
+needs them:
+    python container.py export <Camera_N folder> <output folder>
+"""
+
+# ======================================================================================================================
+# Imports
+
+import argparse
+import glob
+import json
+import logging
+import os
+import struct
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+# ======================================================================================================================
+# Global variables
+
+FRAME_INDEX_DTYPE = np.dtype([('image_id', '<i8'), ('timestamp', '<i8'), ('offset', '<u8'), ('nbytes', '<u8')])
+TRAILER_MAGIC = b'DICIDX01'
+TRAILER_FOOTER = struct.Struct('<8sQQ')  # magic, header length, frame count
+
+
+# ======================================================================================================================
+# Index trailer
+
+def write_index_trailer(path: str, header: Dict[str, Any], index: np.ndarray):
+    """Append the JSON header, frame index and footer to the end of a closed container file."""
+    header_bytes = json.dumps(header).encode('utf-8')
+    with open(path, 'ab') as f:
+        f.write(header_bytes)
+        f.write(np.ascontiguousarray(index, dtype=FRAME_INDEX_DTYPE).tobytes())
+        f.write(TRAILER_FOOTER.pack(TRAILER_MAGIC, len(header_bytes), len(index)))
+
+
+def read_index_trailer(path: str) -> Optional[Tuple[Dict[str, Any], np.ndarray]]:
+    """Read the header and frame index from the end of a container file, or None if the file has no trailer (e.g.
+    the recording was interrupted before the part was closed)."""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        file_size = f.tell()
+        if file_size < TRAILER_FOOTER.size:
+            return None
+        f.seek(file_size - TRAILER_FOOTER.size)
+        magic, header_length, count = TRAILER_FOOTER.unpack(f.read(TRAILER_FOOTER.size))
+        if magic != TRAILER_MAGIC:
+            return None
+        f.seek(file_size - TRAILER_FOOTER.size - count * FRAME_INDEX_DTYPE.itemsize - header_length)
+        header = json.loads(f.read(header_length).decode('utf-8'))
+        index = np.frombuffer(f.read(count * FRAME_INDEX_DTYPE.itemsize), dtype=FRAME_INDEX_DTYPE)
+    return header, index
+
+
+# ======================================================================================================================
+# Writer
+
+class RollingContainerWriter:
+    """Base class for container formats that append the frames of one camera to rolling
+    {test_id}_CAM_{camera}_{part}{extension} files and close each part with a frame index trailer. Subclasses implement
+    _open_file, _append and _close_file."""
+    format = ''
+    extension = ''
+    last_encode_ns = 0  # time spent encoding the last frame, set by subclasses that encode before writing
+    last_nbytes = 0  # bytes written for the last frame
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.max_file_bytes = int(spec.max_file_gb * 1024 ** 3)
+        self.part = -1
+        self.path = None
+        self.header = None
+        self.index = None
+        self.count = 0
+        self.end_offset = 0
+
+    def write(self, frame: np.ndarray, image_id: int, timestamp: int) -> str:
+        """Append one frame and return its frame name for the camera log ("file:position")."""
+        if self.path is None or (self.count > 0 and self.end_offset + frame.nbytes + 4096 > self.max_file_bytes):
+            self._next_part(frame)
+        offset, nbytes = self._append(frame)
+        self.end_offset = offset + nbytes
+        self.last_nbytes = nbytes
+        if self.count == len(self.index):
+            self.index = np.resize(self.index, 2 * len(self.index))
+        self.index[self.count] = (image_id, timestamp, offset, nbytes)
+        self.count += 1
+        return f'{os.path.basename(self.path)}:{self.count - 1}'
+
+    def frame_header(self, frame: np.ndarray) -> Dict[str, Any]:
+        """Shape and dtype of the frames as they are returned by ContainerReader.read()."""
+        return dict(shape=list(frame.shape), dtype=frame.dtype.str)
+
+    def _next_part(self, frame: np.ndarray):
+        self._close_part()
+        self.part += 1
+        self.path = os.path.join(self.spec.save_dir,
+                                 f'{self.spec.test_id}_CAM_{self.spec.camera}_{self.part:03d}{self.extension}')
+        self.header = dict(format=self.format, test_id=self.spec.test_id, camera=self.spec.camera, part=self.part,
+                           roi=list(self.spec.roi) if self.spec.roi else None, **self.frame_header(frame))
+        self._open_file(frame)
+        self.index = np.zeros(4096, dtype=FRAME_INDEX_DTYPE)
+        self.count = 0
+        self.end_offset = 0
+
+    def _close_part(self):
+        if self.path is not None:
+            self._close_file()
+            write_index_trailer(self.path, self.header, self.index[:self.count])
+            self.path = None
+
+    def close(self):
+        self._close_part()
+
+    def _open_file(self, frame: np.ndarray):
+        raise NotImplementedError
+
+    def _append(self, frame: np.ndarray) -> Tuple[int, int]:
+        """Write a frame to the open part and return the (offset, size) of its pixel data in the file."""
+        raise NotImplementedError
+
+    def _close_file(self):
+        raise NotImplementedError
+
+
+class BigTiffContainerWriter(RollingContainerWriter):
+    """Appends the frames of one camera to rolling multi-page BigTIFF files."""
+    format = 'bigtiff'
+    extension = '.tif'
+
+    def __init__(self, spec):
+        super().__init__(spec)
+        import tifffile
+        self.tifffile = tifffile
+        self.tiff = None
+
+    def _open_file(self, frame: np.ndarray):
+        self.tiff = self.tifffile.TiffWriter(self.path, bigtiff=True)
+
+    def _append(self, frame: np.ndarray) -> Tuple[int, int]:
+        return self.tiff.write(frame, photometric='minisblack', contiguous=True, metadata=None, returnoffset=True)
+
+    def _close_file(self):
+        self.tiff.close()
+
+
+# ======================================================================================================================
+# Reader
+
+class ContainerReader:
+    """Random access reader for one container part. Frames are read straight from their data offset."""
+
+    def __init__(self, path: str):
+        self.path = path
+        trailer = read_index_trailer(path)
+        if trailer is None:
+            logging.warning(f'{path} has no frame index, rebuilding it from the frame data (ImageIDs are unknown).')
+            trailer = self._rebuild_index(path)
+            name = os.path.splitext(os.path.basename(path))[0]  # {test_id}_CAM_{camera}_{part}
+            if '_CAM_' in name:
+                test_id, camera = name.rsplit('_', 1)[0].rsplit('_CAM_', 1)
+                trailer[0].setdefault('test_id', test_id)
+                trailer[0].setdefault('camera', camera)
+        self.header, self.index = trailer
+        self.shape = tuple(self.header['shape'])
+        self.dtype = np.dtype(self.header['dtype'])
+        self.image_ids = self.index['image_id']
+        self.timestamps = self.index['timestamp']
+        self._unpack = None
+        if self.header['format'] == 'packed12':
+            from packed12 import unpack12
+            self._unpack = unpack12
+        self._file = open(path, 'rb')
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def read(self, position: int) -> np.ndarray:
+        """Read the frame at a position in the part."""
+        record = self.index[position]
+        self._file.seek(int(record['offset']))
+        data = self._file.read(int(record['nbytes']))
+        if self._unpack is not None:
+            return self._unpack(np.frombuffer(data, dtype=np.uint8), self.shape)
+        return np.frombuffer(data, dtype=self.dtype).reshape(self.shape)
+
+    def position_of(self, image_id: int) -> Optional[int]:
+        """Return the position of a frame from its ImageID, or None if the part does not hold it. ImageIDs are
+        consecutive unless frames were dropped, so the first guess is almost always right. Otherwise the ImageIDs are
+        searched exactly, as an index rebuilt after a crash is not sorted and holds -1 for unknown ImageIDs."""
+        if len(self.index) == 0 or image_id < 0:
+            return None
+        guess = image_id - int(self.image_ids[0])
+        if 0 <= guess < len(self.index) and self.image_ids[guess] == image_id:
+            return guess
+        positions = np.flatnonzero(self.image_ids == image_id)
+        return int(positions[0]) if len(positions) else None
+
+    def frame_by_id(self, image_id: int) -> Optional[np.ndarray]:
+        """Read a frame from its ImageID, or None if the part does not hold it."""
+        position = self.position_of(image_id)
+        return None if position is None else self.read(position)
+
+    def close(self):
+        self._file.close()
+
+    @staticmethod
+    def _rebuild_index(path: str) -> Tuple[Dict[str, Any], np.ndarray]:
+        if path.endswith('.p12'):
+            from packed12 import rebuild_packed12_index
+            return rebuild_packed12_index(path)
+        import tifffile
+        with tifffile.TiffFile(path) as tiff:
+            pages = tiff.pages
+            index = np.zeros(len(pages), dtype=FRAME_INDEX_DTYPE)
+            for k, page in enumerate(pages):
+                index[k] = (-1, 0, page.dataoffsets[0], sum(page.databytecounts))
+            header = dict(format='bigtiff', shape=list(pages[0].shape), dtype=pages[0].dtype.str)
+        return header, index
+
+
+def open_recording(camera_dir: str) -> List[ContainerReader]:
+    """Open all container parts in a camera folder, in part order."""
+    paths = glob.glob(os.path.join(camera_dir, '*_CAM_*_[0-9][0-9][0-9].tif'))
+    paths += glob.glob(os.path.join(camera_dir, '*_CAM_*_[0-9][0-9][0-9].p12'))
+    return [ContainerReader(path) for path in sorted(paths)]
+
+
+# ======================================================================================================================
+# Exporter
+
+def export_to_tiffs(camera_dir: str, output_dir: str) -> int:
+    """Export every frame in the containers of a camera folder to {test_id}_{ImageID}_{camera}.tif files, the layout
+    written by the "tiff" record format. Frames of a part whose index was rebuilt have no ImageID and are numbered by
+    their frame number across all parts instead. Raises FileExistsError rather than overwrite an output. Returns the
+    number of frames exported."""
+    import tifffile
+    os.makedirs(output_dir, exist_ok=True)
+    exported = 0
+    for reader in open_recording(camera_dir):
+        test_id = reader.header.get('test_id', 'frame')
+        camera = reader.header.get('camera', '')
+        for position in range(len(reader)):
+            image_id = int(reader.image_ids[position])
+            path = os.path.join(output_dir, f'{test_id}_{image_id if image_id >= 0 else exported}_{camera}.tif')
+            if os.path.exists(path):
+                reader.close()
+                raise FileExistsError(f'{path} already exists, not overwriting it with frame {position} of '
+                                      f'{reader.path}.')
+            tifffile.imwrite(path, reader.read(position), photometric='minisblack')
+            exported += 1
+        reader.close()
+    return exported
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export recording containers to one .tif file per frame.')
+    parser.add_argument('command', choices=['export'])
+    parser.add_argument('camera_dir', help='Camera_N folder holding the container files')
+    parser.add_argument('output_dir', help='folder to write the .tif files to')
+    args = parser.parse_args()
+    print(f'Exported {export_to_tiffs(args.camera_dir, args.output_dir)} frames.')
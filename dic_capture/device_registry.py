@@ -0,0 +1,170 @@
+"""This module contains the device registry, a cache of the cameras and serial (COM) ports attached to the PC. Camera
+enumeration over USB/GigE takes seconds, so it runs once on a background thread (started as early as possible, e.g.
+before the GUI window is built) and its results are shared by the GUI and the run function. The cache is keyed by
+camera serial number and by port name, and is refreshed on demand, e.g. when the user opens a device drop-down.
+
+Camera sources in the config are the labels shown by the GUI, "<USB port ID>_SN:<serial number>", or a bare port ID,
+model name or serial number. resolve_camera_source() turns a label into the string neoapi connects to (the serial
+number, which stays the same if the camera is plugged into another port) without enumerating again."""
+
+# ======================================================================================================================
+# Imports
+
+import logging
+import threading
+from time import perf_counter
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+# ======================================================================================================================
+# Global variables
+
+SERIAL_NUMBER_TAG = '_SN:'
+
+
+# ======================================================================================================================
+# Classes
+
+class CameraInfo(NamedTuple):
+    """A camera found by enumeration."""
+    serial_number: str
+    port_id: str  # USB port ID (e.g. "P1-6"), or the IP address of GigE cameras
+    model: str = ''
+
+    @property
+    def label(self) -> str:
+        """Camera source label shown in the GUI."""
+        return f'{self.port_id}{SERIAL_NUMBER_TAG}{self.serial_number}'
+
+
+class PortInfo(NamedTuple):
+    """A serial port found by enumeration."""
+    device: str  # e.g. "COM4" or "/dev/ttyACM0"
+    description: str = ''
+    serial_number: str = ''
+
+
+class DeviceRegistry:
+    """Cached camera and serial port discovery with background refresh.
+
+    :param camera_enumerator: function returning the attached cameras
+    :param port_enumerator: function returning the available serial ports
+    """
+
+    def __init__(self, camera_enumerator: Callable[[], List[CameraInfo]] = None,
+                 port_enumerator: Callable[[], List[PortInfo]] = None):
+        self.camera_enumerator = camera_enumerator or enumerate_cameras
+        self.port_enumerator = port_enumerator or enumerate_ports
+        self.cameras: Dict[str, CameraInfo] = {}  # by serial number
+        self.ports: Dict[str, PortInfo] = {}  # by device name
+        self.refresh_count = 0
+        self.enumeration_s = 0.0
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._refreshed = threading.Event()
+
+    def start(self):
+        """Start the first enumeration in the background, unless it has already been started."""
+        with self._lock:
+            started = self._thread is not None or self.refresh_count > 0
+        if not started:
+            self.refresh()
+
+    def refresh(self, wait: bool = False, timeout_s: Optional[float] = None) -> bool:
+        """Enumerate the devices again on a background thread (if no enumeration is running already). Returns whether
+        the cache is up to date, which is only the case on return if wait is set."""
+        with self._lock:
+            if self._thread is None:
+                self._refreshed.clear()
+                self._thread = threading.Thread(target=self._enumerate, daemon=True, name='Device enumeration')
+                self._thread.start()
+        return self.wait(timeout_s) if wait else False
+
+    def wait(self, timeout_s: Optional[float] = None) -> bool:
+        """Wait for the running enumeration to finish. Returns False if it did not finish within the timeout."""
+        if self._thread is None and self.refresh_count == 0:
+            self.start()
+        return self._refreshed.wait(timeout_s)
+
+    def _enumerate(self):
+        t_start = perf_counter()
+        cameras, ports = {}, {}
+        try:
+            cameras = {camera.serial_number: camera for camera in self.camera_enumerator()}
+        except Exception as e:
+            logging.error(f'Error enumerating cameras: {e}')
+        try:
+            ports = {port.device: port for port in self.port_enumerator()}
+        except Exception as e:
+            logging.error(f'Error enumerating serial ports: {e}')
+        with self._lock:
+            self.cameras, self.ports = cameras, ports
+            self.refresh_count += 1
+            self.enumeration_s = perf_counter() - t_start
+            self._thread = None
+        self._refreshed.set()
+        logging.info(f'Found {len(cameras)} cameras and {len(ports)} serial ports in {self.enumeration_s:.2f} s.')
+
+    # Queries (answered from the cache)
+    def camera_labels(self) -> List[str]:
+        """Camera source labels, sorted by port."""
+        with self._lock:
+            return [camera.label for camera in sorted(self.cameras.values(), key=lambda camera: camera.port_id)]
+
+    def port_names(self) -> List[str]:
+        with self._lock:
+            return sorted(self.ports)
+
+    def camera_at_port(self, port_id: str) -> Optional[CameraInfo]:
+        with self._lock:
+            return next((camera for camera in self.cameras.values() if camera.port_id == port_id), None)
+
+    def resolve_camera_source(self, source: str) -> str:
+        """The string to connect to the camera of a config source with (see the module docstring)."""
+        port_id, serial_number = parse_camera_source(source)
+        if serial_number:
+            with self._lock:
+                camera = self.cameras.get(serial_number)
+            if camera is not None and port_id and camera.port_id != port_id:
+                logging.warning(f'Camera {serial_number} has moved from port {port_id} to port {camera.port_id}.')
+            elif camera is None and self.refresh_count:
+                logging.warning(f'Camera {serial_number} was not found by the last enumeration.')
+            return serial_number
+        return port_id
+
+
+# ======================================================================================================================
+# Functions
+
+def parse_camera_source(source: str) -> Tuple[str, str]:
+    """Split a camera source label into (port ID, serial number). Either may be empty."""
+    source = str(source).strip()
+    if SERIAL_NUMBER_TAG in source:
+        port_id, serial_number = source.split(SERIAL_NUMBER_TAG, 1)
+        return port_id.strip(), serial_number.strip()
+    return source, ''
+
+
+def enumerate_cameras() -> List[CameraInfo]:
+    """List the cameras neoapi can see (none if neoapi is not installed)."""
+    try:
+        import neoapi
+    except ImportError:
+        logging.info('neoapi is not installed, no cameras enumerated.')
+        return []
+    cameras = []
+    for device in neoapi.CamInfoList_Get():
+        try:
+            cameras.append(CameraInfo(device.GetSerialNumber(), device.GetUSBPortID(), device.GetModelName()))
+        except neoapi.NeoException as exc:
+            print('error: ', exc)
+    return cameras
+
+
+def enumerate_ports() -> List[PortInfo]:
+    """List the available serial ports."""
+    from serial.tools.list_ports import comports
+    return [PortInfo(str(port.device), port.description or '', port.serial_number or '') for port in comports()]
+
+
+# The registry shared by the GUI and the run function
+registry = DeviceRegistry()
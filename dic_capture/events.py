@@ -0,0 +1,190 @@
+"""This module contains event capture, a record mode for tests where only a short moment matters, e.g. the fracture of
+a specimen. Instead of writing every frame, the save thread of each camera keeps the frames of the last "Pre-event (s)"
+seconds in its frame ring (which is sized to hold them) and releases older ones. When an event fires, the frames from
+"Pre-event (s)" before it to "Post-event (s)" after it are written, and the camera goes back to keeping its history.
+Only the event windows reach the disk, so the cameras can run at frame rates far above what the disk sustains, as long
+as the frames of one window fit in memory.
+
+Events are fired by:
+- a key pressed in a live view window ("Key"), or Enter in the console of a headless run,
+- a line of the Arduino serial output containing "Serial Message",
+- a sudden change of the mean intensity of the frames ("Intensity Change", a fraction of the running mean), optionally
+  measured in "Intensity ROI" only.
+
+Events within the window of the previous event are ignored, and at most "Max Events" are captured. The events are
+written to Raw_Data/{test_id}_events.json."""
+
+# ======================================================================================================================
+# Imports
+
+import json
+import logging
+import math
+import sys
+import threading
+from time import perf_counter_ns
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from packed12 import unpack12
+from roi import Roi, parse_roi
+
+# ======================================================================================================================
+# Global variables
+
+EVENT_DEFAULTS = {
+    "Enabled": False,
+    "Pre-event (s)": 1.0,
+    "Post-event (s)": 0.5,
+    "Max Events": 1,
+    "Key": "space",
+    "Serial Message": "",
+    "Intensity Change": 0.0,  # 0 disables the intensity trigger
+    "Intensity ROI": "",
+}
+KEY_NAMES = {'space': 32, 'enter': 13, 'tab': 9}
+INTENSITY_STRIDE = 4  # the intensity is measured on every 4th pixel of every 4th row
+INTENSITY_SMOOTHING = 0.1  # weight of a new frame in the running mean
+INTENSITY_WARMUP_FRAMES = 10
+
+
+# ======================================================================================================================
+# Classes
+
+class EventCapture:
+    """The events of a run, shared by the camera pipelines. Times are host perf_counter_ns() times, like the times the
+    grab threads publish frames at."""
+
+    def __init__(self, pre_s: float = 1.0, post_s: float = 0.5, max_events: int = 1, key: str = 'space',
+                 serial_message: str = '', intensity_change: float = 0.0, intensity_roi: Optional[Roi] = None):
+        self.pre_ns = int(pre_s * 1e9)
+        self.post_ns = int(post_s * 1e9)
+        self.max_events = int(max_events)
+        self.key_code = key_code(key)
+        self.serial_message = serial_message
+        self.intensity_change = float(intensity_change)
+        self.intensity_roi = intensity_roi
+        self.times_ns: List[int] = []
+        self.sources: List[str] = []
+        self.frames_written: Dict[str, List[int]] = {}  # camera -> frames written per event
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, settings: Dict[str, Any]) -> Optional['EventCapture']:
+        """Create the event capture from the "Event Capture" config section, or None if it is not enabled."""
+        settings = {**EVENT_DEFAULTS, **settings}
+        if not settings["Enabled"]:
+            return None
+        return cls(float(settings["Pre-event (s)"]), float(settings["Post-event (s)"]), int(settings["Max Events"]),
+                   str(settings["Key"]), str(settings["Serial Message"]), float(settings["Intensity Change"]),
+                   parse_roi(settings["Intensity ROI"]))
+
+    def fire(self, source: str, t_ns: Optional[int] = None) -> bool:
+        """Fire an event at t_ns (now by default). Returns False if it was ignored."""
+        t_ns = perf_counter_ns() if t_ns is None else t_ns
+        with self._lock:
+            if len(self.times_ns) >= self.max_events:
+                return False
+            if self.times_ns and t_ns < self.times_ns[-1] + self.post_ns:
+                return False
+            self.times_ns.append(t_ns)
+            self.sources.append(source)
+            count = len(self.times_ns)
+        logging.info(f'Event {count} fired by {source}.')
+        print(f'Event {count} fired by {source}, writing the frames around it.')
+        return True
+
+    def on_serial_message(self, message: str):
+        """Fire an event if an Arduino serial line contains the serial message."""
+        if self.serial_message and self.serial_message in message:
+            self.fire(f'serial message {message!r}')
+
+    def on_key(self, key: int):
+        """Fire an event if the key pressed in a live view window is the event key."""
+        if key >= 0 and key & 0xFF == self.key_code:
+            self.fire('key press')
+
+    def window(self, index: int):
+        """The (start, end) host times of the frames written for event index."""
+        t_ns = self.times_ns[index]
+        return t_ns - self.pre_ns, t_ns + self.post_ns
+
+    def finished(self, now_ns: Optional[int] = None) -> bool:
+        """Whether the last event has been captured and its window has passed."""
+        now_ns = perf_counter_ns() if now_ns is None else now_ns
+        return len(self.times_ns) >= self.max_events and now_ns > self.times_ns[-1] + self.post_ns
+
+    def ring_frames(self, peak_fps: float, ring_buffer_frames: int) -> int:
+        """Frame ring capacity that holds the window of an event at peak_fps, with ring_buffer_frames of headroom for
+        the frames that arrive while the window is written."""
+        return max(ring_buffer_frames, math.ceil((self.pre_ns + self.post_ns) / 1e9 * peak_fps) + ring_buffer_frames)
+
+    def write(self, path: str, test_id: str, t_run_start_ns: int):
+        """Write the events to a JSON file, with their times in seconds since the start of the run."""
+        events = [{'event': k + 1, 'source': source, 'time_s': (t_ns - t_run_start_ns) / 1e9,
+                   'frames_written': {camera: counts[k] if k < len(counts) else 0
+                                      for camera, counts in self.frames_written.items()}}
+                  for k, (t_ns, source) in enumerate(zip(self.times_ns, self.sources))]
+        with open(path, 'w') as f:
+            json.dump({'test_id': test_id, 'pre_event_s': self.pre_ns / 1e9, 'post_event_s': self.post_ns / 1e9,
+                       'events': events}, f, indent=2)
+
+
+class IntensityTrigger:
+    """Fires an event when the mean intensity of a camera's frames (in roi) jumps by more than change times its
+    running mean. Frames are sampled on a grid, and packed Mono12p frames only have the sampled rows unpacked."""
+
+    def __init__(self, events: EventCapture, camera: str, frame_shape, packed: bool = False):
+        self.events = events
+        self.camera = camera
+        self.frame_shape = tuple(frame_shape)
+        self.packed = packed
+        roi = events.intensity_roi or Roi(0, 0, self.frame_shape[1], self.frame_shape[0])
+        self.rows = slice(roi.y, roi.y + roi.height, INTENSITY_STRIDE)
+        self.columns = slice(roi.x, roi.x + roi.width, INTENSITY_STRIDE)
+        self.mean: Optional[float] = None
+        self.frames = 0
+
+    def update(self, frame: np.ndarray) -> bool:
+        """Measure a frame and fire an event if its intensity jumped. Returns whether an event fired."""
+        if self.packed:
+            rows = np.ascontiguousarray(frame[self.rows])
+            sample = unpack12(rows, (rows.shape[0], self.frame_shape[1]))[:, self.columns]
+        else:
+            sample = frame[self.rows, self.columns]
+        value = float(sample.mean())
+        self.frames += 1
+        if self.mean is None:
+            self.mean = value
+            return False
+        change = abs(value - self.mean) / max(self.mean, 1.0)
+        self.mean += INTENSITY_SMOOTHING * (value - self.mean)
+        if self.frames > INTENSITY_WARMUP_FRAMES and change > self.events.intensity_change:
+            return self.events.fire(f'an intensity change of {change:.0%} on camera {self.camera}')
+        return False
+
+
+# ======================================================================================================================
+# Functions
+
+def key_code(key: str) -> int:
+    """The key code of a "Key" setting: a single character or space, enter or tab."""
+    key = str(key)
+    if key.lower() in KEY_NAMES:
+        return KEY_NAMES[key.lower()]
+    if len(key) != 1:
+        raise ValueError(f'Event key must be a single character, space, enter or tab: {key!r}')
+    return ord(key)
+
+
+def watch_console(events: EventCapture, stop_event: threading.Event):
+    """Fire an event whenever Enter is pressed in the console (for headless runs), on a daemon thread."""
+    if sys.stdin is None or not sys.stdin.isatty():
+        return
+
+    def watch():
+        while not stop_event.is_set() and sys.stdin.readline():
+            events.fire('Enter in the console')
+
+    threading.Thread(target=watch, daemon=True, name='Event console').start()
@@ -0,0 +1,250 @@
+"""This module contains the exporter that converts a recorded test into the layouts DIC software needs. Frames are found
+through the frame index (Raw_Data/{test_id}_frame_index.npz, rebuilt from the camera logs for a run that was killed or
+recorded before the index existed), so every record format (tiff, bigtiff, packed12, raw) is read the same way, and
+numbered by the synced trigger table of Synced_Data (so frame k of every camera was exposed by the same trigger) or by
+ImageID. Frames can be cropped, converted to 8 bit through an intensity window and written as one .tif per frame or as
+multi-page stacks, to Export/Camera_N in the test folder by default.
+
+The frames are streamed through a pool of processes: each output file (a frame or a stack) is a task that a worker
+reads, converts and writes by itself, and only a few tasks per worker are in flight, so memory does not grow with the
+size of the test. Outputs are written to a temporary name and renamed when complete, and the results are collected in
+output order into a journal (Export/export_journal.json). An interrupted export resumes after the last output in the
+journal when it is run again with the same settings. A CSV per camera maps every output frame to its ImageID, camera
+timestamp, trigger time and source file.
+
+    python cli.py export --test-dir <test folder> [--crop x,y,w,h] [--8bit] [--stack 100] [--processes 8]
+"""
+
+# ======================================================================================================================
+# Imports
+
+import csv
+import hashlib
+import json
+import logging
+import multiprocessing as mp
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from time import perf_counter
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from frame_index import FrameIndex, FrameReader, load_frame_index
+
+# ======================================================================================================================
+# Global variables
+
+JOURNAL_NAME = 'export_journal.json'
+TASKS_PER_PROCESS = 2  # tasks in flight per worker process
+JOURNAL_INTERVAL_S = 1.0  # how often the journal is saved
+BIGTIFF_BYTES = 2 ** 32 - 2 ** 26  # stacks larger than this are written as BigTIFF
+
+_reader = FrameReader()  # keeps the container and raw files of a worker process open
+
+
+# ======================================================================================================================
+# Classes
+
+class ExportSettings(NamedTuple):
+    """What to export and how."""
+    output_dir: str = ''  # default: Export in the test folder
+    cameras: Optional[Tuple[str, ...]] = None  # default: every camera
+    order: str = 'synced'  # "synced" (trigger order, from Synced_Data) or "image_id"
+    crop: Optional[Tuple[int, int, int, int]] = None  # x, y, width, height
+    eight_bit: bool = False
+    window: Tuple[int, int] = (0, 4095)  # intensities mapped to 0 and 255 by the 8 bit conversion
+    stack_frames: int = 0  # frames per multi-page stack, 0 writes one .tif per frame
+    processes: int = os.cpu_count() or 1  # 0 converts in the calling process
+
+    @property
+    def key(self) -> str:
+        """Hash of the settings that change the outputs, to tell if a journal belongs to this export."""
+        fields = (self.cameras, self.order, self.crop, self.eight_bit, self.window, self.stack_frames)
+        return hashlib.sha1(repr(fields).encode('utf-8')).hexdigest()[:16]
+
+
+class FrameSource(NamedTuple):
+    """Where a recorded frame is stored."""
+    path: str
+    position: int  # position in a container or raw file, -1 for .tif files
+
+
+class ExportTask(NamedTuple):
+    """One output file and the frames that go into it."""
+    output_path: str
+    sources: List[FrameSource]
+    crop: Optional[Tuple[int, int, int, int]]
+    window: Optional[Tuple[int, int]]  # None keeps 16 bit
+
+
+# ======================================================================================================================
+# Worker functions
+
+def _read_frame(source: FrameSource) -> np.ndarray:
+    return _reader.read(source.path, source.position)
+
+
+def _convert(frame: np.ndarray, crop: Optional[Tuple[int, int, int, int]],
+             window: Optional[Tuple[int, int]]) -> np.ndarray:
+    if crop is not None:
+        x, y, width, height = crop
+        frame = frame[y:y + height, x:x + width]
+    if window is not None:
+        frame = _eight_bit_lut(*window)[frame]
+    return frame
+
+
+@lru_cache(maxsize=4)
+def _eight_bit_lut(low: int, high: int) -> np.ndarray:
+    """Lookup table mapping 16 bit intensities to 8 bit, low to 0 and high to 255."""
+    lut = np.clip((np.arange(65536, dtype=np.float32) - low) * (255 / max(1, high - low)), 0, 255)
+    return np.round(lut).astype(np.uint8)
+
+
+def export_task(task: ExportTask) -> Tuple[str, int]:
+    """Write one output file (run in a worker process). Returns its path and the number of frames in it."""
+    import tifffile
+    partial_path = task.output_path + '.part'
+    frame = _convert(_read_frame(task.sources[0]), task.crop, task.window)
+    bigtiff = frame.nbytes * len(task.sources) > BIGTIFF_BYTES
+    with tifffile.TiffWriter(partial_path, bigtiff=bigtiff) as tiff:
+        tiff.write(frame, photometric='minisblack', contiguous=True, metadata=None)
+        for source in task.sources[1:]:
+            tiff.write(_convert(_read_frame(source), task.crop, task.window), photometric='minisblack',
+                       contiguous=True, metadata=None)
+    os.replace(partial_path, task.output_path)
+    return task.output_path, len(task.sources)
+
+
+# ======================================================================================================================
+# Functions
+
+def frame_table(test_dir: str, camera: str, index: FrameIndex, order: str) -> List[Dict[str, Any]]:
+    """The frames of a camera in output order, with their ImageID, timestamp, trigger time (synced order only) and
+    source. In synced order the frames are numbered by trigger, so frame k of every camera shows the same instant and
+    triggers the camera has no frame for leave a gap in the numbering."""
+    rows = []
+    if order == 'synced':
+        test_id = os.path.basename(os.path.normpath(test_dir))  # the name sync.py writes the table under
+        with np.load(os.path.join(test_dir, 'Synced_Data', f'{test_id}_synced.npz')) as synced:
+            image_ids = synced[f'cam{camera}_image_id']
+            trigger_s = synced['trigger_time_s']
+        for trigger, image_id in enumerate(image_ids):
+            record = index.frame_by_id(int(image_id), camera) if image_id >= 0 else None
+            if record is not None:
+                rows.append(dict(trigger=trigger, record=record, trigger_time_s=float(trigger_s[trigger])))
+    else:
+        records = index.camera_records(camera)
+        rows = [dict(trigger=-1, record=record, trigger_time_s=float('nan'))
+                for record in records[np.argsort(records['image_id'], kind='stable')]]
+    for number, row in enumerate(rows):
+        record = row.pop('record')
+        row.update(number=row['trigger'] if order == 'synced' else number, image_id=int(record['image_id']),
+                   timestamp_ns=int(record['timestamp_ns']),
+                   source=FrameSource(index.path_of(record), int(record['position']) if record['file'] >= 0 else -1))
+    return rows
+
+
+def plan_export(test_dir: str, settings: ExportSettings) -> List[ExportTask]:
+    """The output files of an export, in output order, and the CSV of each camera."""
+    test_id = os.path.basename(os.path.normpath(test_dir))
+    index = load_frame_index(test_dir)
+    if index is None:
+        raise ValueError(f'{test_dir} has no frame index or camera logs to export.')
+    output_dir = settings.output_dir or os.path.join(test_dir, 'Export')
+    order = settings.order
+    if order == 'synced' and not os.path.exists(os.path.join(test_dir, 'Synced_Data', f'{test_id}_synced.npz')):
+        logging.warning(f'{test_id} has no synced trigger table, exporting the frames in ImageID order.')
+        order = 'image_id'
+    window = settings.window if settings.eight_bit else None
+    tasks = []
+    for camera in settings.cameras or index.cameras:
+        camera_dir = os.path.join(output_dir, f'Camera_{camera}')
+        os.makedirs(camera_dir, exist_ok=True)
+        rows = frame_table(test_dir, str(camera), index, order)
+        with open(os.path.join(output_dir, f'{test_id}_export_{camera}.csv'), 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['frame', 'trigger', 'image_id', 'timestamp_ns', 'trigger_time_s', 'source', 'position'])
+            for row in rows:
+                writer.writerow([row['number'], row['trigger'], row['image_id'], row['timestamp_ns'],
+                                 f"{row['trigger_time_s']:.6f}", os.path.relpath(row['source'].path, test_dir),
+                                 row['source'].position])
+        if settings.stack_frames > 0:
+            for start in range(0, len(rows), settings.stack_frames):
+                chunk = rows[start:start + settings.stack_frames]
+                name = f'{test_id}_CAM_{camera}_stack_{start // settings.stack_frames:04d}.tif'
+                tasks.append(ExportTask(os.path.join(camera_dir, name), [row['source'] for row in chunk],
+                                        settings.crop, window))
+        else:
+            tasks += [ExportTask(os.path.join(camera_dir, f"{test_id}_{row['number']:06d}_{camera}.tif"),
+                                 [row['source']], settings.crop, window) for row in rows]
+    return tasks
+
+
+def _load_journal(path: str, key: str) -> int:
+    """Number of outputs already written by an earlier run of the same export."""
+    try:
+        with open(path) as f:
+            journal = json.load(f)
+    except (OSError, ValueError):
+        return 0
+    return int(journal.get('completed', 0)) if journal.get('settings') == key else 0
+
+
+def _save_journal(path: str, key: str, completed: int, total: int):
+    with open(path + '.part', 'w') as f:
+        json.dump({'settings': key, 'completed': completed, 'total': total}, f)
+    os.replace(path + '.part', path)
+
+
+def export_test(test_dir: str, settings: ExportSettings = ExportSettings(), restart: bool = False) -> int:
+    """Export a recorded test (see the module docstring). Returns the number of frames written by this call."""
+    t_start = perf_counter()
+    tasks = plan_export(test_dir, settings)
+    output_dir = settings.output_dir or os.path.join(test_dir, 'Export')
+    journal_path = os.path.join(output_dir, JOURNAL_NAME)
+    completed = 0 if restart else _load_journal(journal_path, settings.key)
+    if completed:
+        logging.info(f'Resuming the export after {completed} of {len(tasks)} outputs.')
+    frames = 0
+    t_saved = perf_counter()
+    pending = deque()
+    executor = None
+    max_pending = TASKS_PER_PROCESS * settings.processes
+    if settings.processes > 0:
+        executor = ProcessPoolExecutor(settings.processes, mp_context=mp.get_context('spawn'))
+    try:
+        next_task = completed
+        while completed < len(tasks):
+            while executor is not None and next_task < len(tasks) and len(pending) < max_pending:
+                pending.append(executor.submit(export_task, tasks[next_task]))
+                next_task += 1
+            if executor is not None:
+                _, written = pending.popleft().result()  # results are collected in output order
+            else:
+                _, written = export_task(tasks[completed])
+            completed += 1
+            frames += written
+            if perf_counter() - t_saved > JOURNAL_INTERVAL_S:
+                _save_journal(journal_path, settings.key, completed, len(tasks))
+                t_saved = perf_counter()
+    finally:
+        if executor is not None:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+        _save_journal(journal_path, settings.key, completed, len(tasks))
+    elapsed = perf_counter() - t_start
+    logging.info(f'Exported {frames} frames to {len(tasks)} files in {elapsed:.1f} s.')
+    return frames
+
+
+def parse_crop(value: str) -> Tuple[int, int, int, int]:
+    """Parse an "x,y,width,height" crop string."""
+    values = [int(v) for v in value.replace(' ', '').split(',')]
+    if len(values) != 4 or min(values) < 0 or values[2] == 0 or values[3] == 0:
+        raise ValueError(f'Crop must be x,y,width,height: {value!r}')
+    return tuple(values)
@@ -0,0 +1,176 @@
+"""This module contains the FrameRing, the fixed capacity frame buffer between a camera's grab thread and its save
+thread. All frame memory is allocated once when the ring is created. The grab thread copies each image out of the SDK
+buffer into the next free slot straight away, so the camera's own buffers are recycled quickly, and the save thread
+works on the slots without any further copies."""
+
+# ======================================================================================================================
+# Imports
+
+import threading
+from time import perf_counter_ns
+from typing import Optional, Tuple
+
+import numpy as np
+
+# ======================================================================================================================
+# Global variables
+
+OVERRUN_POLICIES = ('drop_newest', 'overwrite')
+
+
+# ======================================================================================================================
+# Classes
+
+class FrameRing:
+    """Lock-free single producer / single consumer ring of preallocated frame slots.
+
+    Frames are numbered with a sequence number (seq) in the order they are put into the ring. Three cursors follow the
+    frames through the ring:
+        head - seq of the next frame to be written by the producer
+        read - seq of the next frame to be handed to the consumer by get()
+        tail - seq of the oldest frame the consumer has not released yet
+    The producer only moves head, the consumer only moves read (in get) and tail (in release), so each cursor has a
+    single writer and no lock is needed under the GIL. The consumer sleeps in wait() until the producer publishes a
+    frame rather than polling. Each slot also stores the seq of the frame it holds (-1 while it is being written),
+    which lets the consumer check with is_valid() that a slot was not overwritten while it was working on it.
+
+    The overrun policy decides what happens when the consumer falls behind and all slots are in use:
+        drop_newest - the incoming frame is discarded and counted in `dropped` (default, never tears a frame)
+        overwrite   - the oldest unreleased frame is overwritten and counted in `overwritten`. The producer only
+                      rewrites the slot; get() skips frames that were overwritten before they were read and release()
+                      moves the tail past them.
+    """
+
+    def __init__(self, capacity: int, shape: Tuple[int, ...], dtype=np.uint16, overrun_policy: str = 'drop_newest',
+                 buffer=None, clear: bool = True):
+        if capacity < 1:
+            raise ValueError(f'Ring capacity must be at least 1, got {capacity}.')
+        if overrun_policy not in OVERRUN_POLICIES:
+            raise ValueError(f'Unknown overrun policy {overrun_policy!r}, expected one of {OVERRUN_POLICIES}.')
+        self.capacity = int(capacity)
+        self.shape = tuple(int(n) for n in shape)
+        self.dtype = np.dtype(dtype)
+        self.overrun_policy = overrun_policy
+
+        # Frame memory and per-slot metadata, optionally placed in an existing buffer (e.g. shared memory). Pass
+        # clear=False to attach to a buffer that another FrameRing is already using.
+        if buffer is None:
+            buffer = bytearray(self.nbytes(self.capacity, self.shape, self.dtype))
+        meta = np.ndarray((3, self.capacity), dtype=np.int64, buffer=buffer)
+        self.frames = np.ndarray((self.capacity, *self.shape), dtype=self.dtype, buffer=buffer, offset=meta.nbytes)
+        self.seq, self.image_ids, self.timestamps = meta
+        if clear:
+            self.seq[:] = -1
+        self.slots = [self.frames[k] for k in range(self.capacity)]  # views created once, not per frame
+        # perf_counter_ns() time each slot was published at, set before the frame is published so the consumer always
+        # sees the time of the frame it was handed (in this process only, it is not part of the shared buffer)
+        self.put_ns = np.zeros(self.capacity, dtype=np.int64)
+
+        self.head = 0
+        self.read = 0
+        self.tail = 0
+        self.dropped = 0
+        self.overwritten = 0
+        self._released = set()
+        self._frame_ready = threading.Event()
+
+    @staticmethod
+    def nbytes(capacity: int, shape: Tuple[int, ...], dtype=np.uint16) -> int:
+        """Size in bytes of the buffer needed for a ring with the given capacity and frame shape."""
+        return int(capacity) * int(np.prod(shape)) * np.dtype(dtype).itemsize + 3 * int(capacity) * 8
+
+    def __len__(self) -> int:
+        """Number of frames in the ring that have not been released by the consumer."""
+        return min(self.head - self.tail, self.capacity)
+
+    # Producer side
+    def put(self, array: np.ndarray, image_id: int, timestamp: int) -> bool:
+        """Copy a frame into the next free slot. Returns False if the frame was dropped by the overrun policy."""
+        head = self.head
+        if head - self.tail >= self.capacity:
+            if self.overrun_policy == 'drop_newest':
+                self.dropped += 1
+                return False
+            self.overwritten += 1  # the consumer skips and releases the overwritten frame
+
+        slot = head % self.capacity
+        self.seq[slot] = -1
+        if array.shape != self.shape:
+            array = array.reshape(self.shape)  # neoapi returns mono images as (height, width, 1)
+        np.copyto(self.slots[slot], array)
+        self.image_ids[slot] = image_id
+        self.timestamps[slot] = timestamp
+        self.put_ns[slot] = perf_counter_ns()
+        self.seq[slot] = head
+        self.head = head + 1  # publish the frame to the consumer
+        self._frame_ready.set()
+        return True
+
+    # Consumer side
+    def get(self) -> Optional[int]:
+        """Return the seq of the next unread frame, or None if the consumer has caught up with the producer. Frames
+        that were overwritten before they were read are skipped."""
+        seq = self.read
+        head = self.head
+        if seq < head - self.capacity:  # lapped by the producer
+            seq = head - self.capacity
+        while seq < head and self.seq[seq % self.capacity] != seq:  # overwritten, or being overwritten
+            seq += 1
+        if seq >= head:
+            self.read = seq
+            return None
+        self.read = seq + 1
+        return seq
+
+    def wait(self, timeout_s: Optional[float] = None) -> bool:
+        """Block until there is an unread frame. Returns False if none arrived within the timeout."""
+        while self.read >= self.head:
+            self._frame_ready.clear()
+            if self.read < self.head:  # a frame was published between the check and the clear
+                break
+            if not self._frame_ready.wait(timeout_s):
+                return False
+        return True
+
+    def frame(self, seq: int) -> np.ndarray:
+        """Return the slot holding frame seq. The slot stays valid until the frame is released."""
+        return self.slots[seq % self.capacity]
+
+    def metadata(self, seq: int) -> Tuple[int, int]:
+        """Return the (ImageID, timestamp) of frame seq."""
+        slot = seq % self.capacity
+        return int(self.image_ids[slot]), int(self.timestamps[slot])
+
+    def put_time(self, seq: int) -> int:
+        """Return the perf_counter_ns() time frame seq was published at."""
+        return int(self.put_ns[seq % self.capacity])
+
+    def is_valid(self, seq: int) -> bool:
+        """Check that the slot still holds frame seq, i.e. it has not been overwritten."""
+        return self.seq[seq % self.capacity] == seq
+
+    def release(self, seq: int):
+        """Hand the slot of frame seq back to the producer. Frames may be released out of order; the tail only moves
+        past a frame once every earlier frame has been released too. Frames the producer has overwritten count as
+        released."""
+        tail = self.tail
+        floor = self.head - self.capacity
+        if tail < floor:
+            tail = floor
+            self._released = {released for released in self._released if released >= tail}
+        if seq > tail:
+            self._released.add(seq)
+        elif seq == tail:
+            tail += 1
+        while tail in self._released:
+            self._released.remove(tail)
+            tail += 1
+        self.tail = tail
+
+    def latest(self) -> Optional[int]:
+        """Return the seq of the newest frame in the ring, or None if no frame has been written yet."""
+        return self.head - 1 if self.head > 0 else None
+
+    def caught_up(self) -> bool:
+        """Check whether the consumer has been handed every frame written so far."""
+        return self.read >= self.head
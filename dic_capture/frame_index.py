@@ -0,0 +1,220 @@
+"""This module contains the columnar frame index written at the end of each recorded test to
+Raw_Data/{test_id}_frame_index.npz. It holds one row per recorded frame of every camera, with the full resolution
+camera timestamp, the ImageID, where the frame is stored and a few per-frame image statistics, so post-processing does
+not have to parse the text camera logs. The .npz is uncompressed and loads in milliseconds even for long tests.
+
+The index is written when a run shuts down. A run that was killed or crashed has none, nor do tests recorded before
+the index existed, so load_frame_index() rebuilds it from the camera logs when it is missing (with the ms resolution
+timestamps of the logs and without the image statistics).
+
+Rows are sorted by camera and then by timestamp. Frames recorded in the "tiff" format have no file entry (file -1):
+their file name follows the per-frame template {test_id}_{ImageID}_{camera}.tif. The header holds the record ROI of
+each camera (x, y, width, height in sensor pixels, null for the full frame).
+
+    index = FrameIndex('Raw_Data/T1_frame_index.npz')
+    rows = index.frames_between(1.0, 2.0, camera='1')  # seconds since the camera's first frame
+    row = index.frame_by_id(1234, camera='2')
+    path = index.path_of(row)
+    frame = FrameReader().read(path, int(row['position']) if row['file'] >= 0 else -1)
+"""
+
+# ======================================================================================================================
+# Imports
+
+import glob
+import json
+import logging
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+# ======================================================================================================================
+# Global variables
+
+FRAME_RECORD_DTYPE = np.dtype([('camera', '<i2'), ('image_id', '<i8'), ('timestamp_ns', '<i8'), ('file', '<i4'),
+                               ('position', '<i8'), ('valid', '?'), ('mean', '<f4'), ('max', '<f4')])
+STATS_STRIDE = 4  # frame statistics are computed on every 4th pixel of every 4th row
+
+
+# ======================================================================================================================
+# Classes
+
+class FrameIndexBuilder:
+    """Collects the index rows of one camera while it records."""
+
+    def __init__(self, camera: str, camera_dir: str, initial_frames: int = 4096,
+                 roi: Optional[Tuple[int, int, int, int]] = None):
+        self.camera = camera
+        self.camera_dir = camera_dir  # folder of the camera's files, relative to the test folder
+        self.roi = roi  # record ROI (x, y, width, height) in sensor pixels, None for the full frame
+        self.records = np.zeros(initial_frames, dtype=FRAME_RECORD_DTYPE)
+        self.count = 0
+        self.files: List[str] = []
+        self._file_ids: Dict[str, int] = {}
+
+    def add(self, image_id: int, timestamp_ns: int, frame_name: str, valid: bool = True,
+            frame: Optional[np.ndarray] = None):
+        """Add a recorded frame. frame_name is the name in the camera log: a .tif file name, or "file:position" for
+        the container and raw formats. Statistics are only computed for unpacked (uint16) frames."""
+        if self.count == len(self.records):
+            self.records = np.resize(self.records, 2 * len(self.records))
+        file_id, position = -1, -1
+        if ':' in frame_name:
+            file_name, position = frame_name.rsplit(':', 1)
+            file_id = self._file_ids.get(file_name)
+            if file_id is None:
+                file_id = self._file_ids[file_name] = len(self.files)
+                self.files.append(file_name)
+        mean = peak = np.nan
+        if frame is not None and frame.dtype == np.uint16:
+            sample = frame[::STATS_STRIDE, ::STATS_STRIDE]
+            mean, peak = sample.mean(), sample.max()
+        record = self.records[self.count]
+        record['image_id'], record['timestamp_ns'] = image_id, timestamp_ns
+        record['file'], record['position'], record['valid'] = file_id, int(position), valid
+        record['mean'], record['max'] = mean, peak
+        self.count += 1
+
+
+class FrameIndex:
+    """Read-only view of a frame index file with a small query API."""
+
+    def __init__(self, path: str):
+        with np.load(path, allow_pickle=False) as data:
+            self.header = json.loads(str(data['header']))
+            self.records = data['records']
+            self.files = [str(name) for name in data['files']]
+        self.test_dir = os.path.dirname(os.path.dirname(os.path.abspath(path)))
+        self.cameras: List[str] = self.header['cameras']
+        # Rows of camera k are records[bounds[k]:bounds[k + 1]]
+        self.bounds = np.searchsorted(self.records['camera'], np.arange(len(self.cameras) + 1))
+        self._t0 = [int(self.records['timestamp_ns'][start]) if end > start else 0
+                    for start, end in zip(self.bounds[:-1], self.bounds[1:])]
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def camera_records(self, camera: str) -> np.ndarray:
+        """All rows of one camera."""
+        k = self.cameras.index(str(camera))
+        return self.records[self.bounds[k]:self.bounds[k + 1]]
+
+    def frames_between(self, t0_s: float, t1_s: float, camera: Optional[str] = None) -> np.ndarray:
+        """Rows with t0_s <= time < t1_s, in seconds since each camera's first frame (the zero of the camera logs)."""
+        selected = []
+        for k, name in enumerate(self.cameras):
+            if camera is not None and name != str(camera):
+                continue
+            rows = self.records[self.bounds[k]:self.bounds[k + 1]]
+            limits = self._t0[k] + np.array([t0_s, t1_s]) * 1e9
+            start, end = np.searchsorted(rows['timestamp_ns'], limits.astype(np.int64))
+            selected.append(rows[start:end])
+        return np.concatenate(selected) if selected else self.records[:0]
+
+    def frame_by_id(self, image_id: int, camera: str) -> Optional[np.void]:
+        """The row of a frame from its camera and ImageID, or None if it was not recorded."""
+        rows = self.camera_records(camera)
+        if len(rows) == 0:
+            return None
+        guess = image_id - int(rows['image_id'][0])  # ImageIDs are consecutive unless frames were dropped
+        if not (0 <= guess < len(rows) and rows['image_id'][guess] == image_id):
+            guess = int(np.searchsorted(rows['image_id'], image_id))
+        if guess < len(rows) and rows['image_id'][guess] == image_id:
+            return rows[guess]
+        return None
+
+    def path_of(self, record: np.void) -> str:
+        """Full path of the file that holds a frame (for container and raw files, read it at record['position'])."""
+        camera = self.cameras[int(record['camera'])]
+        if record['file'] >= 0:
+            file_name = self.files[int(record['file'])]
+        else:
+            file_name = f"{self.header['test_id']}_{int(record['image_id'])}_{camera}.tif"
+        return os.path.join(self.test_dir, self.header['camera_dirs'][camera], file_name)
+
+
+class FrameReader:
+    """Reads recorded frames of any record format as Mono12 (uint16) arrays. Container and raw files are opened on
+    first use and stay open for the next frames."""
+
+    def __init__(self):
+        self.files: Dict[str, Any] = {}
+
+    def read(self, path: str, position: int = -1) -> np.ndarray:
+        """Read the frame at position in a container or raw file, or the .tif file at path if position is -1."""
+        if position < 0:
+            import tifffile
+            return tifffile.imread(path)
+        reader = self.files.get(path)
+        if reader is None:
+            if path.endswith('.raw'):
+                from rawcapture import RawCaptureFile
+                reader = RawCaptureFile.open(path)
+            else:
+                from container import ContainerReader
+                reader = ContainerReader(path)
+            self.files[path] = reader
+        if not hasattr(reader, 'ring'):
+            return reader.read(position)
+        frame = reader.ring.frame(position)  # raw capture files never wrap, so the position is the slot
+        if reader.header.get('packed'):
+            from packed12 import unpack12, unpacked_shape
+            frame = unpack12(frame, unpacked_shape(tuple(reader.header['shape'])))
+        return frame
+
+    def close(self):
+        for reader in self.files.values():
+            reader.close()
+        self.files = {}
+
+
+# ======================================================================================================================
+# Functions
+
+def write_frame_index(path: str, test_id: str, builders: List[FrameIndexBuilder]):
+    """Combine the rows of every camera, sort them by camera and timestamp and save the index."""
+    records, files = [], []
+    for k, builder in enumerate(builders):
+        camera_records = builder.records[:builder.count].copy()
+        camera_records['camera'] = k
+        camera_records['file'] = np.where(camera_records['file'] >= 0, camera_records['file'] + len(files), -1)
+        files += builder.files
+        records.append(camera_records[np.argsort(camera_records['timestamp_ns'], kind='stable')])
+    header = dict(test_id=test_id, cameras=[builder.camera for builder in builders],
+                  camera_dirs={builder.camera: builder.camera_dir for builder in builders},
+                  rois={builder.camera: list(builder.roi) if builder.roi else None for builder in builders})
+    np.savez(path, header=np.array(json.dumps(header)),
+             records=np.concatenate(records) if records else np.zeros(0, dtype=FRAME_RECORD_DTYPE),
+             files=np.array(files, dtype=str))
+
+
+def rebuild_frame_index(test_dir: str) -> Optional[str]:
+    """Rebuild the frame index of a test folder from the Raw_Data camera logs. Returns the path of the index, or None
+    if the test has no camera logs."""
+    log_paths = sorted(glob.glob(os.path.join(test_dir, 'Raw_Data', '*_CAM_*.txt')))
+    if not log_paths:
+        return None
+    builders = []
+    for log_path in log_paths:
+        test_id, camera = os.path.splitext(os.path.basename(log_path))[0].rsplit('_CAM_', 1)
+        builder = FrameIndexBuilder(camera, f'Camera_{camera}')
+        with open(log_path, 'r') as f:
+            next(f, None)  # heading
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) == 3:  # a line cut short by a crash is skipped
+                    builder.add(int(fields[0]), int(round(float(fields[2]) * 1e6)), fields[1])
+        builders.append(builder)
+    path = os.path.join(test_dir, 'Raw_Data', f'{test_id}_frame_index.npz')
+    write_frame_index(path, test_id, builders)
+    logging.info(f'Rebuilt the frame index of {test_dir} from {len(log_paths)} camera logs.')
+    return path
+
+
+def load_frame_index(test_dir: str) -> Optional[FrameIndex]:
+    """The frame index of a test folder, rebuilt from the camera logs if the run did not write one. Returns None if
+    the test has neither."""
+    index_paths = glob.glob(os.path.join(test_dir, 'Raw_Data', '*_frame_index.npz'))
+    path = index_paths[0] if index_paths else rebuild_frame_index(test_dir)
+    return FrameIndex(path) if path is not None else None
@@ -13,43 +13,46 @@ import threading
 
 from PIL import Image
 from PIL import ImageTk
-from serial.tools.list_ports import comports
 from ttkthemes import ThemedTk
 
 #from dic_capture.run import run#
 from run import run
-
-import neoapi
+from device_registry import registry
 
 # =====================================
 # Global variables
 
 DIC_CAPTURE_VERSION = "0.0.3"
+DEVICE_ENUMERATION_TIMEOUT_S = 10  # how long make_default_dict waits for the first device enumeration
+DEVICE_POLL_INTERVAL_MS = 200  # how often the GUI checks whether the first device enumeration has finished
 
 
 # =====================================
 # Helper functions for gui. See gui class below.
 def get_cameras_port_ID():
-    devices = []
-    for device in neoapi.CamInfoList_Get():
-        try:
-            devices.append(device.GetUSBPortID()+'_SN:'+device.GetSerialNumber())
-        except neoapi.NeoException as exc:
-            print('error: ', exc)
-    return devices
+    """Get the camera source labels (USB port ID and serial number) from the device registry cache (empty until the
+    first enumeration has finished)."""
+    registry.start()
+    return registry.camera_labels()
 
 def get_cameras_SN():
-    devices = []
-    for device in neoapi.CamInfoList_Get():
-        try:
-            devices.append(device.GetSerialNumber())
-        except neoapi.NeoException as exc:
-            print('error: ', exc)
-    return devices
+    registry.start()
+    return sorted(registry.cameras)
 
 def get_available_com_ports():
-    """Get a list of available COM ports."""
-    return [str(port.device) for port in comports()]
+    """Get a list of available COM ports from the device registry cache."""
+    registry.start()
+    return registry.port_names()
+
+def refresh_device_list(control, get_values):
+    """Update a device drop-down from the registry when it is opened, and refresh the registry in the background so
+    newly plugged in devices show up the next time."""
+    control["values"] = get_values()
+    registry.refresh()
+
+def show_error(message: str):
+    """Show an error from the run function in a message box."""
+    messagebox.showerror("Error", message)
 
 def browse_file(widget):
     """Open a file dialog and insert the selected file path into the specified widget."""
@@ -81,7 +84,8 @@ class GUI:
             },
             "Arduino": {
                 "Choose COM Port:": dict(
-                    type="combobox", value=get_available_com_ports(), current = 0
+                    type="combobox", value=get_available_com_ports(), current = 0,
+                    refresh=registry.port_names
                 ),
                 "Baud Rate": dict(
                     type="entry", value=250000
@@ -95,20 +99,26 @@ class GUI:
             },
             "Camera 1": {
                 "Camera Source": dict(
-                    type="combobox", value=get_cameras_port_ID()
+                    type="combobox", value=get_cameras_port_ID(), refresh=registry.camera_labels
                 ),
                 "Exposure Time (ms)": dict(
                     type="entry", value=10
                 ),
+                "Record ROI": dict(
+                    type="entry", value=""
+                ),
 
             },
             "Camera 2": {
                 "Camera Source": dict(
-                    type="combobox", value=get_cameras_port_ID()
+                    type="combobox", value=get_cameras_port_ID(), refresh=registry.camera_labels
                 ),
                 "Exposure Time (ms)": dict(
                     type="entry", value=10
                 ),
+                "Record ROI": dict(
+                    type="entry", value=""
+                ),
 
             },
             #"Camera 3": {
@@ -123,6 +133,7 @@ class GUI:
         }
 
         # Create the main window
+        self.device_controls = []  # (combobox, options) of the device drop-downs, filled once enumeration finishes
         self.master = master
         self.master.title('DIC-Capture v' + DIC_CAPTURE_VERSION)
         self.master.configure()
@@ -131,6 +142,7 @@ class GUI:
         self.create_config_frame()
         self.create_run_frame()
         self.load_logo()
+        self._poll_device_registry()
 
         # Variables
         self.current_settings = dict()
@@ -161,6 +173,9 @@ class GUI:
 
         elif control_type == "combobox":
             control = ttk.Combobox(parent, values=widget_options["value"])
+            if "refresh" in widget_options:
+                control["postcommand"] = lambda: refresh_device_list(control, widget_options["refresh"])
+                self.device_controls.append((control, widget_options))
             try:
                 control.current(0)
             except:
@@ -201,6 +216,18 @@ class GUI:
 
         return control
 
+    def _poll_device_registry(self):
+        """Fill the device drop-downs once the first device enumeration has finished, checking with after() so the
+        window is never blocked by the enumeration."""
+        if registry.refresh_count == 0:
+            self.master.after(DEVICE_POLL_INTERVAL_MS, self._poll_device_registry)
+            return
+        for control, widget_options in self.device_controls:
+            widget_options["value"] = widget_options["refresh"]()
+            control["values"] = widget_options["value"]
+            if not control.get() and widget_options["value"]:
+                control.current(0)
+
     def _update_working_folder(self):
         """Update the working folder and the config file combobox."""
         # Open a file dialog to choose the working folder
@@ -320,7 +347,7 @@ class GUI:
         self._update_current_settings()
         self.current_settings["Record Mode"] = True
         root.destroy()
-        run(self.current_settings)
+        run(self.current_settings, on_error=show_error)
 
 
     def run_test_mode(self):
@@ -338,7 +365,7 @@ class GUI:
         #run(self.current_settings)
         #threading.Thread(target=run, args=(self.current_settings,), daemon=False).start()
         root.destroy()
-        run(self.current_settings)
+        run(self.current_settings, on_error=show_error)
         print("starting camera run script")
 
 
@@ -437,6 +464,7 @@ def run_gui():
 
     """Run the program by opening the GUI."""
     global root
+    registry.start()  # enumerate the devices while the window is being built
     root = ThemedTk(theme="plastik")
     app = GUI(root)
     root.mainloop()
@@ -447,7 +475,8 @@ def run_gui():
 
 def make_default_dict():
     """Use current settings from the GUI to create a default config file."""
-    # Create the GUI to get the default settings
+    # Create the GUI to get the default settings, with the devices found by the first enumeration
+    registry.wait(DEVICE_ENUMERATION_TIMEOUT_S)
     root = ThemedTk(theme="plastik")
     app = GUI(root)
 
@@ -0,0 +1,208 @@
+"""This module contains the acquisition health counters of a camera. Every frame is accounted for while the test runs:
+
+- ImageID gaps: frames the camera exposed but the host never received. A gap found when GetImage returned straight
+  away (frames were queued in the SDK, so the host had fallen behind) is counted as an SDK buffer underrun, i.e. the
+  SetImageBufferCount buffers were all in use; other gaps are counted as lost in transfer.
+- GetImage timeouts (no image within the grab timeout) and GetImage exceptions.
+- Frames dropped or overwritten by the frame ring because the save thread fell behind, and the saver queue depth.
+- Frames skipped by the save thread because they have no timestamp, and frames that could not be saved.
+- Achieved vs commanded frame rate, per stage of the trigger schedule. The rate is measured every RATE_INTERVAL_S and
+  at every stage change, timed from the stage boundaries of the schedule, so each measurement falls in a single stage
+  (the frames to within one pass of the main loop).
+
+The grab and save threads update the counters with plain integer increments (each counter has a single writer). The
+counters are shown on the live preview and written to {test_id}_health.json in Logs at the end of the run."""
+
+# ======================================================================================================================
+# Imports
+
+import json
+import logging
+from time import perf_counter
+from typing import Any, Dict, List, Optional, Tuple
+
+from schedule import TriggerStage, stage_at, stage_start_s
+from serial_protocol import TriggerEvent
+
+# ======================================================================================================================
+# Global variables
+
+IMMEDIATE_GRAB_NS = 200_000  # GetImage calls returning faster than this found a frame already queued in the SDK
+RATE_INTERVAL_S = 0.5  # how often the achieved frame rate is measured
+
+
+# ======================================================================================================================
+# Classes
+
+class CameraHealth:
+    """Acquisition health counters of one camera.
+
+    :param camera: camera name, for log messages
+    :param ring: the camera's FrameRing, for the ring drops and the saver queue depth
+    :param keeps_frames: the ring's slots are never released (raw capture file), so only frames not yet handed to the
+        save thread are queued
+    """
+
+    def __init__(self, camera: str, ring=None, keeps_frames: bool = False):
+        self.camera = camera
+        self.ring = ring
+        self.keeps_frames = keeps_frames
+        self.frames_grabbed = 0
+        self.last_image_id: Optional[int] = None
+        self.id_gaps = 0
+        self.lost_in_transfer = 0
+        self.sdk_underruns = 0  # frames lost because the SDK had no free buffer
+        self.timeouts = 0
+        self.grab_errors = 0
+        self.skipped_no_timestamp = 0
+        self.save_errors = 0
+        self.max_queue_depth = 0
+        self.commanded_fps = 0.0
+        self.achieved_fps = 0.0
+        self.stage: Optional[int] = None
+        self.stages: Dict[int, List[float]] = {}  # stage index -> [seconds, frames]
+        self._t_rate = None
+        self._frames_rate = 0
+
+    # Grab thread
+    def grabbed(self, image_id: int, wait_ns: int):
+        """Count a frame returned by GetImage after waiting wait_ns for it."""
+        self.frames_grabbed += 1
+        if self.last_image_id is not None and image_id > self.last_image_id + 1:
+            missing = image_id - self.last_image_id - 1
+            self.id_gaps += 1
+            if wait_ns < IMMEDIATE_GRAB_NS:
+                self.sdk_underruns += missing
+            else:
+                self.lost_in_transfer += missing
+            if self.id_gaps == 1:
+                logging.warning(f'Camera {self.camera}: first ImageID gap, {missing} frames missing before ImageID '
+                                f'{image_id}.')
+        self.last_image_id = image_id
+        depth = self.queue_depth
+        if depth > self.max_queue_depth:
+            self.max_queue_depth = depth
+
+    def timed_out(self):
+        self.timeouts += 1
+
+    def grab_error(self, error: Exception):
+        self.grab_errors += 1
+        if self.grab_errors == 1 or self.grab_errors % 100 == 0:
+            logging.error(f'Image grab problem on camera {self.camera} ({self.grab_errors} so far): {error}')
+
+    # Save thread
+    def skipped(self, image_id: int):
+        """Count a frame the save thread skipped because it has no timestamp."""
+        self.skipped_no_timestamp += 1
+        if self.skipped_no_timestamp == 1:
+            logging.warning(f'Camera {self.camera}: frame {image_id} has no timestamp and was not saved.')
+
+    def save_error(self):
+        self.save_errors += 1
+
+    @property
+    def queue_depth(self) -> int:
+        """Frames in the ring waiting to be saved."""
+        if self.ring is None:
+            return 0
+        return min(self.ring.head - self.ring.read, self.ring.capacity) if self.keeps_frames else len(self.ring)
+
+    @property
+    def ring_drops(self) -> int:
+        return (self.ring.dropped + self.ring.overwritten) if self.ring is not None else 0
+
+    @property
+    def missing_frames(self) -> int:
+        """Frames that will not be in the recording, whatever the cause."""
+        return (self.lost_in_transfer + self.sdk_underruns + self.ring_drops + self.skipped_no_timestamp
+                + self.save_errors)
+
+    # Main loop
+    def tick(self, stage: Optional[int] = None, commanded_fps: float = 0.0, now: Optional[float] = None,
+             stage_started_s: Optional[float] = None):
+        """Update the achieved frame rate (every RATE_INTERVAL_S, and when the stage of the trigger schedule changes)
+        and attribute the frames since the last update to the stage they were grabbed in. stage_started_s, the time
+        the stage started (see commanded_stage), closes the previous stage at its end rather than at this call."""
+        now = perf_counter() if now is None else now
+        if self._t_rate is None:
+            self._t_rate, self._frames_rate = now, self.frames_grabbed
+            if stage is not None and stage_started_s is not None:  # the schedule started before the main loop
+                self._t_rate, self._frames_rate = min(stage_started_s, now), 0
+            self.stage, self.commanded_fps = stage, commanded_fps
+            return
+        if stage == self.stage:
+            if now - self._t_rate < RATE_INTERVAL_S:
+                return
+        elif stage_started_s is not None:
+            now = min(max(stage_started_s, self._t_rate), now)
+        elapsed = now - self._t_rate
+        frames = self.frames_grabbed - self._frames_rate
+        if elapsed > 0:
+            self.achieved_fps = frames / elapsed
+        if self.stage is not None:
+            totals = self.stages.setdefault(self.stage, [0.0, 0])
+            totals[0] += elapsed
+            totals[1] += frames
+        self.stage, self.commanded_fps = stage, commanded_fps
+        self._t_rate, self._frames_rate = now, self.frames_grabbed
+
+    def lines(self) -> List[str]:
+        """The counters as short text lines for the preview overlay."""
+        return [f'fps {self.achieved_fps:.1f} / {self.commanded_fps:.1f}',
+                f'lost {self.missing_frames} (gap {self.lost_in_transfer} sdk {self.sdk_underruns} '
+                f'ring {self.ring_drops} ts0 {self.skipped_no_timestamp})',
+                f'timeout {self.timeouts} err {self.grab_errors} save err {self.save_errors}',
+                f'queue {self.queue_depth} (max {self.max_queue_depth})']
+
+    @property
+    def ok(self) -> bool:
+        return self.missing_frames == 0 and self.grab_errors == 0  # timeouts are normal during trigger pauses
+
+    def summary(self, stages: Optional[List[TriggerStage]] = None) -> Dict[str, Any]:
+        """The counters, and the achieved frame rate of every stage the camera ran in, as a JSON-ready dict."""
+        per_stage = []
+        for index, (seconds, frames) in sorted(self.stages.items()):
+            stage = {'stage': index + 1, 'seconds': round(seconds, 3), 'frames': int(frames),
+                     'achieved_fps': frames / seconds if seconds else 0.0}
+            if stages is not None and index < len(stages):
+                stage['commanded_fps'] = stages[index].fps
+            per_stage.append(stage)
+        return {'frames_grabbed': self.frames_grabbed, 'last_image_id': self.last_image_id,
+                'missing_frames': self.missing_frames, 'id_gaps': self.id_gaps,
+                'lost_in_transfer': self.lost_in_transfer, 'sdk_buffer_underruns': self.sdk_underruns,
+                'ring_drops': self.ring_drops, 'skipped_no_timestamp': self.skipped_no_timestamp,
+                'save_errors': self.save_errors, 'timeouts': self.timeouts, 'grab_errors': self.grab_errors,
+                'max_queue_depth': self.max_queue_depth,
+                'stages': per_stage}
+
+
+# ======================================================================================================================
+# Functions
+
+def commanded_stage(stages: List[TriggerStage], first_trigger: Optional[TriggerEvent],
+                    now: Optional[float] = None) -> Tuple[Optional[int], float, Optional[float]]:
+    """The index, trigger rate and perf_counter() start time of the stage the Arduino is running, timed from the
+    first trigger record received (None, 0 and None before the first trigger; None, 0 and the end of the schedule
+    after it has ended)."""
+    if first_trigger is None or not stages:
+        return None, 0.0, None
+    now = perf_counter() if now is None else now
+    t_schedule_s = first_trigger.received_s - stage_start_s(stages, first_trigger.stage - 1)
+    index = stage_at(stages, now - t_schedule_s)
+    started_s = t_schedule_s + stage_start_s(stages, len(stages) if index is None else index)
+    return index, (stages[index].fps if index is not None else 0.0), started_s
+
+
+def write_health_summary(path: str, test_id: str, healths: List[CameraHealth],
+                         stages: Optional[List[TriggerStage]] = None, triggers: Optional[int] = None):
+    """Write the health summary of a run: the counters of every camera and the number of triggers sent."""
+    summary = {'test_id': test_id, 'triggers': triggers,
+               'cameras': {health.camera: health.summary(stages) for health in healths}}
+    with open(path, 'w') as f:
+        json.dump(summary, f, indent=2)
+    for health in healths:
+        level = logging.INFO if health.ok else logging.WARNING
+        logging.log(level, f'Camera {health.camera} health: {health.frames_grabbed} frames grabbed, '
+                           f'{health.missing_frames} missing, {health.timeouts} timeouts, {health.grab_errors} errors, '
+                           f'saver queue max {health.max_queue_depth}.')
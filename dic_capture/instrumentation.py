@@ -0,0 +1,137 @@
+"""This module contains the stage timing instrumentation of the capture pipeline. Each stage of each camera (grab,
+copy-out, handoff wait, encode, write, metadata, preview) has a fixed size latency histogram with one bucket per power
+of two nanoseconds, so recording a sample is an int.bit_length() and a list increment (well under a microsecond) and
+the memory does not grow with the length of the test. Every histogram has a single writer thread, so no locks are
+needed.
+
+Timing is turned on with "Stage Timing" in the "Pipeline" section of the config. A one line summary (median and 99th
+percentile of every stage) is written to the run log while the test runs, and the histograms are written to
+{test_id}_stage_timing.json in Logs at the end of the run. When timing is off the stages are NullHistograms, whose
+record() does nothing."""
+
+# ======================================================================================================================
+# Imports
+
+import json
+import logging
+from time import perf_counter
+from typing import Any, Dict, List, Optional, Tuple
+
+# ======================================================================================================================
+# Global variables
+
+BUCKETS = 64  # bucket k counts samples of 2^(k-1) to 2^k - 1 ns (bucket 0 counts 0 ns)
+STAGES = ('grab', 'copy-out', 'handoff wait', 'encode', 'write', 'metadata', 'preview')
+
+
+# ======================================================================================================================
+# Classes
+
+class StageHistogram:
+    """Log2 latency histogram of one pipeline stage."""
+    __slots__ = ('camera', 'stage', 'counts', 'total_ns', 'max_ns')
+
+    def __init__(self, camera: str, stage: str):
+        self.camera = camera
+        self.stage = stage
+        self.counts = [0] * BUCKETS
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def record(self, ns: int):
+        """Add one sample (a duration in ns, e.g. the difference of two perf_counter_ns() calls)."""
+        self.counts[ns.bit_length()] += 1
+        self.total_ns += ns
+        if ns > self.max_ns:
+            self.max_ns = ns
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def percentile(self, q: float) -> int:
+        """Upper bound in ns of the bucket holding the q-th percentile (0 if there are no samples)."""
+        counts = list(self.counts)  # copy, the writer thread keeps recording
+        target = q / 100 * sum(counts)
+        cumulative = 0
+        for bucket, count in enumerate(counts):
+            cumulative += count
+            if count and cumulative >= target:
+                return min((1 << bucket) - 1, self.max_ns)
+        return 0
+
+    def summary(self) -> Dict[str, Any]:
+        count = self.count
+        last = max((bucket for bucket, n in enumerate(self.counts) if n), default=0)
+        return {'count': count, 'mean_us': self.total_ns / count / 1000 if count else 0.0,
+                'p50_us': self.percentile(50) / 1000, 'p99_us': self.percentile(99) / 1000,
+                'max_us': self.max_ns / 1000,
+                'buckets_upper_ns': [(1 << bucket) - 1 for bucket in range(last + 1)],
+                'counts': self.counts[:last + 1]}
+
+
+class NullHistogram:
+    """Stands in for a StageHistogram when timing is off."""
+    __slots__ = ()
+
+    def record(self, ns: int):
+        pass
+
+
+class Instrumentation:
+    """The stage histograms of all cameras of a run.
+
+    :param enabled: record the samples (otherwise stage() returns a NullHistogram)
+    :param log_interval_s: how often log_summary() writes the live summary to the run log
+    :param echo: also print the live summary (test mode, where the run log is off)
+    """
+
+    def __init__(self, enabled: bool = False, log_interval_s: float = 10.0, echo: bool = False):
+        self.enabled = enabled
+        self.log_interval_s = log_interval_s
+        self.echo = echo
+        self.histograms: Dict[Tuple[str, str], StageHistogram] = {}
+        self._t_logged = perf_counter()
+
+    def stage(self, camera: str, stage: str):
+        """The histogram of one stage of a camera, created on first use."""
+        if not self.enabled:
+            return NullHistogram()
+        key = (camera, stage)
+        if key not in self.histograms:
+            self.histograms[key] = StageHistogram(camera, stage)
+        return self.histograms[key]
+
+    def summary_lines(self) -> List[str]:
+        """One line per camera with the median / 99th percentile of each stage that has samples."""
+        lines = []
+        for camera in sorted({camera for camera, _ in self.histograms}):
+            stages = [self.histograms[(camera, stage)] for stage in STAGES if (camera, stage) in self.histograms]
+            stages = [histogram for histogram in stages if histogram.count]
+            lines.append(f'camera {camera}: ' + ', '.join(
+                f'{histogram.stage} {histogram.percentile(50) / 1000:.0f}/{histogram.percentile(99) / 1000:.0f}us'
+                for histogram in stages))
+        return lines
+
+    def log_summary(self, now: Optional[float] = None, force: bool = False):
+        """Write the live summary to the run log, at most every log_interval_s."""
+        if not self.enabled:
+            return
+        now = perf_counter() if now is None else now
+        if not force and now - self._t_logged < self.log_interval_s:
+            return
+        self._t_logged = now
+        for line in self.summary_lines():
+            logging.info(f'Stage timing (p50/p99) {line}')
+            if self.echo:
+                print(f'Stage timing (p50/p99) {line}')
+
+    def write_json(self, path: str, test_id: str):
+        """Write every histogram to a JSON file."""
+        if not self.enabled:
+            return
+        cameras: Dict[str, Dict[str, Any]] = {}
+        for (camera, stage), histogram in sorted(self.histograms.items()):
+            cameras.setdefault(camera, {})[stage] = histogram.summary()
+        with open(path, 'w') as f:
+            json.dump({'test_id': test_id, 'cameras': cameras}, f, indent=2)
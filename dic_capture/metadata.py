@@ -0,0 +1,111 @@
+"""This module contains the metadata writers for the text logs written during a test (the camera logs and the Arduino
+serial output in Raw_Data). Each log keeps one file handle open for the whole test. Lines are collected in memory and
+written in batches, and the file is flushed and fsynced on a fixed interval by a background thread, so the save and
+serial threads never open files or wait on the disk. Every writer is flushed and closed at shutdown, and at interpreter
+exit if the run ends early."""
+
+# ======================================================================================================================
+# Imports
+
+import atexit
+import logging
+import os
+import threading
+import weakref
+from typing import List
+
+# ======================================================================================================================
+# Global variables
+
+_open_writers = weakref.WeakSet()
+
+
+# ======================================================================================================================
+# Classes
+
+class MetadataWriter:
+    """Append-only text log with a long-lived handle, batched writes and periodic fsync.
+
+    :param path: file to append to
+    :param flush_interval_s: how often pending lines are written, flushed and fsynced (0 writes every line at once)
+    :param batch_lines: number of pending lines that triggers a write before the interval elapses
+    """
+
+    def __init__(self, path: str, flush_interval_s: float = 1.0, batch_lines: int = 256):
+        self.path = path
+        self.flush_interval_s = float(flush_interval_s)
+        self.batch_lines = max(1, int(batch_lines))
+        self.lines_written = 0
+        self._file = open(path, 'a', buffering=1024 * 1024)
+        self._pending: List[str] = []
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._flush_thread = None
+        if self.flush_interval_s > 0:
+            self._flush_thread = threading.Thread(target=self._flush_periodically, daemon=True,
+                                                  name=f'MetadataWriter {os.path.basename(path)}')
+            self._flush_thread.start()
+        _open_writers.add(self)
+
+    def write(self, text: str):
+        """Queue text (one or more complete lines) for the log."""
+        with self._lock:
+            if self._closed.is_set():
+                raise ValueError(f'Metadata writer for {self.path} is closed.')
+            self._pending.append(text)
+            if self.flush_interval_s <= 0 or len(self._pending) >= self.batch_lines:
+                self._write_pending()
+
+    def flush(self, fsync: bool = True):
+        """Write the pending lines and flush them to the OS (and to the disk if fsync is True)."""
+        with self._lock:
+            if self._file.closed:
+                return
+            self._write_pending()
+            self._file.flush()
+            if fsync:
+                try:
+                    os.fsync(self._file.fileno())
+                except OSError as e:
+                    logging.warning(f'Could not fsync {self.path}: {e}')
+
+    def close(self):
+        """Flush everything to disk and close the file. Safe to call more than once."""
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        if self._flush_thread is not None:
+            self._flush_thread.join()
+        self.flush()
+        with self._lock:
+            self._file.close()
+        _open_writers.discard(self)
+
+    def _write_pending(self):
+        if self._pending:
+            self._file.write(''.join(self._pending))
+            self.lines_written += len(self._pending)
+            self._pending.clear()
+
+    def _flush_periodically(self):
+        while not self._closed.wait(self.flush_interval_s):
+            self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# ======================================================================================================================
+# Functions
+
+@atexit.register
+def close_all():
+    """Flush and close every metadata writer that is still open."""
+    for writer in list(_open_writers):
+        try:
+            writer.close()
+        except Exception as e:
+            logging.error(f'Error closing metadata writer for {writer.path}: {e}')
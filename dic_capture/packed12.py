@@ -0,0 +1,125 @@
+"""This module contains the packed 12-bit storage mode. The cameras run in Mono12, so a 16-bit TIFF spends a quarter of
+every frame on padding. Packing two 12-bit pixels into three bytes removes it, which directly raises the frame rate the
+disk can sustain.
+
+The packing is the GenICam Mono12p layout, so frames from a camera set to PixelFormat Mono12p can be stored as they
+arrive, without unpacking:
+    byte 0 = p0 bits 0-7,  byte 1 = p0 bits 8-11 | p1 bits 0-3 << 4,  byte 2 = p1 bits 4-11
+
+Packed frames are stored in rolling {test_id}_CAM_{camera}_{part}.p12 files: a short file header, the packed frames
+back to back, and the frame index trailer of container.py. They are read with container.ContainerReader and converted
+to 16-bit TIFFs with container.export_to_tiffs."""
+
+# ======================================================================================================================
+# Imports
+
+import os
+import struct
+from time import perf_counter_ns
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+
+from container import FRAME_INDEX_DTYPE, RollingContainerWriter
+
+# ======================================================================================================================
+# Global variables
+
+P12_MAGIC = b'DICP12\x00\x00'
+P12_FILE_HEADER = struct.Struct('<8sII56x')  # magic, height, width, padded to 64 bytes
+
+
+# ======================================================================================================================
+# Packing
+
+def packed_shape(shape: Tuple[int, int]) -> Tuple[int, int]:
+    """Shape of the packed uint8 frame for a Mono12 frame shape (the width must be even)."""
+    height, width = shape
+    if width % 2:
+        raise ValueError(f'Packed 12-bit frames need an even width, got {width}.')
+    return height, width * 3 // 2
+
+
+def unpacked_shape(shape: Tuple[int, int]) -> Tuple[int, int]:
+    """Shape of the Mono12 frame for a packed uint8 frame shape."""
+    height, row_bytes = shape
+    return height, row_bytes * 2 // 3
+
+
+def pack12(frame: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """Pack a uint16 Mono12 frame into the Mono12p layout."""
+    if out is None:
+        out = np.empty(packed_shape(frame.shape), dtype=np.uint8)
+    pixels = frame.reshape(-1, 2)
+    packed = out.reshape(-1, 3)
+    np.copyto(packed[:, 0], pixels[:, 0], casting='unsafe')
+    np.copyto(packed[:, 1], (pixels[:, 0] >> 8) | ((pixels[:, 1] & 0xF) << 4), casting='unsafe')
+    np.copyto(packed[:, 2], pixels[:, 1] >> 4, casting='unsafe')
+    return out
+
+
+def unpack12(packed: np.ndarray, shape: Tuple[int, int], out: Optional[np.ndarray] = None) -> np.ndarray:
+    """Unpack a Mono12p frame into a uint16 frame of the given shape."""
+    if out is None:
+        out = np.empty(shape, dtype=np.uint16)
+    data = packed.reshape(-1, 3).astype(np.uint16)
+    pixels = out.reshape(-1, 2)
+    np.bitwise_or(data[:, 0], (data[:, 1] & 0xF) << 8, out=pixels[:, 0])
+    np.bitwise_or(data[:, 1] >> 4, data[:, 2] << 4, out=pixels[:, 1])
+    return out
+
+
+# ======================================================================================================================
+# Writer
+
+class Packed12ContainerWriter(RollingContainerWriter):
+    """Appends packed 12-bit frames of one camera to rolling .p12 files. Accepts uint16 Mono12 frames, which are packed
+    here, or uint8 frames that are already in the Mono12p layout (PixelFormat Mono12p), which are written as they are."""
+    format = 'packed12'
+    extension = '.p12'
+
+    def __init__(self, spec):
+        super().__init__(spec)
+        self.file = None
+        self.packed = None
+
+    def frame_header(self, frame: np.ndarray) -> Dict[str, Any]:
+        shape = unpacked_shape(frame.shape) if frame.dtype == np.uint8 else frame.shape
+        return dict(shape=list(shape), dtype='<u2')
+
+    def _open_file(self, frame: np.ndarray):
+        height, width = self.header['shape']
+        self.file = open(self.path, 'wb')
+        self.file.write(P12_FILE_HEADER.pack(P12_MAGIC, height, width))
+
+    def _append(self, frame: np.ndarray) -> Tuple[int, int]:
+        if frame.dtype != np.uint8:
+            if self.packed is None or self.packed.shape != packed_shape(frame.shape):
+                self.packed = np.empty(packed_shape(frame.shape), dtype=np.uint8)
+            t_encode = perf_counter_ns()
+            frame = pack12(frame, self.packed)
+            self.last_encode_ns = perf_counter_ns() - t_encode
+        offset = self.file.tell()
+        self.file.write(frame.data if frame.flags.c_contiguous else frame.tobytes())
+        return offset, frame.nbytes
+
+    def _close_file(self):
+        self.file.close()
+
+
+# ======================================================================================================================
+# Functions
+
+def rebuild_packed12_index(path: str) -> Tuple[Dict[str, Any], np.ndarray]:
+    """Rebuild the frame index of a .p12 part that has no trailer (ImageIDs and timestamps are unknown)."""
+    with open(path, 'rb') as f:
+        magic, height, width = P12_FILE_HEADER.unpack(f.read(P12_FILE_HEADER.size))
+    if magic != P12_MAGIC:
+        raise ValueError(f'{path} is not a packed 12-bit recording.')
+    frame_bytes = height * width * 3 // 2
+    count = (os.path.getsize(path) - P12_FILE_HEADER.size) // frame_bytes
+    index = np.zeros(count, dtype=FRAME_INDEX_DTYPE)
+    index['image_id'] = -1
+    index['offset'] = P12_FILE_HEADER.size + np.arange(count, dtype=np.uint64) * frame_bytes
+    index['nbytes'] = frame_bytes
+    return dict(format='packed12', shape=[height, width], dtype='<u2'), index
@@ -0,0 +1,252 @@
+"""This module contains the pre-flight capacity planner that runs before a test is recorded. The "Trigger speed per
+stage (ms)" schedule is compiled into the frames, frame rate and MB/s of every stage for every camera, and a short
+write probe of the selected record format in the working folder measures what the disk sustains (MB/s and frames, i.e.
+write operations, per second). The planner then checks that:
+
+- the frames the disk cannot keep up with during fast stages fit in the frame ring of each camera (the backlog drains
+  again during slower stages and pauses),
+- open ended stages do not trigger faster than the disk sustains,
+- the recording fits in the free space of the working folder.
+
+Depending on the "Check" setting of the "Pre-flight" section a failed check only warns or stops the run before anything
+is written, with suggestions (a larger ring, the packed12 or raw format, writer processes). The probe writes through
+one writer, like the save thread of one camera, so it is a conservative estimate for several cameras writing at once.
+The frame size is not known before the cameras are connected, so it is taken from the "Frame Width" and "Frame Height"
+settings (by default the largest "Record ROI" if every camera has one, the simulated frame size for the simulated
+backend, the recorded frame size for the replay backend, otherwise the full sensor of the VCXU cameras)."""
+
+# ======================================================================================================================
+# Imports
+
+import logging
+import math
+import os
+import shutil
+import tempfile
+from time import perf_counter
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from roi import parse_roi
+from schedule import TriggerStage, expected_frame_count
+
+# ======================================================================================================================
+# Global variables
+
+PREFLIGHT_DEFAULTS = {
+    "Check": "warn",  # "warn", "refuse" or "off"
+    "Probe Seconds": 1.0,
+    "Probe Max MB": 512,
+    "Headroom": 1.2,  # the disk must sustain this multiple of the planned rate
+}
+DEFAULT_FRAME_SHAPE = (2048, 2448)  # height, width
+BYTES_PER_PIXEL = {'tiff': 2.0, 'bigtiff': 2.0, 'packed12': 1.5, 'raw': 2.0}
+FREE_SPACE_MARGIN = 0.9  # use at most this fraction of the free space
+
+
+# ======================================================================================================================
+# Classes
+
+class StagePlan(NamedTuple):
+    """What one stage of the trigger schedule produces for one camera."""
+    index: int
+    fps: float
+    duration_s: Optional[float]  # None for an open ended stage
+    frames: Optional[int]
+    mb_per_s: float
+
+
+class DiskProbe(NamedTuple):
+    """Result of the write probe."""
+    mb_per_s: float
+    frames_per_s: float
+    frame_bytes: int
+
+
+class PreflightReport(NamedTuple):
+    """The compiled schedule, the probe result and the outcome of the checks."""
+    stages: List[StagePlan]
+    cameras: int
+    frame_bytes: int
+    frames_per_camera: Optional[int]  # None if the schedule is open ended
+    total_bytes: Optional[int]
+    peak_mb_per_s: float  # all cameras
+    probe: Optional[DiskProbe]
+    free_bytes: int
+    max_backlog_frames: float  # per camera, math.inf if an open ended stage cannot be sustained
+    problems: List[str]
+    suggestions: List[str]
+
+    @property
+    def ok(self) -> bool:
+        return not self.problems
+
+    def lines(self) -> List[str]:
+        """The plan as text lines for the console and the run log."""
+        total = f'{self.total_bytes / 1e9:.2f} GB' if self.total_bytes is not None else 'open ended'
+        frames = self.frames_per_camera if self.frames_per_camera is not None else 'open ended'
+        lines = [f'Pre-flight: {self.cameras} cameras, {self.frame_bytes / 1e6:.2f} MB per frame, frames per camera '
+                 f'{frames}, total {total}, peak {self.peak_mb_per_s:.1f} MB/s, {self.free_bytes / 1e9:.1f} GB free.']
+        for stage in self.stages:
+            duration = f'for {stage.duration_s:.2f} s' if stage.duration_s is not None else 'until stopped'
+            lines.append(f'  stage {stage.index + 1}: {stage.fps:.1f} fps {duration}, '
+                         f'{stage.frames if stage.frames is not None else "-"} frames, '
+                         f'{stage.mb_per_s:.1f} MB/s per camera')
+        if self.probe is not None:
+            lines.append(f'  disk sustains {self.probe.mb_per_s:.1f} MB/s ({self.probe.frames_per_s:.0f} frames/s), '
+                         f'ring backlog peaks at {self.max_backlog_frames:.0f} frames per camera')
+        lines += [f'  PROBLEM: {problem}' for problem in self.problems]
+        lines += [f'  suggestion: {suggestion}' for suggestion in self.suggestions]
+        return lines
+
+
+# ======================================================================================================================
+# Functions
+
+def planned_frame_shape(config: Dict[str, Any]) -> Tuple[int, int]:
+    """The (height, width) of the frames the cameras of a config will produce."""
+    settings = config.get("Pre-flight", {})
+    backend_settings = config.get("Backend", {})
+    height, width = DEFAULT_FRAME_SHAPE
+    if backend_settings.get("Camera", "neoapi") == "simulated":
+        from backends import SIMULATED_DEFAULTS
+        height = backend_settings.get("Simulated Height", SIMULATED_DEFAULTS["Simulated Height"])
+        width = backend_settings.get("Simulated Width", SIMULATED_DEFAULTS["Simulated Width"])
+    elif backend_settings.get("Camera") == "replay" and os.path.isdir(backend_settings.get("Replay Folder", "")):
+        from replay import recorded_frame_shape
+        height, width = recorded_frame_shape(backend_settings["Replay Folder"])
+    rois = [parse_roi(section.get("Record ROI")) for key, section in config.items()
+            if key.startswith("Camera ") and isinstance(section, dict) and section.get("Camera Source")]
+    if rois and all(rois):  # plan for the largest ROI
+        height, width = max((roi.shape for roi in rois), key=lambda shape: shape[0] * shape[1])
+    return int(settings.get("Frame Height", height)), int(settings.get("Frame Width", width))
+
+
+def compile_schedule(stages: List[TriggerStage], frame_bytes: int) -> List[StagePlan]:
+    """The frames and data rate of every stage of the schedule, per camera."""
+    return [StagePlan(index, stage.fps, stage.duration_ms / 1000 if stage.duration_ms is not None else None,
+                      stage.frame_count, stage.fps * frame_bytes / 1e6)
+            for index, stage in enumerate(stages)]
+
+
+def ring_backlog(stages: List[StagePlan], sustained_fps: float) -> float:
+    """Largest number of frames waiting in a camera's ring if the disk saves sustained_fps frames per second for it
+    (math.inf if an open ended stage triggers faster)."""
+    backlog = max_backlog = 0.0
+    for stage in stages:
+        if stage.duration_s is None:
+            return math.inf if stage.fps > sustained_fps else max_backlog
+        backlog = max(0.0, backlog + (stage.fps - sustained_fps) * stage.duration_s)
+        max_backlog = max(max_backlog, backlog)
+    return max_backlog
+
+
+def frame_size(width: int, height: int, record_format: str, camera_pixel_format: str = 'Mono12') -> int:
+    """Bytes written per frame in a record format."""
+    bytes_per_pixel = BYTES_PER_PIXEL.get(record_format, 2.0)
+    if record_format == 'raw' and camera_pixel_format == 'Mono12p':
+        bytes_per_pixel = 1.5
+    return int(width * height * bytes_per_pixel)
+
+
+def probe_disk(folder: str, record_format: str, width: int, height: int, seconds: float = 1.0,
+               max_mb: float = 512, compression: str = 'none', compression_level: int = 0,
+               compression_threads: int = 1) -> DiskProbe:
+    """Write synthetic 12 bit frames in record_format (tiff, bigtiff or packed12) to a temporary folder in folder for
+    about seconds (at most max_mb), sync them to disk and measure the rate. Frames are compressed like the tiff
+    format writes them, and the MB/s counts the bytes that reached the disk."""
+    from writers import FrameWriterSpec, make_frame_writer
+    frame = np.random.default_rng(0).integers(0, 4096, size=(height, width), dtype=np.uint16)
+    frame_bytes = frame_size(width, height, record_format)
+    max_frames = max(2, int(max_mb * 1e6 // frame_bytes))
+    with tempfile.TemporaryDirectory(prefix='dic_capture_probe_', dir=folder) as probe_dir:
+        writer = make_frame_writer(FrameWriterSpec(record_format, probe_dir, 'PROBE', '0',
+                                                   compression=compression, compression_level=compression_level,
+                                                   compression_threads=compression_threads))
+        frames = written_bytes = 0
+        t_start = perf_counter()
+        while frames < max_frames and (frames < 2 or perf_counter() - t_start < seconds):
+            writer.write(frame, frames, frames + 1)
+            frames += 1
+            written_bytes += writer.last_nbytes
+        writer.close()
+        _sync_folder(probe_dir)
+        elapsed = perf_counter() - t_start
+    return DiskProbe(written_bytes / 1e6 / elapsed, frames / elapsed, written_bytes // frames)
+
+
+def _sync_folder(folder: str):
+    """Flush the files in folder to disk, so the probe does not only measure the page cache."""
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        if os.path.isfile(path):
+            with open(path, 'rb+') as f:
+                os.fsync(f.fileno())
+
+
+def preflight(stages: List[TriggerStage], n_cameras: int, working_folder: str, record_format: str, width: int,
+              height: int, ring_buffer_frames: int, camera_pixel_format: str = 'Mono12', writer_processes: int = 0,
+              raw_capture_frames: int = 0, settings: Optional[Dict[str, Any]] = None,
+              compression: str = 'none', compression_level: int = 0, compression_threads: int = 1) -> PreflightReport:
+    """Compile the schedule, probe the disk and check that the test can be recorded (see the module docstring).
+    raw_capture_frames is the capture file size used by the raw format when the schedule is open ended."""
+    settings = {**PREFLIGHT_DEFAULTS, **(settings or {})}
+    working_folder = os.path.abspath(working_folder)
+    while not os.path.isdir(working_folder) and os.path.dirname(working_folder) != working_folder:
+        working_folder = os.path.dirname(working_folder)  # the run creates the working folder later
+    frame_bytes = frame_size(width, height, record_format, camera_pixel_format)
+    plans = compile_schedule(stages, frame_bytes)
+    frames_per_camera = expected_frame_count(stages)
+    if record_format == 'raw' and frames_per_camera is None:
+        frames_per_camera = raw_capture_frames  # the capture files are preallocated
+    total_bytes = frames_per_camera * frame_bytes * n_cameras if frames_per_camera is not None else None
+    peak_mb_per_s = max((plan.mb_per_s for plan in plans), default=0.0) * n_cameras
+    free_bytes = shutil.disk_usage(working_folder).free
+    problems, suggestions = [], []
+
+    # Free space
+    if total_bytes is not None and total_bytes > free_bytes * FREE_SPACE_MARGIN:
+        problems.append(f'the recording needs {total_bytes / 1e9:.2f} GB but only {free_bytes / 1e9:.2f} GB are '
+                        f'free in {working_folder}')
+    elif total_bytes is None and peak_mb_per_s > 0:
+        minutes = free_bytes * FREE_SPACE_MARGIN / (peak_mb_per_s * 1e6) / 60
+        suggestions.append(f'the schedule is open ended, the free space lasts {minutes:.1f} minutes at the peak rate')
+
+    # Bandwidth: the raw format writes into the preallocated capture files, which the kernel flushes to disk in the
+    # background, so only the free space is checked for it
+    probe = None
+    max_backlog = 0.0
+    if record_format != 'raw' and peak_mb_per_s > 0:
+        probe = probe_disk(working_folder, record_format, width, height, float(settings["Probe Seconds"]),
+                           float(settings["Probe Max MB"]), compression if record_format == 'tiff' else 'none',
+                           compression_level, compression_threads)
+        sustained_fps = probe.frames_per_s / float(settings["Headroom"]) / n_cameras
+        max_backlog = ring_backlog(plans, sustained_fps)
+        n_problems = len(problems)
+        if math.isinf(max_backlog):
+            problems.append(f'an open ended stage triggers faster than the {sustained_fps:.1f} fps per camera the '
+                            f'disk sustains')
+        elif max_backlog > ring_buffer_frames:
+            problems.append(f'the disk falls {max_backlog:.0f} frames per camera behind, more than the '
+                            f'{ring_buffer_frames} frame ring holds')
+            ring_mb = math.ceil(max_backlog * 1.1) * frame_bytes * n_cameras / 1e6
+            suggestions.append(f'set "Ring Buffer Frames" to at least {math.ceil(max_backlog * 1.1)} '
+                               f'({ring_mb:.0f} MB of memory for {n_cameras} cameras)')
+        if len(problems) > n_problems:
+            if record_format == 'tiff' and compression == 'none':
+                suggestions.append('set "Compression" to zstd, speckle images compress to about 70% of their size')
+            if record_format in ('tiff', 'bigtiff') and camera_pixel_format != 'Mono12p':
+                suggestions.append('record as packed12, which writes 25% fewer bytes per frame')
+            if frames_per_camera is not None:
+                suggestions.append('record as raw, which writes the frames straight into a preallocated capture file')
+            if record_format == 'tiff' and writer_processes == 0:
+                suggestions.append('set "Writer Processes" to encode and write the frames in parallel')
+    return PreflightReport(plans, n_cameras, frame_bytes, frames_per_camera, total_bytes, peak_mb_per_s, probe,
+                           free_bytes, max_backlog, problems, suggestions)
+
+
+def log_report(report: PreflightReport):
+    """Write the report to the run log, with the problems as warnings."""
+    for line in report.lines():
+        logging.log(logging.WARNING if 'PROBLEM' in line else logging.INFO, line)
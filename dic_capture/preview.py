@@ -0,0 +1,165 @@
+"""This module contains the live preview renderer. Mono12 frames are turned into TURBO colour images with a precomputed
+4096-entry lookup table, so a preview costs one strided gather per frame instead of float divisions and full-size
+temporaries. The table entries are BGRA pixels packed in a uint32, so each pixel is a single 4-byte gather; cv2.imshow
+shows the BGRA images as they are. The window/level of the table is configurable, so the colour range can be fitted to
+the speckle.
+
+The renderer writes into three preallocated sets of images. A camera's preview thread renders the newest frame into a
+back set and publishes it as the front set under a lock once it is complete; the main thread takes the front set with
+front() and keeps it until its next call, and the preview thread never renders into the front set or the one the main
+thread holds, so cv2.imshow never shows a half drawn image or a histogram of another frame. The
+histogram of the zoom ROI is computed on the native 12-bit pixels with np.bincount, so saturated pixels (4095) are
+counted exactly, and is only redrawn when a new frame is rendered. The speckle quality and focus metrics of
+speckle_metrics.py (of the zoom ROI, or of the whole frame) and the acquisition health counters of health.py are
+drawn over the live view."""
+
+# ======================================================================================================================
+# Imports
+
+import threading
+from typing import List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from speckle_metrics import SpeckleMetrics, compute_metrics
+
+# ======================================================================================================================
+# Global variables
+
+MONO12_LEVELS = 4096
+MONO12_MAX = MONO12_LEVELS - 1
+
+
+# ======================================================================================================================
+# Functions
+
+def turbo_lut(window_low: int = 0, window_high: int = MONO12_LEVELS - 1) -> np.ndarray:
+    """Return a (4096,) uint32 lookup table mapping Mono12 values to packed BGRA TURBO colours. Values at or below
+    window_low are the first colour of the map, values at or above window_high the last."""
+    if window_high <= window_low:
+        raise ValueError(f'Preview window high ({window_high}) must be above window low ({window_low}).')
+    colours = cv2.applyColorMap(np.arange(256, dtype=np.uint8).reshape(-1, 1), cv2.COLORMAP_TURBO).reshape(256, 3)
+    levels = np.arange(MONO12_LEVELS, dtype=np.float64)
+    index = np.clip((levels - window_low) * 255 / (window_high - window_low), 0, 255).round().astype(np.intp)
+    bgra = np.full((MONO12_LEVELS, 4), 255, dtype=np.uint8)
+    bgra[:, :3] = colours[index]
+    return bgra.view(np.uint32).ravel()
+
+
+def apply_lut(frame: np.ndarray, lut: np.ndarray, out: np.ndarray) -> np.ndarray:
+    """Colour a uint16 frame (or strided view of one) into out, a (height, width, 4) uint8 BGRA image, with a lookup
+    table from turbo_lut. Values above the table are clipped to its last entry."""
+    np.take(lut, frame, out=out.view(np.uint32).reshape(out.shape[:2]), mode='clip')
+    return out
+
+
+# ======================================================================================================================
+# Classes
+
+class HistogramRenderer:
+    """Draws the 12-bit histogram of the zoom ROI into a reused canvas: one bar per 16 grey levels, coloured like the
+    preview, and a red strip on the right whose height shows the fraction of saturated pixels (at least a tenth of the
+    canvas if any pixel is saturated, so it cannot be missed)."""
+    bars = 256
+    strip_width = 4
+
+    def __init__(self, height: int = 256):
+        self.height = height
+        self.canvas = np.zeros((height, self.bars + self.strip_width, 4), dtype=np.uint8)
+        colours = cv2.applyColorMap(np.arange(self.bars, dtype=np.uint8).reshape(1, -1), cv2.COLORMAP_TURBO)
+        self.colours = np.full((1, self.bars, 4), 255, dtype=np.uint8)
+        self.colours[..., :3] = colours
+        self.rows = np.arange(height).reshape(-1, 1)
+        self.counts = np.zeros(MONO12_LEVELS, dtype=np.int64)
+        self.saturated_pixels = 0
+        self.saturated_fraction = 0.0
+
+    def render(self, pixels: np.ndarray) -> np.ndarray:
+        """Count the Mono12 pixels and redraw the canvas."""
+        counts = np.bincount(pixels.ravel(), minlength=MONO12_LEVELS)
+        self.saturated_pixels = int(counts[MONO12_MAX:].sum())
+        self.saturated_fraction = self.saturated_pixels / max(1, pixels.size)
+        self.counts[:] = counts[:MONO12_LEVELS]
+        bars = self.counts.reshape(self.bars, -1).sum(axis=1)
+        heights = (bars * self.height) // max(1, int(bars.max()))
+        self.canvas[:] = 0
+        np.copyto(self.canvas[:, :self.bars], self.colours, where=(self.rows >= self.height - heights)[..., None])
+        if self.saturated_pixels:
+            strip = max(self.height // 10, int(self.saturated_fraction * self.height))
+            self.canvas[self.height - strip:, self.bars:] = (0, 0, 255, 255)
+        return self.canvas
+
+
+class PreviewRenderer:
+    """Renders the downsampled live view and the full resolution zoom ROI of one camera into preallocated buffers.
+
+    :param frame_shape: (height, width) of the Mono12 frames
+    :param step: downsampling step of the live view (2 shows every 2nd pixel of every 2nd row)
+    """
+
+    def __init__(self, frame_shape: Tuple[int, int], step: int = 2, window_low: int = 0,
+                 window_high: int = MONO12_LEVELS - 1, metrics: bool = True):
+        self.frame_shape = tuple(frame_shape)
+        self.show_metrics = metrics
+        self.metrics: Optional[SpeckleMetrics] = None
+        self.step = int(step)
+        self.lut = turbo_lut(window_low, window_high)
+        height, width = self.frame_shape
+        view_shape = (-(-height // self.step), -(-width // self.step), 4)
+        self._views = [np.zeros(view_shape, dtype=np.uint8) for _ in range(3)]
+        self._zooms = [None, None, None]
+        self._front = None  # set published by the last render
+        self._shown = None  # set handed to the main thread by the last front()
+        self._lock = threading.Lock()
+        self.view: Optional[np.ndarray] = None  # front buffers, shown by the main thread
+        self.zoom: Optional[np.ndarray] = None
+        self.zoom_raw: Optional[np.ndarray] = None  # Mono12 pixels of the zoom ROI
+        self.histogram = HistogramRenderer()
+        self._histograms = [self.histogram.canvas.copy() for _ in range(3)]
+        self.hist: Optional[np.ndarray] = None
+
+    def set_window(self, window_low: int, window_high: int):
+        """Change the window/level of the colour map."""
+        self.lut = turbo_lut(window_low, window_high)
+
+    def render(self, frame: np.ndarray, roi: Optional[Tuple[int, int, int, int]] = None,
+               marker: Optional[Tuple[int, int, int, int]] = None, status: Optional[List[str]] = None,
+               status_ok: bool = True):
+        """Render a Mono12 frame into a free set of buffers and publish it as the front set. roi is the zoom region
+        (x0, y0, x1, y1) in frame pixels, marker a rectangle drawn on the live view in view pixels. status lines (the
+        acquisition health counters) are drawn at the bottom of the live view, in red unless status_ok."""
+        with self._lock:
+            back = next(k for k in range(3) if k != self._front and k != self._shown)
+        view = apply_lut(frame[::self.step, ::self.step], self.lut, self._views[back])
+        if marker is not None:
+            cv2.rectangle(view, marker[:2], marker[2:], (0, 0, 255, 255), 2)
+        zoom = zoom_raw = hist = None
+        if roi is not None:
+            x0, y0, x1, y1 = roi
+            zoom_raw = frame[min(y0, y1):max(y0, y1), min(x0, x1):max(x0, x1)]
+            if zoom_raw.size:
+                if self._zooms[back] is None or self._zooms[back].shape[:2] != zoom_raw.shape:
+                    self._zooms[back] = np.empty((*zoom_raw.shape, 4), dtype=np.uint8)
+                zoom = apply_lut(zoom_raw, self.lut, self._zooms[back])
+                hist = self._histograms[back]
+                np.copyto(hist, self.histogram.render(zoom_raw))
+            else:
+                zoom_raw = None
+        if self.show_metrics:
+            self.metrics = compute_metrics(zoom_raw if zoom_raw is not None else frame)
+            for k, line in enumerate(self.metrics.lines()):
+                cv2.putText(view, line, (10, 30 + 28 * k), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 255, 255), 2)
+        if status:
+            colour = (255, 255, 255, 255) if status_ok else (0, 0, 255, 255)
+            for k, line in enumerate(reversed(status)):
+                cv2.putText(view, line, (10, view.shape[0] - 12 - 28 * k), cv2.FONT_HERSHEY_SIMPLEX, 0.8, colour, 2)
+        with self._lock:
+            self.view, self.zoom, self.zoom_raw, self.hist = view, zoom, zoom_raw, hist
+            self._front = back
+
+    def front(self) -> Tuple[Optional[np.ndarray], Optional[np.ndarray], Optional[np.ndarray]]:
+        """The last rendered live view, zoom and histogram images. They are not drawn over until the next call."""
+        with self._lock:
+            self._shown = self._front
+            return self.view, self.zoom, self.hist
@@ -0,0 +1,128 @@
+"""This module contains the raw capture file used by the "raw" record format for burst tests. A file per camera is
+preallocated for the number of frames the trigger schedule will produce and memory-mapped, and the camera's FrameRing
+is placed inside the mapping. The grab thread's copy out of the SDK buffer is then the only write a frame needs: there
+is no encoder, no per-frame file and no intermediate array. Slots are never reused, so the file holds every frame of
+the test in order.
+
+File layout: [4096 byte JSON header][FrameRing buffer: seq, ImageID and timestamp arrays, then the frames]
+
+After the test the frames are converted into the usual {test_id}_{ImageID}_{camera}.tif layout with
+    python rawcapture.py export <raw file> [output folder]
+"""
+
+# ======================================================================================================================
+# Imports
+
+import argparse
+import json
+import logging
+import os
+from typing import Any, Dict, Iterator, Tuple
+
+import numpy as np
+
+from frame_buffer import FrameRing
+
+# ======================================================================================================================
+# Global variables
+
+RAW_HEADER_BYTES = 4096
+
+
+# ======================================================================================================================
+# Classes
+
+class RawCaptureFile:
+    """Preallocated memory-mapped capture file holding a FrameRing that is filled once and never wraps."""
+
+    def __init__(self, path: str, header: Dict[str, Any], mapping: np.memmap, clear: bool):
+        self.path = path
+        self.header = header
+        self.mapping = mapping
+        self.ring = FrameRing(header['capacity'], tuple(header['shape']), header['dtype'], overrun_policy='drop_newest',
+                              buffer=mapping[RAW_HEADER_BYTES:], clear=clear)
+
+    @classmethod
+    def create(cls, path: str, capacity: int, shape: Tuple[int, ...], dtype, **header_fields) -> 'RawCaptureFile':
+        """Preallocate a capture file for capacity frames and map it."""
+        header = dict(format='raw', capacity=int(capacity), shape=[int(n) for n in shape], dtype=np.dtype(dtype).str,
+                      **header_fields)
+        header_bytes = json.dumps(header).encode('utf-8')
+        if len(header_bytes) > RAW_HEADER_BYTES:
+            raise ValueError('Raw capture header is too long.')
+        size = RAW_HEADER_BYTES + FrameRing.nbytes(capacity, shape, dtype)
+        with open(path, 'wb') as f:
+            f.write(header_bytes.ljust(RAW_HEADER_BYTES, b'\x00'))
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(f.fileno(), 0, size)  # reserve the blocks now rather than on first write
+            else:
+                f.truncate(size)
+        mapping = np.memmap(path, dtype=np.uint8, mode='r+', shape=(size,))
+        logging.info(f'Preallocated raw capture file {path} for {capacity} frames ({size / 1024 ** 3:.2f} GB).')
+        return cls(path, header, mapping, clear=True)
+
+    @classmethod
+    def open(cls, path: str) -> 'RawCaptureFile':
+        """Open an existing capture file for reading."""
+        with open(path, 'rb') as f:
+            header = json.loads(f.read(RAW_HEADER_BYTES).rstrip(b'\x00').decode('utf-8'))
+        mapping = np.memmap(path, dtype=np.uint8, mode='r')
+        return cls(path, header, mapping, clear=False)
+
+    def frames(self) -> Iterator[Tuple[int, int, np.ndarray]]:
+        """Iterate over the (ImageID, timestamp, frame) of every recorded frame, in recording order."""
+        for slot in np.flatnonzero(self.ring.seq >= 0):
+            yield int(self.ring.image_ids[slot]), int(self.ring.timestamps[slot]), self.ring.slots[slot]
+
+    def flush(self):
+        self.mapping.flush()
+
+    def close(self):
+        if self.mapping.mode != 'r':
+            self.flush()
+        self.ring = None
+        self.mapping = None
+
+
+# ======================================================================================================================
+# Functions
+
+def raw_capture_capacity(expected_frames, fallback_frames: int, margin: float = 0.05) -> int:
+    """Number of slots to preallocate: the frames expected from the trigger schedule plus a margin, or the fallback
+    if the schedule is open ended."""
+    if expected_frames is None:
+        logging.warning(f'The trigger schedule is open ended, preallocating {fallback_frames} raw frames per camera.')
+        return int(fallback_frames)
+    return int(expected_frames * (1 + margin)) + 16
+
+
+def export_raw_to_tiffs(path: str, output_dir: str = '') -> int:
+    """Convert a raw capture file to {test_id}_{ImageID}_{camera}.tif files, by default next to the raw file (the
+    Camera_N folder). Returns the number of frames exported."""
+    import tifffile
+    raw = RawCaptureFile.open(path)
+    output_dir = output_dir or os.path.dirname(os.path.abspath(path))
+    os.makedirs(output_dir, exist_ok=True)
+    test_id = raw.header.get('test_id', 'frame')
+    camera = raw.header.get('camera', '')
+    unpack = None
+    if raw.header.get('packed'):
+        from packed12 import unpack12, unpacked_shape
+        unpack = (unpack12, unpacked_shape(tuple(raw.header['shape'])))
+    exported = 0
+    for image_id, timestamp, frame in raw.frames():
+        if unpack is not None:
+            frame = unpack[0](frame, unpack[1])
+        tifffile.imwrite(os.path.join(output_dir, f'{test_id}_{image_id}_{camera}.tif'), frame, photometric='minisblack')
+        exported += 1
+    raw.close()
+    return exported
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert a raw capture file to one .tif file per frame.')
+    parser.add_argument('command', choices=['export'])
+    parser.add_argument('raw_file', help='.raw capture file')
+    parser.add_argument('output_dir', nargs='?', default='', help='output folder (default: folder of the raw file)')
+    args = parser.parse_args()
+    print(f'Exported {export_raw_to_tiffs(args.raw_file, args.output_dir)} frames.')
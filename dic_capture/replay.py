@@ -0,0 +1,246 @@
+"""This module contains the "replay" camera backend, which feeds a recorded test back through the live pipeline. Each
+camera reads the frames of a recorded camera (Test_ID/Camera_N) in the order of the Raw_Data frame index, or of the
+camera logs for tests recorded before the index existed, and delivers them with their recorded ImageID and timestamp at
+the recorded timing, at a multiple of it or as fast as the pipeline takes them. Frames are read ahead on a background
+thread per camera, so disk reads do not hold up the grab thread.
+
+This makes it possible to tune the ring size, record format, compression and writer settings, or to debug the grab,
+save and preview stages, on a real recording without the cameras attached:
+    "Backend": {
+        "Camera": "replay",
+        "Trigger": "loopback",
+        "Replay Folder": "D:/DIC/T1",
+        "Replay Speed": 1.0,
+        "Replay Prefetch Frames": 32,
+        "Replay Loop": false
+    }
+
+"Replay Speed" 1 keeps the recorded timing, 2 replays twice as fast and 0 as fast as possible. The "Camera Source" of
+each camera section names the recorded camera to replay ("1" or "Camera_1"); cameras whose source does not match one
+are given the next recorded camera. With "Replay Loop" the recording starts again after the last frame, with the
+ImageIDs and timestamps continuing, otherwise the camera times out like one that is no longer triggered."""
+
+# ======================================================================================================================
+# Imports
+
+import logging
+import queue
+import threading
+from time import perf_counter_ns, sleep
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from backends import SimulatedImage, _SimulatedFeatureAccess
+from frame_index import FrameReader, load_frame_index
+from packed12 import pack12
+
+# ======================================================================================================================
+# Global variables
+
+REPLAY_DEFAULTS = {
+    "Replay Folder": "",
+    "Replay Speed": 1.0,  # multiple of the recorded timing, 0 replays as fast as possible
+    "Replay Prefetch Frames": 32,
+    "Replay Loop": False,
+}
+
+
+# ======================================================================================================================
+# Classes
+
+class RecordedFrame(NamedTuple):
+    """A frame of a recorded camera and where it is stored."""
+    image_id: int
+    timestamp_ns: int
+    path: str
+    position: int  # position in a container or raw file, -1 for .tif files
+
+
+class ReplayCam:
+    """Mimics the parts of neoapi.Cam used by the capture pipeline, delivering the frames of a recorded camera.
+
+    :param frames: the recorded frames, in timestamp order
+    :param speed: multiple of the recorded timing, 0 delivers the frames as fast as they are taken
+    :param prefetch_frames: frames read ahead on the background thread
+    :param loop: start again after the last frame
+    :param clock: shared start time of the replay in host ns (one element list), so the cameras of a test stay aligned
+    """
+
+    def __init__(self, frames: List[RecordedFrame], speed: float = 1.0, prefetch_frames: int = 32, loop: bool = False,
+                 clock: Optional[List[Optional[int]]] = None, name: str = ''):
+        self.frames = frames
+        self.speed = float(speed)
+        self.loop = loop
+        self.clock = clock if clock is not None else [None]
+        self.name = name
+        height, width = frame_shape(frames[0])
+        self.f = _SimulatedFeatureAccess(width, height)
+        for feature in (self.f.OffsetX, self.f.OffsetY, self.f.Width, self.f.Height):
+            feature.writable = False  # the recorded frames have a fixed size, a record ROI is cropped in software
+        self.connected = False
+        self.prefetched = queue.Queue(max(1, prefetch_frames))  # (frame, array), None after the last frame
+        self.pending: Optional[Tuple[RecordedFrame, np.ndarray]] = None
+        self.loops = 0
+        self.finished = False
+        self._closed = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        # A loop continues the ImageIDs and timestamps as if the recording had gone on for one more frame period
+        periods = np.diff([frame.timestamp_ns for frame in frames])
+        period_ns = int(np.median(periods)) if len(periods) else 0
+        self.loop_ns = frames[-1].timestamp_ns - frames[0].timestamp_ns + period_ns
+        self.loop_ids = frames[-1].image_id - frames[0].image_id + 1
+
+    # Connection and buffer settings (neoapi.Cam API)
+    def Connect(self, src: str = '') -> 'ReplayCam':
+        self.connected = True
+        return self
+
+    def IsConnected(self) -> bool:
+        return self.connected
+
+    def Disconnect(self):
+        self.connected = False
+        self._closed.set()
+
+    def SetImageBufferCount(self, count: int):
+        pass
+
+    def SetImageBufferCycleCount(self, count: int):
+        pass
+
+    # Image acquisition (neoapi.Cam API)
+    def GetImage(self, timeout_ms: int = 400) -> SimulatedImage:
+        if self._thread is None:  # started on the first grab, once the pixel format has been set
+            self._thread = threading.Thread(target=self._prefetch, daemon=True, name=f'Replay prefetch {self.name}')
+            self._thread.start()
+        if self.pending is None:
+            try:
+                self.pending = self.prefetched.get(timeout=timeout_ms / 1000)
+            except queue.Empty:
+                return SimulatedImage()
+            if self.pending is None:  # end of the recording
+                self.prefetched.put(None)
+                if not self.finished:
+                    self.finished = True
+                    logging.info(f'Camera {self.name}: replay finished.')
+                sleep(timeout_ms / 1000)
+                return SimulatedImage()
+        frame, array = self.pending
+        if self.speed > 0:
+            if self.clock[0] is None:
+                self.clock[0] = perf_counter_ns()
+            t_frame_ns = self.clock[0] + (frame.timestamp_ns - self.frames[0].timestamp_ns) / self.speed
+            wait_s = (t_frame_ns - perf_counter_ns()) / 1e9
+            if wait_s > timeout_ms / 1000:
+                sleep(timeout_ms / 1000)
+                return SimulatedImage()
+            if wait_s > 0:
+                sleep(wait_s)
+        self.pending = None
+        return SimulatedImage(array, frame.image_id, frame.timestamp_ns)
+
+    def _prefetch(self):
+        """Read the frames ahead into the prefetch queue, packed if the pixel format is Mono12p."""
+        reader = FrameReader()
+        packed = self.f.PixelFormat.GetString() == 'Mono12p'
+        try:
+            while not self._closed.is_set():
+                id_offset, time_offset = self.loops * self.loop_ids, self.loops * self.loop_ns
+                for frame in self.frames:
+                    array = reader.read(frame.path, frame.position)
+                    if packed:
+                        array = pack12(array)
+                    elif array.base is not None:  # a view of a memory mapped file, which is closed at the end
+                        array = array.copy()
+                    frame = frame._replace(image_id=frame.image_id + id_offset,
+                                           timestamp_ns=frame.timestamp_ns + time_offset)
+                    if not self._put((frame, array)):
+                        return
+                if not self.loop:
+                    break
+                self.loops += 1
+        except Exception as e:
+            logging.error(f'Camera {self.name}: error reading the recording to replay: {e}')
+        finally:
+            reader.close()
+        self._put(None)
+
+    def _put(self, item) -> bool:
+        """Put an item in the prefetch queue, waiting for space. Returns False if the camera was disconnected."""
+        while not self._closed.is_set():
+            try:
+                self.prefetched.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+
+class ReplayCameraBackend:
+    """Creates ReplayCam objects for the cameras of a recorded test (see the module docstring)."""
+    name = 'replay'
+
+    def __init__(self, settings: Dict[str, Any]):
+        self.settings = {**REPLAY_DEFAULTS, **settings}
+        self.test_dir = str(self.settings["Replay Folder"])
+        self.recorded = recorded_frames(self.test_dir)
+        if not self.recorded:
+            raise ValueError(f'No recorded frames found to replay in {self.test_dir!r}.')
+        self.clock: List[Optional[int]] = [None]
+        self.replayed: List[str] = []
+        self._lock = threading.Lock()  # cameras are connected concurrently
+
+    def connect(self, src: str) -> ReplayCam:
+        camera = str(src).strip()
+        camera = camera[len('Camera_'):] if camera.startswith('Camera_') else camera
+        with self._lock:
+            if camera not in self.recorded or camera in self.replayed:
+                unused = [name for name in self.recorded if name not in self.replayed]
+                if not unused:
+                    raise ValueError(f'No recorded camera left to replay for source {src!r}.')
+                logging.warning(f'Source {src!r} is not a recorded camera of {self.test_dir}, replaying camera '
+                                f'{unused[0]}.')
+                camera = unused[0]
+            self.replayed.append(camera)
+        replay_cam = ReplayCam(self.recorded[camera], float(self.settings["Replay Speed"]),
+                               int(self.settings["Replay Prefetch Frames"]), bool(self.settings["Replay Loop"]),
+                               self.clock, camera)
+        logging.info(f'Replaying {len(self.recorded[camera])} frames of camera {camera} for source {src!r}.')
+        return replay_cam.Connect(src)
+
+    def enable_hardware_trigger(self, camera: ReplayCam):
+        pass  # the frames are delivered at the recorded timing
+
+
+# ======================================================================================================================
+# Functions
+
+def recorded_frames(test_dir: str) -> Dict[str, List[RecordedFrame]]:
+    """The recorded frames of every camera of a test folder, in timestamp order, from the frame index (which is
+    rebuilt from the camera logs, with ms resolution timestamps, for tests without one)."""
+    index = load_frame_index(test_dir)
+    if index is None:
+        return {}
+    cameras = {}
+    for camera in index.cameras:
+        frames = [RecordedFrame(int(record['image_id']), int(record['timestamp_ns']), index.path_of(record),
+                                int(record['position']) if record['file'] >= 0 else -1)
+                  for record in index.camera_records(camera) if record['valid']]
+        if frames:
+            cameras[camera] = frames
+    return cameras
+
+
+def frame_shape(frame: RecordedFrame) -> Tuple[int, int]:
+    """The (height, width) of a recorded frame."""
+    reader = FrameReader()
+    try:
+        return reader.read(frame.path, frame.position).shape
+    finally:
+        reader.close()
+
+
+def recorded_frame_shape(test_dir: str) -> Tuple[int, int]:
+    """The (height, width) of the frames of a recorded test."""
+    return frame_shape(next(iter(recorded_frames(test_dir).values()))[0])
@@ -0,0 +1,112 @@
+"""This module contains the record ROI, a region of the sensor that a camera records instead of the full frame. Small
+specimens often fill a fraction of the frame, and cutting the pixels per frame raises both the frame rate the sensor
+and link sustain and the frames per second the disk can take.
+
+The ROI of a camera is set with "Record ROI" ("x,y,width,height" in sensor pixels) in its "Camera N" section. A test
+mode run prints the zoom rectangle dragged on the live view of each camera as a "Record ROI" value, so it can be pasted
+into the config. With "ROI Mode" "auto" in the "Pipeline" section, the ROI is pushed to the camera (OffsetX, OffsetY,
+Width and Height), rounded out to the camera's increments, so only the ROI is read out and transferred. If the camera
+does not accept it, or with "ROI Mode" "software", the grab thread crops the frames before they enter the frame ring,
+so everything after it (ring, encode and write) handles only the ROI. The ROI that was recorded is stored with the
+frames: in the frame index header, the container and raw file headers and the metadata of .tif frames."""
+
+# ======================================================================================================================
+# Imports
+
+import logging
+from typing import NamedTuple, Optional, Tuple
+
+# ======================================================================================================================
+# Global variables
+
+ROI_MODES = ('auto', 'software')
+
+
+# ======================================================================================================================
+# Classes
+
+class Roi(NamedTuple):
+    """A region of the sensor, in sensor pixels."""
+    x: int
+    y: int
+    width: int
+    height: int
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.height, self.width
+
+    def slices(self, packed: bool = False) -> Tuple[slice, slice]:
+        """Index of the ROI in a frame (in the bytes of a packed Mono12p frame if packed, which needs even x and
+        width)."""
+        if packed:
+            return slice(self.y, self.y + self.height), slice(self.x * 3 // 2, (self.x + self.width) * 3 // 2)
+        return slice(self.y, self.y + self.height), slice(self.x, self.x + self.width)
+
+    def text(self) -> str:
+        """The ROI as a "Record ROI" config value."""
+        return f'{self.x},{self.y},{self.width},{self.height}'
+
+
+# ======================================================================================================================
+# Functions
+
+def parse_roi(value) -> Optional[Roi]:
+    """Parse a "Record ROI" setting ("x,y,width,height", a list of four numbers or empty)."""
+    if value is None or value == '' or value == []:
+        return None
+    if isinstance(value, (list, tuple)):
+        values = [int(v) for v in value]
+    else:
+        values = [int(v) for v in str(value).replace(' ', '').split(',')]
+    if len(values) != 4 or min(values) < 0 or values[2] == 0 or values[3] == 0:
+        raise ValueError(f'Record ROI must be x,y,width,height: {value!r}')
+    return Roi(*values)
+
+
+def roi_from_corners(x0: int, y0: int, x1: int, y1: int) -> Roi:
+    """The ROI spanned by two opposite corners (e.g. of the zoom rectangle)."""
+    return Roi(min(x0, x1), min(y0, y1), abs(x1 - x0), abs(y1 - y0))
+
+
+def align_roi(roi: Roi, frame_shape: Tuple[int, int], x_inc: int = 1, y_inc: int = 1, width_inc: int = 1,
+              height_inc: int = 1) -> Roi:
+    """Round the ROI out to the given increments and clip it to a frame of frame_shape, so it still covers the
+    requested region where the frame allows."""
+    height, width = frame_shape
+    x = min(roi.x, width - 1) // x_inc * x_inc
+    y = min(roi.y, height - 1) // y_inc * y_inc
+    roi_width = -(-(min(roi.x + roi.width, width) - x) // width_inc) * width_inc
+    roi_height = -(-(min(roi.y + roi.height, height) - y) // height_inc) * height_inc
+    roi_width = max(width_inc, min(roi_width, (width - x) // width_inc * width_inc))
+    roi_height = max(height_inc, min(roi_height, (height - y) // height_inc * height_inc))
+    return Roi(x, y, roi_width, roi_height)
+
+
+def apply_camera_roi(camera, roi: Roi) -> Optional[Roi]:
+    """Set the ROI on the camera (OffsetX, OffsetY, Width, Height). Returns the ROI as set, rounded out to the camera's
+    increments, or None if the camera does not support it (the full sensor is restored)."""
+    f = camera.f
+    try:
+        features = (f.OffsetX, f.OffsetY, f.Width, f.Height)
+        if not all(feature.IsWritable() for feature in features):
+            return None
+        sensor = (int(f.HeightMax.Get()), int(f.WidthMax.Get()))
+        aligned = align_roi(roi, sensor, *(max(1, int(feature.GetInc())) for feature in features))
+        f.OffsetX.Set(0)  # the offsets are set last, so the width and height fit the sensor at every step
+        f.OffsetY.Set(0)
+        f.Width.Set(aligned.width)
+        f.Height.Set(aligned.height)
+        f.OffsetX.Set(aligned.x)
+        f.OffsetY.Set(aligned.y)
+        return aligned
+    except Exception as e:
+        logging.warning(f'The camera did not accept the ROI {roi.text()}, cropping in software: {e}')
+        try:
+            f.OffsetX.Set(0)
+            f.OffsetY.Set(0)
+            f.Width.Set(int(f.WidthMax.Get()))
+            f.Height.Set(int(f.HeightMax.Get()))
+        except Exception as e:
+            logging.error(f'Could not restore the full sensor: {e}')
+        return None
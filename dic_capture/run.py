@@ -6,17 +6,27 @@ clicks the "Run" button. The GUI is used to create a config file, which is then
 
 import logging
 import os
+import sys
 import threading
-import tkinter.messagebox
-from threading import Thread
-from time import sleep, time
-from typing import Dict, Any, List
-
-import cv2
-import neoapi
-import numpy as np
-import serial
-import tifffile as tf
+from time import perf_counter, perf_counter_ns, sleep, time
+from typing import Callable, Dict, Any, List, Optional
+
+from backends import check_backend_settings, make_backends
+from camera_pipeline import (EXPOSURE_KEYS, CameraPipeline, PipelineSettings, camera_configs, create_pipelines,
+                             stop_pipelines)
+from compression import check_codec
+from events import EventCapture, watch_console
+from frame_index import write_frame_index
+from health import commanded_stage, write_health_summary
+from instrumentation import Instrumentation
+from metadata import MetadataWriter
+from planner import PREFLIGHT_DEFAULTS, log_report, planned_frame_shape, preflight
+from rawcapture import raw_capture_capacity
+from roi import ROI_MODES
+from schedule import expected_frame_count, parse_trigger_stages
+from serial_protocol import ACK, TriggerEventReader, handshake
+from sync import sync_test
+from writer_pool import WriterPool
 
 # ======================================================================================================================
 # Classes
@@ -48,10 +58,15 @@ def timer_func(func):
     return wrap_func
 
 
-def run(config: Dict[str, Any]):
+def run(config: Dict[str, Any], on_error: Optional[Callable[[str], None]] = None, headless: bool = False,
+        duration_s: Optional[float] = None):
 
 
     """Run the DIC Capture software with the given config file path and record mode.
+
+    on_error is called with the message of errors the user has to see (the GUI shows them in a message box), otherwise
+    they are printed. headless runs without the OpenCV windows (and does not import OpenCV); it stops when the trigger
+    schedule has ended, after duration_s if given, or on Ctrl+C. Returns 0, or 1 if the run could not start.
     
     Example config file:
     {
@@ -90,6 +105,12 @@ def run(config: Dict[str, Any]):
         }
     }
     """
+    def report_error(message: str):
+        if on_error is not None:
+            on_error(message)
+        else:
+            print(f'Error: {message}', file=sys.stderr)
+
     # Extract the IO settings from config
     working_folder: str = config["I/O"]["Working Folder"]
     config_file: str = config["I/O"]["Config File"]
@@ -100,43 +121,104 @@ def run(config: Dict[str, Any]):
     arduino_baud_rate: int = config["Arduino"]["Baud Rate"]
     arduino_max_buffer: int = config["Arduino"]["Image Buffer"]
     trigger_period_stages_ms: str = config["Arduino"]["Trigger speed per stage (ms)"]
-    
-
-    # Extract the Camera 1 settings from config
-    cam1_src: str = config["Camera 1"]["Camera Source"][:4]
-    cam1_exposure_time_ms = config["Camera 1"]["Exposure Time (ms)"]
-
-    # Extract the Camera 2 settings from config
-    cam2_src: str = config["Camera 2"]["Camera Source"][:4]
-    cam2_exposure_time_ms = config["Camera 2"]["Exposure Time (ms)"]
-
-
-    # Extract the Camera 3 settings from config
-    #cam3_source: str = config["Camera 3"]["Camera Source"][:4]
-    #cam3_exposure_time_ms: float = config["Camera 3"]["Exposure Time (ms)"]
+    try:
+        trigger_stages = parse_trigger_stages(trigger_period_stages_ms)
+        trigger_stages_error = None
+    except ValueError as e:
+        trigger_stages, trigger_stages_error = [], e
+
+    # Extract the camera and trigger backend settings from config (optional, defaults to the real hardware)
+    backend_settings: Dict[str, Any] = config.get("Backend", {})
+
+    serial_binary = backend_settings.get("Serial Framing", "text") == "binary"
+    handshake_timeout_s = float(backend_settings.get("Handshake Timeout (s)", 3.0))
+
+    # Extract the capture pipeline settings from config (optional)
+    pipeline_settings: Dict[str, Any] = config.get("Pipeline", {})
+    ring_buffer_frames = int(pipeline_settings.get("Ring Buffer Frames", 64))
+    ring_overrun_policy: str = pipeline_settings.get("Ring Overrun Policy", "drop_newest")
+    record_format: str = pipeline_settings.get("Record Format", "tiff")
+    writer_processes = int(pipeline_settings.get("Writer Processes", 0))
+    container_max_file_gb = float(pipeline_settings.get("Container Max File Size (GB)", 4.0))
+    camera_pixel_format: str = pipeline_settings.get("Camera Pixel Format", "Mono12")
+    raw_capture_frames = int(pipeline_settings.get("Raw Capture Frames", 2000))
+    metadata_flush_interval_s = float(pipeline_settings.get("Metadata Flush Interval (s)", 1.0))
+    stage_timing = bool(pipeline_settings.get("Stage Timing", False))
+    stage_timing_log_interval_s = float(pipeline_settings.get("Stage Timing Log Interval (s)", 10.0))
+    compression: str = str(pipeline_settings.get("Compression", "none")).lower()
+    compression_level = int(pipeline_settings.get("Compression Level", 1))
+    compression_threads = int(pipeline_settings.get("Compression Threads", max(1, (os.cpu_count() or 1) // 2)))
+    compression_adaptive = bool(pipeline_settings.get("Adaptive Compression", False))
+    roi_mode: str = str(pipeline_settings.get("ROI Mode", "auto")).lower()
+
+    # Extract the live preview settings from config (optional)
+    preview_settings: Dict[str, Any] = config.get("Preview", {})
+    preview_max_fps = float(preview_settings.get("Max FPS", 60)) if not headless else 0.0  # no live view headless
+    preview_window_low = int(preview_settings.get("Window Low", 0))
+    preview_window_high = int(preview_settings.get("Window High", 4095))
+    preview_metrics = bool(preview_settings.get("Show Metrics", True))
+
+    # Extract the pre-flight capacity check settings from config (optional)
+    preflight_settings: Dict[str, Any] = {**PREFLIGHT_DEFAULTS, **config.get("Pre-flight", {})}
+    preflight_check = str(preflight_settings["Check"]).lower()
 
     # Output directories
     test_id_dir = os.path.join(working_folder, test_id)
     raw_data_save_dir = os.path.join(working_folder, test_id, 'Raw_Data')
-    cam_1_save_dir = os.path.join(working_folder, test_id, 'Camera_1')
-    cam_2_save_dir = os.path.join(working_folder, test_id, 'Camera_2')
-    cam_3_save_dir = os.path.join(working_folder, test_id, 'Camera_3')
     synced_data_save_dir = os.path.join(working_folder, test_id, 'Synced_Data')
     dic_results_save_dir = os.path.join(working_folder, test_id, 'DIC_Results')
     log_save_dir = os.path.join(working_folder, test_id, 'Logs')
 
+    # Extract the settings of every camera from the "Camera N" sections of the config
+    cameras = camera_configs(config, test_id_dir)
+
     # Create the output folder and sub-folders if record mode is true
     record_mode: bool = config["Record Mode"]
+
+    # Extract the event capture settings from config (optional), only the frames around events are then recorded
+    try:
+        event_capture = EventCapture.from_config(config.get("Event Capture", {})) if record_mode else None
+    except ValueError as e:
+        report_error(f'Invalid event capture settings: {e}')
+        return 1
+
+    # Check the backends before any folder is created
+    try:
+        check_backend_settings(backend_settings)
+    except ValueError as e:
+        report_error(f'Invalid backend settings: {e}.')
+        return 1
+
+    # Check that the disk can take the frames the trigger schedule will produce before anything is written (with event
+    # capture only the event windows are written, at the pace of the disk)
+    t_launch = perf_counter()  # time to first frame is counted from here, so it includes the pre-flight check
+    preflight_report = None
+    if record_mode and preflight_check != 'off' and cameras and event_capture is None:
+        frame_height, frame_width = planned_frame_shape(config)
+        try:
+            preflight_report = preflight(trigger_stages, len(cameras), working_folder, record_format, frame_width,
+                                         frame_height, ring_buffer_frames, camera_pixel_format, writer_processes,
+                                         raw_capture_frames, preflight_settings, compression, compression_level,
+                                         compression_threads)
+        except Exception as e:  # the check must not stop a run it cannot evaluate
+            print(f'Pre-flight check failed: {e}')
+        if preflight_report is not None:
+            print('\n'.join(preflight_report.lines()))
+            if not preflight_report.ok and preflight_check == 'refuse':
+                report_error('The planned test cannot be recorded:\n' + '\n'.join(
+                    preflight_report.problems + [f'Suggestion: {s}' for s in preflight_report.suggestions]))
+                return 1
+    t_preflight = perf_counter() - t_launch
+
     if record_mode:
         # Try to create a folder for the test ID, stop running if folder already exists
         if os.path.exists(test_id_dir):
-            tkinter.messagebox.showerror("Error", f"Folder for test ID {test_id} already exists. Please choose a "
-                                                  f"different test ID.")
+            report_error(f"Folder for test ID {test_id} already exists. Please choose a different test ID.")
             return 1
         else:
             os.makedirs(test_id_dir)
         # Create the sub-folders
-        output_subfolders = [raw_data_save_dir, cam_1_save_dir, cam_2_save_dir, cam_3_save_dir, synced_data_save_dir,
+        output_subfolders = [raw_data_save_dir, *[camera.save_dir for camera in cameras], synced_data_save_dir,
                              dic_results_save_dir, log_save_dir]
         for folder in output_subfolders:
             os.makedirs(folder)
@@ -152,20 +234,97 @@ def run(config: Dict[str, Any]):
         logging.basicConfig(level=logging.CRITICAL)
 
     logging.info('Starting DIC Capture run function.')
+    if trigger_stages_error is not None:
+        logging.error(f'Invalid trigger stages: {trigger_stages_error}')
+    if preflight_report is not None:
+        log_report(preflight_report)
+    t_run_start = perf_counter()
 
-    # Create a serial connection to the Arduino
+    # Create the camera backend and a serial connection to the Arduino
+    try:
+        camera_backend, open_trigger_port = make_backends(backend_settings)
+    except Exception as e:  # ValueError for a replay folder without recorded frames, ImportError for missing drivers
+        logging.error(f'Error creating the camera and trigger backends: {e}')
+        report_error(f"Error creating the camera and trigger backends: {e}")
+        return 1
     try:
-        ser = serial.Serial(arduino_com_port, arduino_baud_rate, timeout=2)
-    except serial.SerialException as e:
+        ser = open_trigger_port(arduino_com_port, arduino_baud_rate, timeout=2)
+    except Exception as e:  # serial.SerialException, or ValueError for invalid port settings
         logging.error(f'Error creating serial connection to Arduino: {e}')
-        tkinter.messagebox.showerror("Error", "Error creating serial connection to Arduino.")
-        # return 1
-    finally:
-        pass
+        report_error(f"Error creating serial connection to Arduino: {e}")
+        return 1
+
+    # Event capture keeps the history of each camera in its frame ring and writes the event windows on the save threads
+    if event_capture is not None:
+        if record_format == 'raw':
+            record_format = 'packed12' if camera_pixel_format == 'Mono12p' else 'tiff'
+            logging.error(f'Record Format raw preallocates every frame and cannot be used with event capture, '
+                          f'using {record_format}.')
+        if writer_processes > 0:
+            logging.warning('Event capture writes the frames on the save threads, Writer Processes is not used.')
+            writer_processes = 0
+        peak_fps = max((stage.fps for stage in trigger_stages), default=0.0)
+        ring_buffer_frames = event_capture.ring_frames(peak_fps, ring_buffer_frames)
+        logging.info(f'Event capture: {event_capture.pre_ns / 1e9:.2f} s before and {event_capture.post_ns / 1e9:.2f} '
+                     f's after each event, {ring_buffer_frames} frames kept per camera.')
+
+    # Packed Mono12p frames from the camera can only be recorded as they are by the packed12 format
+    if camera_pixel_format == 'Mono12p' and record_mode and record_format not in ('packed12', 'raw'):
+        logging.error(f'Camera Pixel Format Mono12p needs Record Format packed12 or raw, not {record_format}. '
+                      f'Using Mono12.')
+        camera_pixel_format = 'Mono12'
+
+    # Compression is only applied by the tiff format (the container formats are read straight from the data offsets)
+    if compression != 'none' and record_mode:
+        if record_format != 'tiff':
+            logging.warning(f'Compression is only supported by Record Format tiff, writing {record_format} '
+                            f'uncompressed.')
+            compression = 'none'
+        else:
+            compression = check_codec(compression)
+    disk_mb_per_s = preflight_report.probe.mb_per_s if preflight_report and preflight_report.probe else None
+
+    if roi_mode not in ROI_MODES:
+        logging.error(f'Unknown ROI Mode {roi_mode!r}, using auto.')
+        roi_mode = 'auto'
 
-    # OLD VARIABLE NAMES HERE
-    #exposure_time_ms = cam1_exposure_time_ms
-    max_buffer_arr = arduino_max_buffer
+    # Set to stop the grab, save and serial threads
+    stop_event = threading.Event()
+
+    # Open the Arduino serial output log for the whole run
+    arduino_log = None
+    if record_mode:
+        arduino_log = MetadataWriter(os.path.join(raw_data_save_dir, f'Arduino_Serial_Output_{test_id}.txt'),
+                                     metadata_flush_interval_s)
+
+    # The raw format preallocates a capture file per camera for every frame the trigger schedule will produce
+    raw_mode = record_mode and record_format == 'raw'
+    raw_capacity = None
+    if raw_mode:
+        raw_capacity = raw_capture_capacity(expected_frame_count(trigger_stages), raw_capture_frames)
+
+    # Start the writer processes, if frames are not written on the cameras' own save threads (the raw format has no
+    # writer, frames are written by the grab thread's copy into the capture file)
+    writer_pool = WriterPool(writer_processes) if record_mode and writer_processes > 0 and not raw_mode else None
+
+    # NOTE: frames are buffered in each camera's FrameRing now, "Image Buffer" (arduino_max_buffer) is no longer used
+    settings = PipelineSettings(record_mode=record_mode, test_id=test_id, test_dir=test_id_dir,
+                                raw_data_dir=raw_data_save_dir, camera_pixel_format=camera_pixel_format,
+                                record_format=record_format, container_max_file_gb=container_max_file_gb,
+                                ring_buffer_frames=ring_buffer_frames, ring_overrun_policy=ring_overrun_policy,
+                                raw_capacity=raw_capacity, metadata_flush_interval_s=metadata_flush_interval_s,
+                                preview_max_fps=preview_max_fps, preview_window_low=preview_window_low,
+                                preview_window_high=preview_window_high, preview_metrics=preview_metrics,
+                                compression=compression, compression_level=compression_level,
+                                compression_threads=compression_threads, compression_adaptive=compression_adaptive,
+                                disk_mb_per_s=disk_mb_per_s, roi_mode=roi_mode, event_capture=event_capture)
+
+    # Latency histograms of the grab, copy-out, handoff, encode, write, metadata and preview stages of every camera
+    instrumentation = Instrumentation(stage_timing, stage_timing_log_interval_s, echo=not record_mode)
+
+    # Parses the Arduino trigger records onto a queue (and into the Arduino log) once the handshake is done
+    trigger_reader = TriggerEventReader(ser, binary=serial_binary, log=arduino_log, echo=not record_mode,
+                                        on_message=event_capture.on_serial_message if event_capture else None)
 
     def get_period_stages():
         return trigger_period_stages_ms
@@ -177,280 +336,33 @@ def run(config: Dict[str, Any]):
         logging.info('Waiting for serial connection to initialize.')
         #sleep(1)
 
-        while True:
-            try:  # reads serial output from audrino
-                ser.write(trigger_period_stages_ms.encode())
-                qValue = ser.readline().strip().decode('ascii')
-                print('serial output: ', qValue)
-
-                if qValue == "RECIEVED":
-                    print("Should break here")
-                    break
-            except Exception as e:
-                logging.error(f'Error reading serial output from Arduino: {e}')
-                print('serial output error')
-                break
-
-        while record_mode:
-            try:
-                while ser.inWaiting() == 0:
-                    pass
-                qValue = ser.read(ser.in_waiting)
-
-                with open(raw_data_save_dir + "/Arduino_Serial_Output_" + test_id + '.txt', 'a') as f:
-                    f.write(qValue.decode('ascii'))
-
-            except Exception as e:
-                logging.error(f'Error reading serial output from Arduino in second block: {e}')
-                print('serial output error in second block')
-                break
-
-        while record_mode == False:
-            try:
-                while ser.inWaiting() == 0:
-                    pass
-                qValue = ser.read(ser.in_waiting)
-                print(qValue)
-
-            except Exception as e:
-                logging.error(f'Error reading serial output from Arduino in second block: {e}')
-                print('serial output error in second block')
-                break
-
+        try:  # send the trigger stages once and wait for the acknowledgement
+            acknowledged = handshake(ser, trigger_period_stages_ms_1, serial_binary, handshake_timeout_s)
+        except Exception as e:
+            logging.error(f'Error reading serial output from Arduino: {e}')
+            acknowledged = False
+        if not acknowledged:
+            logging.error('The Arduino did not acknowledge the trigger stages.')
+            print('serial output error')
+            return
+        print('serial output: ', ACK.decode('ascii'))
 
+        trigger_reader.run(stop_event)  # parse the trigger records onto trigger_reader.events until the run stops
 
-    class vStream():
-        def __init__(self, src, windowName, timeOut_ms, buffer_arr_max, xPos, yPos, xPosHist, yPosHist, cam_save_dir, exposure_time_ms):
-            self.buffer_arr_max = int(buffer_arr_max)
-            self.timeOut_ms = timeOut_ms
-            self.windowName = windowName
-            self.zoomWindowName = windowName + ' Zoomed'
-            self.xPos = xPos
-            self.yPos = yPos
-            self.src = src
-            self.camera = neoapi.Cam()
-            self.camera.Connect(self.src)
-            self.xPosHist = xPosHist
-            self.yPosHist = yPosHist
-            self.cam_save_dir = cam_save_dir
-            self.float_exposure_time = float(exposure_time_ms) * 1000
-            self.camera.SetImageBufferCount(20)
-            self.camera.SetImageBufferCycleCount(10)
-            self.camera.f.PixelFormat.SetString('Mono12')
-            self.camera.f.ExposureTime.Set(self.float_exposure_time)
-            self.camera.f.Gain.Set(1)
-            self.camera.f.TriggerMode = neoapi.TriggerMode_On
-            self.camera.f.TriggerSource = neoapi.TriggerSource_Line2
-            self.camera.f.TriggerActivation = neoapi.TriggerActivation_FallingEdge
-            # self.camera.f.TriggerActivation neoapi.AcquisitionStatusSelector_AcquisitionTriggerWait
-            # self.cam_event = neoapi.NeoEvent()
-            # self.camera.ClearEvents()
-            # self.camera.EnableEvent("ExposureStart")
-            # self.camera.EnableChunk('Image')  # enable the Image chunk to receive the data of the image
-            # self.camera.EnableChunk('ExposureTime')
-            # self.camera.EnableEvent("ExposureStart")
-            self.img_arr = []
-            self.thread_update = Thread(target=self.update, args=())
-            self.thread_update.daemon = True
-            self.arr_A_full = False
-            self.arr_B_full = False
-            self.thread_array_read = Thread(target=self.get_full_arr, args=())
-            self.thread_array_read.daemon = True
-            self.thread_save_array = Thread(target=self.save_array, args=())
-            self.thread_save_array.daemon = True
-            self.img_arr_A = []
-            self.img_arr_B = []
-            self.count_img = 0
-            self.displayWait = False
-            self.clicked = 0
-            self.scale = 0.5
-            self.save_last_array = False
-            self.cam_t0 = 0
-
-        def inc_exposure_ms(self,inc_ms):
-            self.inc_ms = inc_ms
-            self.float_exposure_time = self.float_exposure_time + inc_ms*1000
-            self.camera.f.ExposureTime.Set(self.float_exposure_time)
-            print("Cam"+self.windowName+' changed exposure time to: ', str(self.float_exposure_time/1000)+'ms')
-
-        def click_event(self, event, x, y, flags, params):
-            logging.info('Click event detected.')
-            self.event = event
-            self.flags = flags
-            self.params = params
-            if self.event == cv2.EVENT_LBUTTONDOWN:
-                self.x_0 = x
-                self.y_0 = y
-                self.x_0_scaled = round(self.x_0 / self.scale)
-                self.y_0_scaled = round(self.y_0 / self.scale)
-
-            if self.event == cv2.EVENT_LBUTTONUP:
-                self.x_1 = x
-                self.y_1 = y
-                self.x_1_scaled = round(self.x_1 / self.scale)
-                self.y_1_scaled = round(self.y_1 / self.scale)
-                self.clicked = self.clicked + 1
-
-        def start_vStream(self):
-            logging.info('Starting camera thread.')
-            self.thread_update.start()
-            self.thread_array_read.start()
-            self.thread_save_array.start()
-
-        def update(self):
-            self.temp = []
-            for self.k in range(0, self.buffer_arr_max):
-                self.img_arr_A.append(self.temp)
-                self.img_arr_B.append(self.temp)
-            while True:
-                for self.i in range(0, self.buffer_arr_max):
-                    try:
-                        self.img = self.camera.GetImage(self.timeOut_ms)
-                        self.img_arr_A[self.i] = self.img
-                    except:
-                        pass
-                        print('Image grab problem print problem')
-                self.arr_A_full = True
-                self.arr_B_full = False
-                for self.i in range(0, self.buffer_arr_max):
-                    try:
-                        self.img = self.camera.GetImage(self.timeOut_ms)
-                        self.img_arr_B[self.i] = self.img
-                    except:
-                        print('Image grab problem print problem')
-                        pass
-                self.arr_A_full = False
-                self.arr_B_full = True
-
-        def save_buffer_remainder(self):
-            self.save_last_array = True
-
-        def get_full_arr(self):
-            #while True:
-            if self.arr_A_full:
-                self.arr_A_full = False
-                return self.img_arr_A
-            else:
-                if self.arr_B_full:
-                    self.arr_B_full = False
-                    return self.img_arr_B
-                else:
-                    return 0
-
-        def save_array(self):
-            if (record_mode == True):
-                with open(raw_data_save_dir + '/' + test_id + '_CAM_' + self.windowName + '.txt', 'a') as f:
-                    self.heading_cam = 'Frame' + '\t' + 'Frame_Name' + '\t' + 'Cam_Time' + '\n'
-                    f.write(self.heading_cam)
-            while True:
-                try:
-                    self.img_arr = self.get_full_arr()
-                    if self.save_last_array:
-                        if self.arr_A_full:
-                            self.img_arr = self.img_arr_B
-                        else:
-                            if self.arr_B_full:
-                                self.img_arr = self.img_arr_A
-                            self.save_last_array = False
-
-
-                    if (self.img_arr != 0):
-                        self.frame = self.img_arr[0].GetNPArray()
-                        self.displayWait = False
-                        #threading.Thread(target=self.displayFrame, args=(), daemon=True).start()
-
-                        if (record_mode == True):
-                            for self.k in range(0, self.buffer_arr_max):  # saves an image as .tif and adds image details to .csv file
-                                self.img_title = str(test_id) + '_' + str(self.img_arr[self.k].GetImageID()) + '_' + self.windowName + '.tif'
-                                self.fileName = self.cam_save_dir + '/' + self.img_title
-                                self.save_img = self.img_arr[self.k].GetNPArray()
-                                self.img_ID = self.img_arr[self.k].GetImageID()
-                                self.img_TimeStamp = self.img_arr[self.k].GetTimestamp()
-                                if self.img_TimeStamp != 0:
-                                    if (self.img_ID == 0):
-                                        self.cam_t0 = self.img_TimeStamp
-                                    self.img_TimeStamp_zerod = round((self.img_TimeStamp - self.cam_t0) / 1000000)
-                                    self.data = str(self.img_ID) + '\t' + str(self.img_title) + '\t' + str(
-                                        self.img_TimeStamp_zerod) + '\n'
-                                    tf.imwrite(self.fileName, self.save_img, photometric='minisblack')
-                                    with open(raw_data_save_dir + '/' + test_id + '_CAM_' + self.windowName + '.txt',
-                                              'a') as f:
-                                        f.write(self.data)
-                                    print('saved', self.data)
-                except:
-                    logging.error('Error saving array.')
-                    print('save array error')
-
-
-        def displayFrame(self):
-            try:
-                if self.displayWait == False:
-                    #self.t0 = time()
-                    self.heighTest = self.frame.shape[1]
-                    self.widthTest = self.frame.shape[0]
-                    self.img_resized = self.frame[0:self.widthTest:2,0:self.heighTest:2] #uint16
-                    self.img_resized_8 = (self.img_resized / 256).astype(np.uint8)
-                    self.img_heat_8 = cv2.applyColorMap(self.img_resized_8, cv2.COLORMAP_TURBO)
-                    # self.img_heat_8 = cv2.rotate(self.img_heat_8, cv2.ROTATE_90_COUNTERCLOCKWISE #use to rotate image if needed
-                    self.img_rotated = self.img_heat_8
-                    self.width = int(self.img_rotated.shape[1])
-                    self.height = int(self.img_rotated.shape[0])
-                    if self.clicked > 0:
-                        self.zoomed_16 = self.frame[self.y_0_scaled: self.y_1_scaled, self.x_0_scaled: self.x_1_scaled]
-                        self.zoomed_8 = (self.zoomed_16 / 256).astype(np.uint8)
-                        self.zoomed_heat = cv2.applyColorMap(self.zoomed_8, cv2.COLORMAP_TURBO)
-                    self.show_ready = True
-                    self.displayWait = True
-                    #self.t1 = time()
-                    #print((self.t1 - self.t0) * 1000)
-            except:
-                pass
 
-        def showWindow(self):
-            if self.show_ready:
-                if self.clicked > 0:
-                    self.showHistogram()
-                    cv2.imshow(self.zoomWindowName, self.zoomed_heat)
-                    cv2.namedWindow(self.windowName)
-                    cv2.rectangle(self.img_rotated, (self.x_0, self.y_0), (self.x_1, self.y_1), (0, 0, 255), 2)
-                    cv2.imshow(self.windowName, self.img_rotated)
-                else:
-                    cv2.namedWindow(self.windowName)
-                    cv2.imshow(self.windowName, self.img_rotated)
-                self.show_ready = False
-
-        def showHistogram(self):
-            self.histr = cv2.calcHist([self.zoomed_8], [0], None, [255], [0, 255])
-            self.histr[254] = self.histr[254] * 10000
-            if self.histr[254] > 0:
-                self.histr[254] = int(((max(self.histr) / 10)))
-            self.hist_height = 255
-            self.hist_width = 260
-            self.img_hist = np.zeros((self.hist_height + 1, self.hist_width), dtype=np.uint8)
-            for self.k in range(0, 255):
-                self.temp_hist = int((self.histr[self.k] / (max(self.histr))) * self.hist_height)
-                self.img_hist[0:self.temp_hist, self.k] = self.k  # black
-            self.img_hist[0:self.temp_hist, 255:self.hist_width] = self.k
-            self.img_hist = cv2.flip(self.img_hist, 0)
-            self.img_hist = (self.img_hist).astype('uint8')
-            self.img_hist = cv2.applyColorMap(self.img_hist, cv2.COLORMAP_TURBO)
-            self.hist_window_name = str(self.windowName + ' Histogram')
-            cv2.namedWindow(self.hist_window_name)
-            cv2.imshow(self.hist_window_name, self.img_hist)
-        def getTimestamp(self):
-            return self.timestamp_arr[1]
 
     logging.info('Starting hardware trigger thread.')
-    threading.Thread(target=hardware_trigger, args=(), daemon=True).start()
+    trigger_thread = threading.Thread(target=hardware_trigger, args=(), daemon=True)
+    trigger_thread.start()
 
+    pipelines: List[CameraPipeline] = []
+    exit_code = 0
     try:
-        logging.info('Creating camera objects.')
-        cam1 = vStream(cam1_src, '1', 4000, max_buffer_arr, -16, 0, 1655, 450, cam_1_save_dir, cam1_exposure_time_ms)
-        cam2 = vStream(cam2_src, '2', 4000, max_buffer_arr, 823, 0, 1655, 740, cam_2_save_dir, cam2_exposure_time_ms)
-        # cam3 = vStream(cam3_source, '3', 4000, max_buffer_arr, 823, 0, 1655, 740, cam_3_save_dir)
+        logging.info(f'Creating {len(cameras)} camera pipelines.')
+        pipelines = create_pipelines(cameras, settings, camera_backend, stop_event, writer_pool, instrumentation)
         logging.info('Starting camera threads.')
-        cam1.start_vStream()
-        cam2.start_vStream()
+        for pipeline in pipelines:
+            pipeline.start_vStream()
 
         print('Waiting for cameras to initialize.')
         logging.info('Waiting for cameras to initialize.')
@@ -458,42 +370,100 @@ def run(config: Dict[str, Any]):
 
     except Exception as e:
         logging.error(f'Error creating camera objects: {e}')
-        tkinter.messagebox.showerror("Error", f"Error creating camera objects: {e}.")
-        # return 1
+        report_error(f"Error creating camera objects: {e}.")
+        exit_code = 1
+        stop_event.set()
+
+    if not headless:
+        import cv2
+    elif event_capture is not None:
+        watch_console(event_capture, stop_event)
 
     error_count = 0
-    while True:
-        try:
-            #logging.info('Displaying frames.')
-            cam1.showWindow()
-            cam2.showWindow()
-
-            if record_mode == False:
-                cv2.setMouseCallback(cam1.windowName, cam1.click_event)
-                cv2.setMouseCallback(cam2.windowName, cam2.click_event)
-                key = cv2.waitKeyEx(2)
-                exposure_inc = 1
-                if key == 2555904: #RIGHT arrow key for cam 1
-                    cam1.inc_exposure_ms(exposure_inc)
-                elif key == 2424832: #LEFT arrow key for cam 1
-                    cam1.inc_exposure_ms(-exposure_inc)
-                elif key == 2490368: #UP arrow key for cam 2
-                    cam2.inc_exposure_ms(exposure_inc)
-                elif key == 2621440: #DOWN arrow key for cam 2
-                    cam2.inc_exposure_ms(-exposure_inc)
+    t_first_frame = None
+    t_schedule_end = None
+    try:
+        while not stop_event.is_set():
+            try:
+                #logging.info('Displaying frames.')
+                now = perf_counter()
+                stage, commanded_fps, stage_started_s = commanded_stage(trigger_stages, trigger_reader.first, now)
+                for pipeline in pipelines:
+                    pipeline.health.tick(stage, commanded_fps, now, stage_started_s)
+                    pipeline.adapt_compression()
+                    if not headless:
+                        pipeline.showWindow()
+                instrumentation.log_summary()
+                if t_first_frame is None and any(pipeline.frame_ring.head for pipeline in pipelines):
+                    t_first_frame = perf_counter() - t_launch
+                    logging.info(f'Time to first frame: {t_first_frame:.3f} s (pre-flight check {t_preflight:.3f} s).')
+                    print(f'Time to first frame: {t_first_frame:.3f} s (pre-flight check {t_preflight:.3f} s)')
+
+                if headless:
+                    if duration_s is not None and perf_counter() - t_run_start >= duration_s:
+                        break
+                    if event_capture is not None and event_capture.finished(perf_counter_ns() - 500_000_000):
+                        break  # the last event window has passed (half a second ago, let its last frames arrive)
+                    if trigger_reader.first is not None and stage is None:  # the schedule has ended
+                        t_schedule_end = t_schedule_end or perf_counter()
+                        if perf_counter() - t_schedule_end > 0.5:  # let the last frames arrive
+                            break
+                elif record_mode == False:
+                    for pipeline in pipelines:
+                        cv2.setMouseCallback(pipeline.windowName, pipeline.click_event)
+                    key = cv2.waitKeyEx(2)
+                    exposure_inc = 1
+                    if key in EXPOSURE_KEYS:  # arrow keys for cameras 1 and 2, see EXPOSURE_KEYS for the others
+                        position, sign = EXPOSURE_KEYS[key]
+                        if position < len(pipelines):
+                            pipelines[position].inc_exposure_ms(sign * exposure_inc)
+                elif event_capture is not None:
+                    event_capture.on_key(cv2.waitKeyEx(1))
 
+            except Exception as e:
+                pass
+
+            if headless:
+                sleep(0.01)
+            elif cv2.waitKey(1) == "TEMPORTY BLOCK":  # ord('q'): #work out a safe command for stopping the program
+                break
+            # if cv2.waitKey(10) == ord('q'):
+            #   exposure_time_ms = exposure_time_ms + 10
+    except KeyboardInterrupt:  # Ctrl+C in the console stops the run
+        pass
+
+    logging.info('Exiting program.')
+    stop_pipelines(pipelines, stop_event)
+    for pipeline in pipelines:
+        pipeline.health.tick(None)  # book the frames of a stage stopped part way
+    if not record_mode:  # the zoom rectangles, to be used as the record ROI of the cameras
+        for pipeline in pipelines:
+            zoom_roi = pipeline.zoom_roi()
+            if zoom_roi is not None:
+                print(f'Camera {pipeline.windowName} zoom rectangle as "Record ROI": {zoom_roi.text()}')
+    if writer_pool is not None:
+        writer_pool.close()
+    for pipeline in pipelines:
+        pipeline.close()
+    if record_mode:
+        write_frame_index(os.path.join(raw_data_save_dir, f'{test_id}_frame_index.npz'), test_id,
+                          [pipeline.frame_index for pipeline in pipelines])
+        write_health_summary(os.path.join(log_save_dir, f'{test_id}_health.json'), test_id,
+                             [pipeline.health for pipeline in pipelines], trigger_stages, trigger_reader.count)
+        instrumentation.log_summary(force=True)
+        instrumentation.write_json(os.path.join(log_save_dir, f'{test_id}_stage_timing.json'), test_id)
+        if event_capture is not None:
+            event_capture.write(os.path.join(raw_data_save_dir, f'{test_id}_events.json'), test_id,
+                                int(t_run_start * 1e9))
+    trigger_thread.join(timeout=3)  # returns within the serial read timeout once stop_event is set
+    if arduino_log is not None:
+        arduino_log.close()
+    ser.close()
+    if record_mode:  # match the frames of every camera to the Arduino triggers in Synced_Data
+        try:
+            sync_test(test_id_dir)
         except Exception as e:
-            pass
-
-        if cv2.waitKey(1) == "TEMPORTY BLOCK":  # ord('q'): #work out a safe command for stopping the program
-            logging.info('Exiting program.')
-            # cam1.capture.release()
-            cam1.save_buffer_remainder()
-            cam2.save_buffer_remainder()
-            print()
-            cv2.destroyAllWindows()
-            exit(1)
-            break
-        # if cv2.waitKey(10) == ord('q'):
-        #   exposure_time_ms = exposure_time_ms + 10
-    return 0
+            logging.error(f'Error synchronising the cameras to the Arduino triggers: {e}')
+    if not headless:
+        cv2.destroyAllWindows()
+    return exit_code
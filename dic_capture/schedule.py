@@ -0,0 +1,72 @@
+"""This module contains helpers for the Arduino trigger schedule. The "Trigger speed per stage (ms)" setting is a comma
+separated list that is read as pairs of (trigger period in ms, stage duration in ms), e.g. "30,1000,0,500" triggers
+every 30 ms for one second and then pauses for half a second. A period of 0 means no triggers are sent during that
+stage, and a trailing period without a duration runs until the test is stopped."""
+
+# ======================================================================================================================
+# Imports
+
+from typing import List, NamedTuple, Optional
+
+
+# ======================================================================================================================
+# Classes
+
+class TriggerStage(NamedTuple):
+    """One stage of the trigger schedule."""
+    period_ms: float
+    duration_ms: Optional[float]  # None means the stage runs until the test is stopped
+
+    @property
+    def fps(self) -> float:
+        """Trigger rate of the stage in frames per second."""
+        return 1000 / self.period_ms if self.period_ms > 0 else 0.0
+
+    @property
+    def frame_count(self) -> Optional[int]:
+        """Number of triggers sent during the stage, or None if the stage is open ended."""
+        if self.period_ms <= 0:
+            return 0
+        if self.duration_ms is None:
+            return None
+        return int(self.duration_ms // self.period_ms)
+
+
+# ======================================================================================================================
+# Functions
+
+def parse_trigger_stages(stages: str) -> List[TriggerStage]:
+    """Parse a "Trigger speed per stage (ms)" string into a list of trigger stages."""
+    values = [float(value) for value in str(stages).replace(';', ',').split(',') if value.strip()]
+    if any(value < 0 for value in values):
+        raise ValueError(f'Trigger stages must not be negative: {stages!r}')
+    parsed = []
+    for k in range(0, len(values), 2):
+        duration_ms = values[k + 1] if k + 1 < len(values) else None
+        parsed.append(TriggerStage(values[k], duration_ms))
+    return parsed
+
+
+def expected_frame_count(stages: List[TriggerStage]) -> Optional[int]:
+    """Total number of triggers in the schedule, or None if the schedule ends with an open ended stage."""
+    counts = [stage.frame_count for stage in stages]
+    if any(count is None for count in counts):
+        return None
+    return sum(counts)
+
+
+def stage_at(stages: List[TriggerStage], elapsed_s: float) -> Optional[int]:
+    """Index of the stage running elapsed_s after the schedule started, or None once the schedule has ended."""
+    t_end_s = 0.0
+    for index, stage in enumerate(stages):
+        if stage.duration_ms is None:
+            return index
+        t_end_s += stage.duration_ms / 1000
+        if elapsed_s < t_end_s:
+            return index
+    return None
+
+
+def stage_start_s(stages: List[TriggerStage], index: int) -> float:
+    """Time from the start of the schedule to the start of stage index, in seconds."""
+    return sum(stage.duration_ms or 0.0 for stage in stages[:index]) / 1000
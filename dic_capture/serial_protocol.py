@@ -0,0 +1,223 @@
+"""This module contains the protocol layer for the Arduino serial channel.
+
+Handshake: the host sends the trigger stages string once and waits for the "RECIEVED" acknowledgement, resending only
+after a timeout (the Arduino resets when the port is opened and can miss the first string). Prefixing the stages with
+"B:" asks for binary framing instead of text lines.
+
+After the acknowledgement the Arduino sends one record per trigger:
+    text:   "<stage>,<trigger count>,<micros>\\r\\n"
+    binary: 0xA5 | stage (uint8) | trigger count (uint32) | micros (uint32) | checksum (uint8), little endian, 11 bytes;
+            the checksum is the sum of the 9 payload bytes modulo 256
+
+The parsers turn the incoming bytes into TriggerEvent records incrementally, whatever way the bytes are split across
+reads, and TriggerEventReader puts them on a queue so trigger timing is available live while the test runs.
+"""
+
+# ======================================================================================================================
+# Imports
+
+import logging
+import queue
+import struct
+import threading
+from time import perf_counter
+from typing import Callable, List, NamedTuple, Optional
+
+# ======================================================================================================================
+# Global variables
+
+ACK = b'RECIEVED'  # spelled as the trigger sketch sends it
+BINARY_REQUEST_PREFIX = 'B:'
+BINARY_SYNC = 0xA5
+BINARY_PAYLOAD = struct.Struct('<BII')  # stage, trigger count, micros
+BINARY_RECORD_SIZE = 1 + BINARY_PAYLOAD.size + 1
+MAX_MESSAGE_BYTES = 1024  # longest text line kept between binary records
+
+
+# ======================================================================================================================
+# Classes
+
+class TriggerEvent(NamedTuple):
+    """One trigger sent by the Arduino."""
+    stage: int
+    count: int
+    micros: int  # Arduino micros() when the trigger was sent, wraps at 2^32
+    received_s: float  # host perf_counter() when the record was parsed
+
+    def to_line(self) -> str:
+        """The record as a line of the Arduino serial log."""
+        return f'{self.stage},{self.count},{self.micros}\r\n'
+
+
+class TextTriggerParser:
+    """Incremental parser for text trigger records. Lines that are not trigger records are kept in `messages`."""
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self.messages: List[str] = []
+
+    def feed(self, data: bytes) -> List[TriggerEvent]:
+        """Parse the complete lines in data (plus anything left over from earlier reads)."""
+        self._buffer += data
+        end = self._buffer.rfind(b'\n')
+        if end < 0:
+            return []
+        lines = self._buffer[:end].split(b'\n')
+        del self._buffer[:end + 1]
+        now = perf_counter()
+        events = []
+        for line in lines:
+            fields = line.strip().split(b',')
+            try:
+                if len(fields) != 3:
+                    raise ValueError
+                events.append(TriggerEvent(int(fields[0]), int(fields[1]), int(fields[2]), now))
+            except ValueError:
+                if line.strip():
+                    self.messages.append(line.strip().decode('ascii', errors='replace'))
+        return events
+
+
+class BinaryTriggerParser:
+    """Incremental parser for binary trigger records. Bytes between records are text the Arduino printed (the sync
+    byte is never ASCII): complete printable lines are kept in `messages`, anything else is skipped until the next sync
+    byte and counted in `discarded_bytes`."""
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._text = bytearray()
+        self.messages: List[str] = []
+        self.discarded_bytes = 0
+
+    def feed(self, data: bytes) -> List[TriggerEvent]:
+        self._buffer += data
+        now = perf_counter()
+        events = []
+        start = 0
+        while start < len(self._buffer):
+            if self._buffer[start] != BINARY_SYNC:
+                sync = self._buffer.find(BINARY_SYNC, start + 1)
+                end = sync if sync >= 0 else len(self._buffer)
+                self._text += self._buffer[start:end]
+                start = end
+                continue
+            if len(self._buffer) - start < BINARY_RECORD_SIZE:
+                break  # wait for the rest of the record
+            payload = bytes(self._buffer[start + 1:start + BINARY_RECORD_SIZE - 1])
+            if sum(payload) & 0xFF != self._buffer[start + BINARY_RECORD_SIZE - 1]:
+                self.discarded_bytes += 1
+                start += 1
+                continue
+            events.append(TriggerEvent(*BINARY_PAYLOAD.unpack(payload), now))
+            start += BINARY_RECORD_SIZE
+        del self._buffer[:start]
+        self._collect_messages()
+        return events
+
+    def _collect_messages(self):
+        """Move the complete printable lines of the text between records to messages."""
+        end = self._text.rfind(b'\n')
+        if end >= 0:
+            for line in self._text[:end].split(b'\n'):
+                text = line.strip().decode('ascii', errors='replace')
+                if text.isprintable():
+                    if text:
+                        self.messages.append(text)
+                else:
+                    self.discarded_bytes += len(line) + 1
+            del self._text[:end + 1]
+        if len(self._text) > MAX_MESSAGE_BYTES:  # no line end in sight, not text
+            self.discarded_bytes += len(self._text)
+            self._text.clear()
+
+
+class TriggerEventReader:
+    """Reads the serial port after the handshake, parses the trigger records and puts them on `events`. If the queue
+    is full the oldest event is dropped. The records are also written to the Arduino serial log, as text lines whatever
+    the framing, and printed if echo is set. Other lines from the Arduino are passed to on_message."""
+
+    def __init__(self, ser, binary: bool = False, log=None, echo: bool = False, max_queued: int = 65536,
+                 on_message: Optional[Callable[[str], None]] = None):
+        self.ser = ser
+        self.on_message = on_message
+        self.parser = BinaryTriggerParser() if binary else TextTriggerParser()
+        self.log = log
+        self.echo = echo
+        self.events = queue.Queue(max_queued)
+        self.first: Optional[TriggerEvent] = None
+        self.latest: Optional[TriggerEvent] = None
+        self.count = 0
+        self.dropped_events = 0
+
+    def poll(self) -> List[TriggerEvent]:
+        """Wait up to the serial timeout for data and handle every complete record received."""
+        data = self.ser.read(1)  # blocks until data arrives or the serial timeout expires
+        if not data:
+            return []
+        data += self.ser.read(self.ser.in_waiting)
+        events = self.parser.feed(data)
+        for event in events:
+            try:
+                self.events.put_nowait(event)
+            except queue.Full:
+                self.events.get_nowait()
+                self.events.put_nowait(event)
+                self.dropped_events += 1
+        if events:
+            if self.first is None:
+                self.first = events[0]
+            self.latest = events[-1]
+            self.count += len(events)
+        lines = ''.join(event.to_line() for event in events)
+        if self.parser.messages:
+            lines += ''.join(message + '\r\n' for message in self.parser.messages)
+            if self.on_message is not None:
+                for message in self.parser.messages:
+                    self.on_message(message)
+            self.parser.messages.clear()
+        if lines:
+            if self.log is not None:
+                self.log.write(lines)
+            if self.echo:
+                print(lines, end='')
+        return events
+
+    def run(self, stop_event: threading.Event):
+        """Read trigger records until stop_event is set or the port fails."""
+        while not stop_event.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                logging.error(f'Error reading serial output from Arduino: {e}')
+                print('serial output error')
+                break
+
+
+# ======================================================================================================================
+# Functions
+
+def encode_trigger_event(stage: int, count: int, micros: int, binary: bool = False) -> bytes:
+    """Encode a trigger record the way the Arduino sends it."""
+    if not binary:
+        return f'{stage},{count},{micros}\r\n'.encode('ascii')
+    payload = BINARY_PAYLOAD.pack(stage, count & 0xFFFFFFFF, micros & 0xFFFFFFFF)
+    return bytes([BINARY_SYNC]) + payload + bytes([sum(payload) & 0xFF])
+
+
+def handshake(ser, stages: str, binary: bool = False, timeout_s: float = 3.0, attempts: int = 3) -> bool:
+    """Send the trigger stages and wait for the acknowledgement. The string is sent once per attempt and only resent
+    if no acknowledgement arrived within timeout_s. Returns whether the Arduino acknowledged."""
+    request = (BINARY_REQUEST_PREFIX if binary else '') + str(stages)
+    for attempt in range(attempts):
+        ser.reset_input_buffer()
+        ser.write(request.encode('ascii'))
+        deadline = perf_counter() + timeout_s
+        while perf_counter() < deadline:
+            line = ser.readline()  # blocks up to the serial timeout
+            if line.strip() == ACK:
+                logging.info(f'Arduino acknowledged the trigger stages ({"binary" if binary else "text"} framing).')
+                return True
+            if line.strip():
+                logging.info(f'Serial output before the acknowledgement: {line!r}')
+        logging.warning(f'No acknowledgement from the Arduino after {timeout_s} s (attempt {attempt + 1}).')
+    return False
@@ -0,0 +1,91 @@
+"""This module contains the speckle quality and focus metrics shown on the live preview while a test is set up, and
+logged to the run log when recording starts:
+
+- saturation: fraction of pixels at the Mono12 maximum (4095)
+- mean gradient: mean absolute intensity gradient, the contrast DIC correlates on (higher is better)
+- focus: variance of the Laplacian, which peaks when the speckle is in focus
+- speckle size: mean distance in pixels between crossings of the mean intensity along rows and columns, an estimate of
+  the speckle diameter (3-5 px is ideal for DIC)
+
+The metrics are computed with vectorised numpy/OpenCV kernels on the zoom ROI, or on the whole frame if no ROI is
+selected. To run at preview rate, the gradient, focus and speckle size use the central SAMPLE_SIZE x SAMPLE_SIZE
+pixels of the region at full resolution (they depend on the pixel pitch), and the saturation a strided sample of the
+whole region."""
+
+# ======================================================================================================================
+# Imports
+
+from typing import NamedTuple
+
+import cv2
+import numpy as np
+
+# ======================================================================================================================
+# Global variables
+
+SAMPLE_SIZE = 512
+MONO12_MAX = 4095
+
+
+# ======================================================================================================================
+# Classes
+
+class SpeckleMetrics(NamedTuple):
+    """Speckle quality and focus metrics of an image region."""
+    saturation: float  # fraction of saturated pixels
+    mean_gradient: float  # grey levels per pixel
+    focus: float  # variance of the Laplacian
+    speckle_size_px: float  # in full resolution pixels
+
+    def lines(self):
+        """The metrics as short text lines for the preview overlay."""
+        return [f'sat {self.saturation * 100:.2f}%', f'grad {self.mean_gradient:.0f}', f'focus {self.focus:.0f}',
+                f'speckle {self.speckle_size_px:.1f} px']
+
+    def __str__(self):
+        return (f'saturation {self.saturation * 100:.3f} %, mean gradient {self.mean_gradient:.1f}, '
+                f'focus {self.focus:.1f}, speckle size {self.speckle_size_px:.2f} px')
+
+
+# ======================================================================================================================
+# Functions
+
+def sample_step(shape) -> int:
+    """Stride that brings the longest side of a region down to about SAMPLE_SIZE pixels."""
+    return max(1, -(-max(shape) // SAMPLE_SIZE))
+
+
+def central_crop(pixels: np.ndarray) -> np.ndarray:
+    """The central SAMPLE_SIZE x SAMPLE_SIZE (or smaller) window of a region."""
+    height, width = pixels.shape
+    y0 = max(0, (height - SAMPLE_SIZE) // 2)
+    x0 = max(0, (width - SAMPLE_SIZE) // 2)
+    return pixels[y0:y0 + SAMPLE_SIZE, x0:x0 + SAMPLE_SIZE]
+
+
+def speckle_size(above_mean: np.ndarray) -> float:
+    """Mean run length between crossings of the mean along the rows and columns of a boolean image."""
+    sizes = []
+    for axis in (0, 1):
+        length = above_mean.shape[axis]
+        if length < 2:
+            continue
+        crossings = np.count_nonzero(np.diff(above_mean, axis=axis))
+        lines = above_mean.shape[1 - axis]
+        sizes.append(lines * length / (crossings + lines))
+    return float(np.mean(sizes)) if sizes else 0.0
+
+
+def compute_metrics(pixels: np.ndarray) -> SpeckleMetrics:
+    """Compute the metrics of a Mono12 region (a view into a frame is fine, it is not modified)."""
+    if pixels.size == 0:
+        return SpeckleMetrics(0.0, 0.0, 0.0, 0.0)
+    step = sample_step(pixels.shape)
+    sample = pixels[::step, ::step]
+    saturation = np.count_nonzero(sample >= MONO12_MAX) / sample.size
+    crop = central_crop(pixels).astype(np.float32)
+    gradient_x = np.abs(np.diff(crop, axis=1)).mean() if crop.shape[1] > 1 else 0.0
+    gradient_y = np.abs(np.diff(crop, axis=0)).mean() if crop.shape[0] > 1 else 0.0
+    focus = float(cv2.Laplacian(crop, cv2.CV_32F, ksize=3).var())
+    return SpeckleMetrics(float(saturation), float(gradient_x + gradient_y) / 2, focus,
+                          speckle_size(crop > crop.mean()))
@@ -0,0 +1,202 @@
+"""This module contains the synchronisation engine that fills the Synced_Data folder of a recorded test. It matches the
+frames of every camera to the Arduino trigger that exposed them:
+
+1. The trigger times are read from the Arduino serial log ("stage,count,micros" lines, micros unwrapped at 2^32).
+2. The frame times are read from the frame index (full resolution camera timestamps), or from the camera logs if the
+   test has no index.
+3. For each camera, the camera clock is fitted to the trigger clock as cam_time = (1 + drift) * trigger_time + offset.
+   The fit starts from the first frames and is refined by matching the frames to their nearest predicted trigger with
+   searchsorted and refitting on the matches, over a window that grows to the whole test so that the drift never moves
+   the prediction by more than the match tolerance. Dropped frames and missed triggers do not shift the pairing. The
+   tolerance of each trigger is a fraction of the spacing to its nearest neighbouring trigger, so the fast stages of
+   a schedule are matched as tightly as their period allows whatever the slow stages do.
+4. One row per trigger is written to Synced_Data/{test_id}_synced.csv (and .npz), with the ImageID and time of the
+   frame of each camera (-1 if the camera has no frame for that trigger), plus a report of the fit and of unmatched
+   frames and triggers in {test_id}_sync_report.json.
+
+Run at the end of a recorded test, or afterwards with
+    python sync.py <test folder>
+"""
+
+# ======================================================================================================================
+# Imports
+
+import argparse
+import json
+import logging
+import os
+from typing import Any, Dict, NamedTuple, Tuple
+
+import numpy as np
+
+# ======================================================================================================================
+# Global variables
+
+MICROS_WRAP = 2 ** 32
+FIT_START_FRAMES = 256
+FIT_ITERATIONS = 3
+MATCH_TOLERANCE = 0.25  # a frame matches a trigger if it is within this fraction of the local trigger spacing
+
+
+# ======================================================================================================================
+# Classes
+
+class ClockFit(NamedTuple):
+    """Mapping from the trigger clock to a camera clock, both in seconds."""
+    slope: float
+    offset_s: float
+
+    @property
+    def drift_ppm(self) -> float:
+        return (self.slope - 1) * 1e6
+
+    def to_trigger_time(self, cam_time_s: np.ndarray) -> np.ndarray:
+        return (cam_time_s - self.offset_s) / self.slope
+
+
+# ======================================================================================================================
+# Loading
+
+def load_triggers(arduino_log_path: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Read the Arduino serial log and return the (stage, count, time in s) of every trigger. Lines that are not
+    trigger records are skipped."""
+    with open(arduino_log_path, 'r', errors='replace') as f:
+        lines = [line for line in f.read().split() if line.count(',') == 2]
+    fields = np.array(','.join(lines).split(',') if lines else [], dtype=np.int64).reshape(-1, 3)
+    stage, count, micros = fields.T
+    # micros() wraps every ~71.6 minutes, add 2^32 for every wrap seen so far
+    wraps = np.cumsum(np.diff(micros, prepend=micros[:1]) < 0)
+    return stage, count, (micros + wraps * MICROS_WRAP) / 1e6
+
+
+def load_camera_frames(test_dir: str) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+    """Return {camera: (ImageIDs, camera times in s)} from the frame index, which is rebuilt from the camera logs
+    (ms resolution) if the test has no index."""
+    from frame_index import load_frame_index
+    index = load_frame_index(test_dir)
+    cameras = {}
+    if index is None:
+        return cameras
+    for camera in index.cameras:
+        records = index.camera_records(camera)
+        cameras[camera] = records['image_id'].copy(), records['timestamp_ns'] / 1e9
+    return cameras
+
+
+# ======================================================================================================================
+# Matching
+
+def nearest(sorted_values: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """Index of the nearest element of sorted_values for every element of values."""
+    right = np.clip(np.searchsorted(sorted_values, values), 1, len(sorted_values) - 1)
+    left = right - 1
+    return np.where(values - sorted_values[left] <= sorted_values[right] - values, left, right)
+
+
+def trigger_tolerances(trigger_s: np.ndarray) -> np.ndarray:
+    """Match tolerance of every trigger in s: MATCH_TOLERANCE times the spacing to its nearest neighbour."""
+    spacing = np.diff(trigger_s)
+    return MATCH_TOLERANCE * np.minimum(np.append(spacing[:1], spacing), np.append(spacing, spacing[-1:]))
+
+
+def match_frames(trigger_s: np.ndarray, cam_s: np.ndarray, tolerance_s: np.ndarray,
+                 fit: ClockFit) -> Tuple[np.ndarray, np.ndarray]:
+    """Match every frame to its nearest predicted trigger, within the tolerance of that trigger (see
+    trigger_tolerances). Returns the trigger index of each frame (-1 if unmatched) and the residual in s. If two frames
+    land on the same trigger only the closer one keeps it."""
+    predicted = fit.to_trigger_time(cam_s)
+    trigger = nearest(trigger_s, predicted)
+    residual = predicted - trigger_s[trigger]
+    trigger[np.abs(residual) > tolerance_s[trigger]] = -1
+    order = np.lexsort((np.abs(residual), trigger))
+    duplicate = np.zeros(len(trigger), dtype=bool)
+    duplicate[order[1:]] = (trigger[order[1:]] == trigger[order[:-1]]) & (trigger[order[1:]] >= 0)
+    trigger[duplicate] = -1
+    return trigger, residual
+
+
+def fit_clock(trigger_s: np.ndarray, cam_s: np.ndarray,
+              tolerance_s: np.ndarray) -> Tuple[ClockFit, np.ndarray, np.ndarray]:
+    """Fit the camera clock to the trigger clock and match the frames. Returns the fit, and the trigger index and
+    residual of every frame."""
+    # The first frame belongs to one of the first triggers; keep the start that matches the most of the first frames
+    window = min(len(cam_s), FIT_START_FRAMES)
+    best = None
+    for start in range(min(10, len(trigger_s))):
+        fit = ClockFit(1.0, cam_s[0] - trigger_s[start])
+        matched = np.count_nonzero(match_frames(trigger_s, cam_s[:window], tolerance_s, fit)[0] >= 0)
+        if best is None or matched > best[0]:
+            best = matched, fit
+    fit = best[1]
+    # Refit on a window that grows 8x per step, then iterate on all frames
+    iterations = 0
+    while iterations < FIT_ITERATIONS:
+        trigger, residual = match_frames(trigger_s, cam_s[:window], tolerance_s, fit)
+        matched = trigger >= 0
+        if np.count_nonzero(matched) >= 2:
+            slope, offset = np.polyfit(trigger_s[trigger[matched]], cam_s[:window][matched], 1)
+            fit = ClockFit(float(slope), float(offset))
+        if window == len(cam_s):
+            iterations += 1
+        window = min(len(cam_s), 8 * window)
+    trigger, residual = match_frames(trigger_s, cam_s, tolerance_s, fit)
+    return fit, trigger, residual
+
+
+# ======================================================================================================================
+# Functions
+
+def sync_test(test_dir: str) -> Dict[str, Any]:
+    """Synchronise the cameras of a recorded test to the Arduino triggers, write the synced table and report to
+    Synced_Data and return the report."""
+    test_id = os.path.basename(os.path.normpath(test_dir))
+    stage, count, trigger_s = load_triggers(os.path.join(test_dir, 'Raw_Data', f'Arduino_Serial_Output_{test_id}.txt'))
+    if len(trigger_s) < 2:
+        raise ValueError(f'The Arduino log of {test_id} holds {len(trigger_s)} triggers, at least 2 are needed.')
+    tolerance_s = trigger_tolerances(trigger_s)
+
+    table = {'stage': stage, 'trigger': count, 'trigger_time_s': trigger_s - trigger_s[0]}
+    report = dict(test_id=test_id, triggers=len(trigger_s), tolerance_ms=float(np.median(tolerance_s)) * 1e3,
+                  tolerance_ms_by_stage={int(s): float(np.median(tolerance_s[stage == s])) * 1e3
+                                         for s in np.unique(stage)},
+                  cameras={})
+    for camera, (image_ids, cam_s) in load_camera_frames(test_dir).items():
+        if len(cam_s) == 0:
+            continue
+        fit, trigger, residual = fit_clock(trigger_s, cam_s, tolerance_s)
+        matched = trigger >= 0
+        frame_id = np.full(len(trigger_s), -1, dtype=np.int64)
+        frame_id[trigger[matched]] = image_ids[matched]
+        frame_time = np.full(len(trigger_s), np.nan)
+        frame_time[trigger[matched]] = fit.to_trigger_time(cam_s[matched]) - trigger_s[0]
+        table[f'cam{camera}_image_id'] = frame_id
+        table[f'cam{camera}_time_s'] = frame_time
+        report['cameras'][camera] = dict(
+            frames=len(cam_s), matched=int(np.count_nonzero(matched)),
+            unmatched_frames=image_ids[~matched].tolist(),
+            triggers_without_frame=int(len(trigger_s) - np.count_nonzero(matched)),
+            drift_ppm=fit.drift_ppm, offset_s=fit.offset_s,
+            residual_rms_us=float(np.sqrt(np.mean(residual[matched] ** 2)) * 1e6) if matched.any() else None)
+        logging.info(f'Sync camera {camera}: {report["cameras"][camera]["matched"]} of {len(cam_s)} frames matched '
+                     f'to {len(trigger_s)} triggers, drift {fit.drift_ppm:.1f} ppm.')
+
+    synced_dir = os.path.join(test_dir, 'Synced_Data')
+    os.makedirs(synced_dir, exist_ok=True)
+    np.savez(os.path.join(synced_dir, f'{test_id}_synced.npz'), **table)
+    columns = list(table)
+    np.savetxt(os.path.join(synced_dir, f'{test_id}_synced.csv'), np.column_stack([table[c] for c in columns]),
+               fmt=['%.6f' if c.endswith('_s') else '%d' for c in columns], delimiter=',', header=','.join(columns),
+               comments='')
+    with open(os.path.join(synced_dir, f'{test_id}_sync_report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Match the camera frames of a recorded test to the Arduino triggers.')
+    parser.add_argument('test_dir', help='test folder (holding Raw_Data)')
+    args = parser.parse_args()
+    for camera, result in sync_test(args.test_dir)['cameras'].items():
+        print(f'Camera {camera}: {result["matched"]}/{result["frames"]} frames matched, '
+              f'{result["triggers_without_frame"]} triggers without a frame, {len(result["unmatched_frames"])} '
+              f'unmatched frames, drift {result["drift_ppm"]:.1f} ppm')
@@ -0,0 +1,235 @@
+"""This module contains the WriterPool, a pool of writer processes that encode and save recorded frames outside the
+GIL of the capture process. Each camera's FrameRing is placed in a multiprocessing.shared_memory block: the grab thread
+copies frames straight into it, the save thread only sends the frame's sequence number to a writer process, and the
+writer process reads the pixels from the same shared slot. No pixel data is pickled.
+
+Frames of one camera may be written by several processes at once, but they are always handed back in order: the slot
+is released and the on_written callback (used for the camera log) is called strictly in frame order. Writers that need
+the frames in order themselves (see FrameWriterSpec.ordered) are pinned to a single process."""
+
+# ======================================================================================================================
+# Imports
+
+import logging
+import multiprocessing as mp
+import signal
+import threading
+from multiprocessing import shared_memory
+from time import perf_counter_ns
+from typing import Callable, Dict, Optional, Tuple
+
+import numpy as np
+
+from frame_buffer import FrameRing
+from writers import FrameWriterSpec, make_frame_writer
+
+# ======================================================================================================================
+# Global variables
+
+WORKER_READY_TIMEOUT_S = 60.0  # spawned writer processes import numpy and tifffile before they can attach to a ring
+
+
+# ======================================================================================================================
+# Writer process
+
+def _writer_process(worker_index: int, task_queue: mp.Queue, result_queue: mp.Queue):
+    """Main loop of a writer process. Messages on the task queue are tuples:
+        ('camera', key, shm_name, capacity, shape, dtype, spec) - attach to a camera's shared ring
+        ('frame', key, seq)                                      - write frame seq of a camera
+        ('compression', key, level)                              - change the compression level of a camera
+        ('stop',)                                                - close all writers and exit
+    Attaching to a camera is acknowledged with ('ready', worker_index, key, error) on the result queue, error being
+    None on success.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C stops the run in the parent, which then stops the pool
+    cameras = {}
+    while True:
+        message = task_queue.get()
+        if message[0] == 'frame':
+            _, key, seq = message
+            shm, ring, writer = cameras[key]
+            try:
+                image_id, timestamp = ring.metadata(seq)
+                t_write = perf_counter_ns()
+                frame_name = writer.write(ring.frame(seq), image_id, timestamp) if timestamp != 0 else None
+                write_ns = perf_counter_ns() - t_write - writer.last_encode_ns
+                result_queue.put(('written', key, seq, frame_name, bool(ring.is_valid(seq)), write_ns,
+                                  writer.last_encode_ns, writer.last_nbytes))
+            except Exception as e:
+                result_queue.put(('error', key, seq, repr(e)))
+        elif message[0] == 'camera':
+            _, key, shm_name, capacity, shape, dtype, spec = message
+            try:
+                shm = shared_memory.SharedMemory(name=shm_name)  # the parent owns the block and unlinks it
+                ring = FrameRing(capacity, shape, dtype, buffer=shm.buf, clear=False)
+                cameras[key] = (shm, ring, make_frame_writer(spec))
+                result_queue.put(('ready', worker_index, key, None))
+            except Exception as e:
+                result_queue.put(('ready', worker_index, key, repr(e)))
+        elif message[0] == 'compression':
+            _, key, level = message
+            cameras[key][2].compression_level = level
+        elif message[0] == 'stop':
+            for key in list(cameras):
+                shm, ring, writer = cameras.pop(key)
+                writer.close()
+                del ring
+                shm.close()
+            result_queue.put(('stopped', worker_index))
+            return
+
+
+# ======================================================================================================================
+# Classes
+
+class _PoolCamera:
+    """Book-keeping for one camera in the pool."""
+
+    def __init__(self, ring: FrameRing, shm: shared_memory.SharedMemory, spec: FrameWriterSpec,
+                 on_written: Callable[[int, Optional[str], bool, int, int, int], None], worker: Optional[int]):
+        self.ring = ring
+        self.shm = shm
+        self.spec = spec
+        self.on_written = on_written
+        self.worker = worker  # fixed worker for ordered writers, otherwise None
+        self.submitted = 0
+        self.completed = 0
+        self.max_depth = 0
+        self.errors = 0
+        self.finished = {}  # seq -> (frame_name, valid, write_ns, encode_ns, nbytes) of frames written ahead of others
+        self.ready_workers = 0  # writer processes attached to the ring
+        self.attach_errors = []
+        self.ready = threading.Event()  # set once every writer process has attached (or failed to)
+
+    @property
+    def depth(self) -> int:
+        """Number of frames handed to the pool that have not been written yet."""
+        return self.submitted - self.completed
+
+
+class WriterPool:
+    """Pool of writer processes fed through shared memory frame rings."""
+
+    def __init__(self, processes: int):
+        self.processes = max(1, int(processes))
+        context = mp.get_context('spawn')  # the same start method on Windows and Linux
+        self.task_queues = [context.Queue() for _ in range(self.processes)]
+        self.result_queue = context.Queue()
+        self.workers = [context.Process(target=_writer_process, args=(k, self.task_queues[k], self.result_queue),
+                                        daemon=True)
+                        for k in range(self.processes)]
+        for worker in self.workers:
+            worker.start()
+        self.cameras: Dict[str, _PoolCamera] = {}
+        self._next_worker = 0
+        self._stopped_workers = 0
+        self._collector = threading.Thread(target=self._collect_results, daemon=True)
+        self._collector.start()
+        logging.info(f'Started writer pool with {self.processes} processes.')
+
+    def add_camera(self, key: str, capacity: int, shape: Tuple[int, ...], spec: FrameWriterSpec,
+                   on_written: Callable[[int, Optional[str], bool, int, int, int], None], dtype=np.uint16,
+                   overrun_policy: str = 'drop_newest', timeout_s: float = WORKER_READY_TIMEOUT_S) -> FrameRing:
+        """Create a shared memory frame ring for a camera and register it with every writer process. on_written is
+        called in frame order with (seq, frame_name, valid, write_ns, encode_ns, nbytes) once a frame is on disk;
+        frame_name is None for frames that were skipped because they have no timestamp or could not be written.
+        Returns once every writer process has attached to the ring, so no frames are dropped while the processes are
+        still starting; raises RuntimeError if they do not within timeout_s."""
+        if overrun_policy != 'drop_newest':
+            logging.warning(f'Camera {key}: frames in the writer pool cannot be overwritten, using drop_newest.')
+        shm = shared_memory.SharedMemory(create=True, size=FrameRing.nbytes(capacity, shape, dtype))
+        ring = FrameRing(capacity, shape, dtype, overrun_policy='drop_newest', buffer=shm.buf)
+        worker = len(self.cameras) % self.processes if spec.ordered else None
+        self.cameras[key] = _PoolCamera(ring, shm, spec, on_written, worker)
+        for task_queue in self.task_queues:
+            task_queue.put(('camera', key, shm.name, capacity, ring.shape, ring.dtype.str, spec))
+        camera = self.cameras[key]
+        if not camera.ready.wait(timeout_s):
+            raise RuntimeError(f'Camera {key}: only {camera.ready_workers} of {self.processes} writer processes '
+                               f'attached to the frame ring within {timeout_s:.0f} s.')
+        if camera.attach_errors:
+            raise RuntimeError(f'Camera {key}: writer process could not attach to the frame ring: '
+                               f'{camera.attach_errors[0]}')
+        logging.info(f'Camera {key}: {self.processes} writer processes attached to the frame ring.')
+        return ring
+
+    def submit(self, key: str, seq: int):
+        """Hand frame seq of a camera to a writer process. The frame is released from the ring once written."""
+        camera = self.cameras[key]
+        if camera.worker is None:
+            worker = self._next_worker
+            self._next_worker = (worker + 1) % self.processes
+        else:
+            worker = camera.worker
+        camera.submitted += 1
+        camera.max_depth = max(camera.max_depth, camera.depth)
+        self.task_queues[worker].put(('frame', key, seq))
+
+    def set_compression_level(self, key: str, level: int):
+        """Change the compression level of a camera in every writer process (frames already queued may still be
+        written at the old level)."""
+        for task_queue in self.task_queues:
+            task_queue.put(('compression', key, level))
+
+    def depth(self, key: Optional[str] = None) -> int:
+        """Number of frames waiting to be written, for one camera or for the whole pool."""
+        if key is not None:
+            return self.cameras[key].depth
+        return sum(camera.depth for camera in self.cameras.values())
+
+    def report(self) -> str:
+        """One line summary of the queue depths of all cameras."""
+        return ', '.join(f'camera {key}: {camera.depth} queued (max {camera.max_depth}), {camera.completed} written, '
+                         f'{camera.errors} errors' for key, camera in self.cameras.items())
+
+    def _collect_results(self):
+        """Release written frames and report them to the cameras in frame order."""
+        while self._stopped_workers < self.processes:
+            message = self.result_queue.get()
+            if message[0] == 'stopped':
+                self._stopped_workers += 1
+                continue
+            if message[0] == 'ready':
+                _, worker, key, error = message
+                camera = self.cameras[key]
+                camera.ready_workers += 1
+                if error is not None:
+                    camera.attach_errors.append(f'worker {worker}: {error}')
+                if camera.ready_workers == self.processes:
+                    camera.ready.set()
+                continue
+            if message[0] == 'error':
+                _, key, seq, error = message
+                logging.error(f'Error writing frame {seq} of camera {key}: {error}')
+                self.cameras[key].errors += 1
+                result = (None, False, 0, 0, 0)
+            else:
+                _, key, seq, *result = message
+            camera = self.cameras[key]
+            camera.finished[seq] = result
+            next_seq = camera.ring.tail
+            while next_seq in camera.finished:
+                result = camera.finished.pop(next_seq)
+                try:
+                    camera.on_written(next_seq, *result)
+                except Exception as e:
+                    logging.error(f'Error in on_written callback of camera {key}: {e}')
+                camera.ring.release(next_seq)
+                camera.completed += 1
+                next_seq += 1
+
+    def close(self, timeout_s: float = 30.0):
+        """Write the frames still queued, stop the writer processes and free the shared memory."""
+        for task_queue in self.task_queues:
+            task_queue.put(('stop',))
+        for worker in self.workers:
+            worker.join(timeout_s)
+        self._collector.join(timeout_s)
+        logging.info(f'Writer pool closed: {self.report()}')
+        for camera in self.cameras.values():
+            camera.ring = None
+            try:
+                camera.shm.close()
+            except BufferError:
+                pass  # frame views are still held by the camera, the mapping goes away when the process exits
+            camera.shm.unlink()
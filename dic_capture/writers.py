@@ -0,0 +1,79 @@
+"""This module contains the frame writers that save recorded frames to disk. A writer is created from a picklable
+FrameWriterSpec, so the same writer classes are used on a camera's save thread and inside the writer processes of the
+WriterPool (see writer_pool.py)."""
+
+# ======================================================================================================================
+# Imports
+
+import os
+from typing import NamedTuple, Optional, Tuple
+
+import numpy as np
+
+
+# ======================================================================================================================
+# Classes
+
+class FrameWriterSpec(NamedTuple):
+    """Everything needed to create a frame writer for one camera."""
+    format: str  # "tiff": one .tif per frame, "bigtiff" (container.py) or "packed12" (packed12.py) rolling containers
+    save_dir: str
+    test_id: str
+    camera: str
+    max_file_gb: float = 4.0  # size at which container formats start a new part
+    compression: str = 'none'  # "tiff" format only, see compression.py
+    compression_level: int = 0
+    compression_threads: int = 1
+    roi: Optional[Tuple[int, int, int, int]] = None  # record ROI (x, y, width, height), stored with the frames
+
+    @property
+    def ordered(self) -> bool:
+        """Whether the writer must receive the frames of a camera in order, on a single writer."""
+        return self.format != 'tiff'
+
+
+class TiffFrameWriter:
+    """Writes each frame to its own {test_id}_{ImageID}_{camera}.tif file in the camera save directory, compressed if
+    the spec selects a codec."""
+    last_encode_ns = 0  # time spent encoding the last frame (compression happens inside the write)
+
+    def __init__(self, spec: FrameWriterSpec):
+        import tifffile
+        from compression import check_codec
+        self.tifffile = tifffile
+        self.spec = spec
+        self.codec = check_codec(spec.compression)
+        self.compression_level = spec.compression_level
+        self.last_nbytes = 0  # bytes written for the last frame
+        self.metadata = {'roi': list(spec.roi)} if spec.roi else {}  # written to the ImageDescription as JSON
+
+    def write(self, frame: np.ndarray, image_id: int, timestamp: int) -> str:
+        """Write one frame and return the frame name used in the camera log."""
+        from compression import tiff_compression_args
+        frame_name = f'{self.spec.test_id}_{image_id}_{self.spec.camera}.tif'
+        path = os.path.join(self.spec.save_dir, frame_name)
+        self.tifffile.imwrite(path, frame, photometric='minisblack', metadata=self.metadata,
+                              **tiff_compression_args(self.codec, self.compression_level, self.spec.compression_threads,
+                                                      frame.shape))
+        compressed = self.codec != 'none' and self.compression_level > 0
+        self.last_nbytes = os.path.getsize(path) if compressed else frame.nbytes
+        return frame_name
+
+    def close(self):
+        pass
+
+
+# ======================================================================================================================
+# Functions
+
+def make_frame_writer(spec: FrameWriterSpec):
+    """Create the frame writer for the format in spec."""
+    if spec.format == 'tiff':
+        return TiffFrameWriter(spec)
+    if spec.format == 'bigtiff':
+        from container import BigTiffContainerWriter
+        return BigTiffContainerWriter(spec)
+    if spec.format == 'packed12':
+        from packed12 import Packed12ContainerWriter
+        return Packed12ContainerWriter(spec)
+    raise ValueError(f'Unknown record format: {spec.format!r}')